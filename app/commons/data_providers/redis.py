@@ -15,12 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from aioredis import StrictRedis
-from common import LoggerFactory
 
+from app.commons.logger import LoggerFactory
 from app.config import ConfigClass
+from app.resources.tracing import traced
 
 _logger = LoggerFactory('SrvAioRedisSingleton').get_logger()
 REDIS_INSTANCE = {}
+# aioredis has no instrumentation, the calls are traced by hand
+_REDIS_SPAN_ATTRIBUTES = {'db.system': 'redis'}
 
 
 class SrvAioRedisSingleton:
@@ -51,24 +54,99 @@ class SrvAioRedisSingleton:
     async def get_pipeline(self):
         return await self.__instance.pipeline()
 
+    @traced('redis.get_by_key', _REDIS_SPAN_ATTRIBUTES)
     async def get_by_key(self, key: str):
         return await self.__instance.get(key)
 
-    async def set_by_key(self, key: str, content: str):
-        return await self.__instance.set(key, content)
+    @traced('redis.set_by_key', _REDIS_SPAN_ATTRIBUTES)
+    async def set_by_key(self, key: str, content: str, expire: int = None):
+        return await self.__instance.set(key, content, ex=expire)
 
+    @traced('redis.set_indexed_by_key', _REDIS_SPAN_ATTRIBUTES)
+    async def set_indexed_by_key(self, key: str, content: str, expire: int, index_key: str, score: float):
+        # the key is also added into the sorted set index in one round trip
+        pipeline = self.__instance.pipeline(transaction=False)
+        pipeline.set(key, content, ex=expire)
+        pipeline.zadd(index_key, {key: score})
+        pipeline.expire(index_key, expire)
+        return await pipeline.execute()
+
+    @traced('redis.set_if_not_exist', _REDIS_SPAN_ATTRIBUTES)
+    async def set_if_not_exist(self, key: str, content: str, expire: int = None):
+        return await self.__instance.set(key, content, ex=expire, nx=True)
+
+    @traced('redis.mget_by_prefix', _REDIS_SPAN_ATTRIBUTES)
     async def mget_by_prefix(self, prefix: str):
         # _logger.debug(prefix)
         query = '{}:*'.format(prefix)
         keys = await self.__instance.keys(query)
         return await self.__instance.mget(keys)
 
+    async def keys_by_prefix(self, prefix: str):
+        return await self.__instance.keys('{}:*'.format(prefix))
+
+    async def hget_by_key(self, key: str, field: str):
+        return await self.__instance.hget(key, field)
+
+    @traced('redis.hgetall_by_keys', _REDIS_SPAN_ATTRIBUTES)
+    async def hgetall_by_keys(self, keys: list):
+        # the error of each key is returned in place, e.g. WRONGTYPE
+        pipeline = self.__instance.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hgetall(key)
+        return await pipeline.execute(raise_on_error=False)
+
+    @traced('redis.replace_with_hash', _REDIS_SPAN_ATTRIBUTES)
+    async def replace_with_hash(self, key: str, mapping: dict):
+        pipeline = self.__instance.pipeline()
+        pipeline.delete(key)
+        pipeline.hset(key, mapping=mapping)
+        return await pipeline.execute()
+
+    @traced('redis.mget_by_keys', _REDIS_SPAN_ATTRIBUTES)
+    async def mget_by_keys(self, keys: list):
+        return await self.__instance.mget(keys)
+
+    @traced('redis.mget_by_key_groups', _REDIS_SPAN_ATTRIBUTES)
+    async def mget_by_key_groups(self, key_groups: list):
+        # one MGET for each group of keys in one round trip
+        pipeline = self.__instance.pipeline(transaction=False)
+        for keys in key_groups:
+            pipeline.mget(keys)
+        return await pipeline.execute()
+
+    @traced('redis.hmget_by_key', _REDIS_SPAN_ATTRIBUTES)
+    async def hmget_by_key(self, key: str, fields: list):
+        return await self.__instance.hmget(key, fields)
+
+    async def zrange_by_key(self, key: str, start: int, end: int):
+        return await self.__instance.zrange(key, start, end)
+
+    @traced('redis.zrange_with_scores_by_key', _REDIS_SPAN_ATTRIBUTES)
+    async def zrange_with_scores_by_key(self, key: str):
+        return await self.__instance.zrange(key, 0, -1, withscores=True)
+
     async def check_by_key(self, key: str):
         return await self.__instance.exists(key)
 
     async def delete_by_key(self, key: str):
         return await self.__instance.delete(key)
 
+    @traced('redis.delete_by_keys', _REDIS_SPAN_ATTRIBUTES)
+    async def delete_by_keys(self, keys: list):
+        return await self.__instance.delete(*keys)
+
+    @traced('redis.scan_by_pattern', _REDIS_SPAN_ATTRIBUTES)
+    async def scan_by_pattern(self, pattern: str, count: int = 1000):
+        # SCAN does not block redis like KEYS on large keyspace
+        return [key async for key in self.__instance.scan_iter(match=pattern, count=count)]
+
+    async def memory_usage_by_keys(self, keys: list):
+        pipeline = self.__instance.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        return await pipeline.execute()
+
     async def mdelete_by_prefix(self, prefix: str):
         _logger.debug(prefix)
         query = '{}:*'.format(prefix)
@@ -81,11 +159,16 @@ class SrvAioRedisSingleton:
         keys = await self.__instance.keys(query_string)
         return await self.__instance.mget(keys)
 
+    def register_script(self, script: str):
+        return self.__instance.register_script(script)
+
+    async def hincrby(self, key: str, field: str, amount: int = 1):
+        return await self.__instance.hincrby(key, field, amount)
+
+    @traced('redis.publish', _REDIS_SPAN_ATTRIBUTES)
     async def publish(self, channel, data):
         res = await self.__instance.publish(channel, data)
         return res
 
-    async def subscriber(self, channel):
-        p = await self.__instance.pubsub()
-        p.subscribe(channel)
-        return p
+    def get_pubsub(self):
+        return self.__instance.pubsub()
@@ -14,10 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import time
 from enum import Enum
 
+from app.commons import serializer
+from app.config import ConfigClass
+from app.resources.metrics import observe_stage
+
 from .redis import SrvAioRedisSingleton
 
 _JOB_TYPE = 'data_upload'
@@ -34,6 +37,103 @@ class EState(Enum):
     TERMINATED = 5
 
 
+FINISHED_STATES = (EState.SUCCEED.name, EState.TERMINATED.name)
+
+# the allowed transitions from each state, the missing record is INIT.
+# terminating a terminated job again is allowed so the failure handlers
+# do not need to check the current state
+JOB_TRANSITIONS = {
+    EState.INIT.name: (EState.PRE_UPLOADED.name, EState.TERMINATED.name),
+    EState.PRE_UPLOADED.name: (EState.CHUNK_UPLOADED.name, EState.TERMINATED.name),
+    EState.CHUNK_UPLOADED.name: (EState.FINALIZED.name, EState.TERMINATED.name),
+    EState.FINALIZED.name: (EState.SUCCEED.name, EState.TERMINATED.name),
+    EState.SUCCEED.name: (),
+    EState.TERMINATED.name: (EState.TERMINATED.name,),
+}
+
+# The script validates the transition of job and applies it with the
+# changed fields, the session indexes and the notification atomically.
+# The values are json encoded as they are in the hash, so the script only
+# compares and concatenates them, a new state is appended to the timeline.
+#   KEYS: job key, session jobs index, session job keys index
+#   ARGV: job_id, status channel, target status, timestamp in ms,
+#         record ttl (0 for no expiry), index ttl, number of allowed
+#         current states, the allowed states, field_1, value_1, ...
+# Return:
+#   {1, '<json of the job record>'} if transited, {0, '<current status>'}
+#   if not allowed, {-1, ''} if the record is saved as json string
+_TRANSITION_SCRIPT = '''
+local job_key, jobs_index, job_keys_index = KEYS[1], KEYS[2], KEYS[3]
+local job_id, channel, target, now = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local record_ttl, index_ttl = tonumber(ARGV[5]), tonumber(ARGV[6])
+local fields_start = 8 + tonumber(ARGV[7])
+if redis.call('TYPE', job_key).ok == 'string' then
+    return {-1, ''}
+end
+local current = redis.call('HGET', job_key, 'status') or '"INIT"'
+local allowed = false
+for i = 8, fields_start - 1 do
+    allowed = allowed or ARGV[i] == current
+end
+if not allowed then
+    return {0, current}
+end
+for i = fields_start, #ARGV, 2 do
+    redis.call('HSET', job_key, ARGV[i], ARGV[i + 1])
+end
+local timeline = redis.call('HGET', job_key, 'timeline') or '{}'
+if not string.find(timeline, target .. ':', 1, true) then
+    local separator = timeline == '{}' and '' or ', '
+    timeline = string.sub(timeline, 1, -2) .. separator .. target .. ': ' .. now .. '}'
+end
+redis.call('HSET', job_key, 'status', target, 'timeline', timeline)
+if record_ttl > 0 then
+    redis.call('EXPIRE', job_key, record_ttl)
+end
+redis.call('ZADD', jobs_index, 'NX', now, job_id)
+redis.call('HSET', job_keys_index, job_id, job_key)
+redis.call('EXPIRE', jobs_index, index_ttl)
+redis.call('EXPIRE', job_keys_index, index_ttl)
+local fields = redis.call('HGETALL', job_key)
+local parts = {}
+for i = 1, #fields, 2 do
+    parts[#parts + 1] = '"' .. fields[i] .. '": ' .. fields[i + 1]
+end
+local record = '{' .. table.concat(parts, ', ') .. '}'
+redis.call('PUBLISH', channel, record)
+return {1, record}
+'''
+_transition_script = None
+
+
+class InvalidStateTransition(Exception):
+    """The job can not transit from its current state to the target one."""
+
+    def __init__(self, job_id: str, current_status: str, target_status: str):
+        super().__init__('Job %s can not transit from %s to %s' % (job_id, current_status, target_status))
+        self.current_status = current_status
+        self.target_status = target_status
+
+
+# the fields of job record in order, each field is a json encoded value
+# in the redis hash so it can be updated alone
+JOB_FIELDS = [
+    'session_id',
+    'job_id',
+    'source',
+    'action',
+    'status',
+    'project_code',
+    'operator',
+    'progress',
+    'payload',
+    'timeline',
+    'stage_durations',
+    'critical_path',
+    'update_timestamp',
+]
+
+
 class SessionJob:
     """Session Job ORM."""
 
@@ -51,47 +151,106 @@ class SessionJob:
         self.status = EState.INIT.name
         self.progress = 0
         self.payload = {}
+        # the millisecond timestamp of each status transition, the
+        # millisecond duration of each finalize stage and the chain of
+        # stages that decides the finalize time
+        self.timeline = {}
+        self.stage_durations = {}
+        self.critical_path = []
+        # the encoded fields in redis, only the changed ones are written
+        # with the next transition
+        self._saved_fields = {}
 
     async def set_job_id(self, job_id):
-        """set job id."""
+        """set job id, the job afterwards is a new record."""
         self.job_id = job_id
+        self._saved_fields = {}
 
     def set_source(self, source: str):
-        """set job source."""
+        """set job source, the job afterwards is a new record."""
         self.source = source
+        self._saved_fields = {}
 
     def add_payload(self, key: str, value):
         """will update if exists the same key."""
         self.payload[key] = value
 
-    async def set_status(self, status: str):
-        """set job status."""
-        self.status = status
-        return await self.save()
+    async def set_status(self, status: str, *next_statuses: str):
+        """
+        Summary:
+            transit the job to the status in one round trip, the changed
+            fields are saved with it and the time of transition is recorded.
+        Parameter:
+            - status(str): the target status
+            - next_statuses(str): the statuses to transit through afterwards
+                in the same round trip, e.g. FINALIZED then SUCCEED
+        Return:
+            - (dict) the job record after transition
+        Raise:
+            - InvalidStateTransition if the current status can not transit
+                to the target, e.g. the job is already terminated by others
+        """
+        self._validate()
+
+        job = await session_job_transition(
+            self.session_id, self.job_id, self.get_key(), status, self._changed_fields(), next_statuses=next_statuses
+        )
+        self._load(job)
+        return job
+
+    def _changed_fields(self) -> dict:
+        """the encoded fields changed since last read or save, the status is set by transition."""
+        fields = encode_job_fields(self.get_record())
+        return {
+            field: value
+            for field, value in fields.items()
+            if field not in ('status', 'timeline') and self._saved_fields.get(field) != value
+        }
+
+    def _load(self, job: dict):
+        """load the job record read from redis."""
+        self.source = job['source']
+        self.status = job['status']
+        self.progress = job['progress']
+        self.payload = job['payload']
+        self.timeline = job.get('timeline', {})
+        self.stage_durations = job.get('stage_durations', {})
+        self.critical_path = job.get('critical_path', [])
+        self._saved_fields = encode_job_fields(job)
 
     def set_progress(self, progress: int):
         """set job status."""
         self.progress = progress
 
-    async def save(self):
-        """save in redis."""
+    def get_key(self) -> str:
+        """get the redis key of job record."""
+        return get_job_key(self.session_id, self.job_id, self.action, self.project_code, self.operator, self.source)
+
+    def get_record(self) -> dict:
+        """get the job record."""
+        return {
+            'session_id': self.session_id,
+            'job_id': self.job_id,
+            'source': self.source,
+            'action': self.action,
+            'status': self.status,
+            'project_code': self.project_code,
+            'operator': self.operator,
+            'progress': self.progress,
+            'payload': self.payload,
+            'timeline': self.timeline,
+            'stage_durations': self.stage_durations,
+            'critical_path': self.critical_path,
+            'update_timestamp': str(round(time.time())),
+        }
+
+    def _validate(self):
         if not self.job_id:
             raise (Exception('[SessionJob] job_id not provided'))
         if not self.source:
             raise (Exception('[SessionJob] source not provided'))
         if not self.status:
             raise (Exception('[SessionJob] status not provided'))
-        return await session_job_set_status(
-            self.session_id,
-            self.job_id,
-            self.source,
-            self.action,
-            self.status,
-            self.project_code,
-            self.operator,
-            self.payload,
-            self.progress,
-        )
 
     async def read(self):
         """read from redis."""
@@ -100,18 +259,11 @@ class SessionJob:
         )
         if not fetched:
             raise Exception('[SessionJob] Not found job: {}'.format(self.job_id))
-        job_read = fetched[0]
-        self.source = job_read['source']
-        self.status = job_read['status']
-        self.progress = job_read['progress']
-        self.payload = job_read['payload']
+        self._load(fetched[0])
 
     def get_kv_entity(self):
         """get redis key value pair return key, value, job_dict."""
-        my_key = 'dataaction:{}:Container:{}:{}:{}:{}:{}'.format(
-            self.session_id, self.job_id, self.action, self.project_code, self.operator, self.source
-        )
-        # print('mykey:' + my_key)
+        my_key = self.get_key()
         record = {
             'session_id': self.session_id,
             'job_id': self.job_id,
@@ -124,13 +276,85 @@ class SessionJob:
             'payload': {
                 'task_id': self.payload.get('task_id'),
                 'resumable_identifier': self.payload.get('resumable_identifier'),
+                'chunk_size': self.payload.get('chunk_size'),
+                'upload_mode': self.payload.get('upload_mode'),
             },
+            'timeline': self.timeline,
+            'stage_durations': self.stage_durations,
+            'critical_path': self.critical_path,
             'update_timestamp': str(round(time.time())),
         }
-        my_value = json.dumps(record)
+        my_value = serializer.dumps(record)
         return my_key, my_value, record
 
 
+def encode_job_fields(record: dict) -> dict:
+    """encode the job record into the fields of redis hash."""
+    return {field: serializer.dumpb(value) for field, value in record.items()}
+
+
+def decode_job_fields(fields: dict) -> dict:
+    """decode the fields of redis hash into the job record."""
+    fields = {field.decode('utf-8'): value for field, value in fields.items()}
+    return {field: serializer.loads(fields[field]) for field in JOB_FIELDS if field in fields}
+
+
+async def read_job_records(job_keys: list) -> list:
+    """
+    Summary:
+        read the job records in one round trip.
+    Parameter:
+        - job_keys(list): the keys of job records
+    Return:
+        - the job records in the same order, None for the missing one
+    """
+
+    if not job_keys:
+        return []
+
+    srv_redis = SrvAioRedisSingleton()
+    jobs, legacy_positions = [], []
+    for position, fields in enumerate(await srv_redis.hgetall_by_keys(job_keys)):
+        if isinstance(fields, Exception):
+            # the record was saved as json string before the hash format
+            legacy_positions.append(position)
+            jobs.append(None)
+        else:
+            jobs.append(decode_job_fields(fields) if fields else None)
+
+    if legacy_positions:
+        records = await srv_redis.mget_by_keys([job_keys[position] for position in legacy_positions])
+        for position, record in zip(legacy_positions, records):
+            jobs[position] = serializer.loads(record) if record else None
+
+    return jobs
+
+
+def get_job_key(session_id: str, job_id: str, action: str, project_code: str, operator: str, source: str) -> str:
+    """get the redis key of job record."""
+    return 'dataaction:{}:Container:{}:{}:{}:{}:{}'.format(session_id, job_id, action, project_code, operator, source)
+
+
+def get_status_channel(session_id: str) -> str:
+    """get the pub/sub channel where the job status changes of session are published."""
+    return 'upload_status:{}'.format(session_id)
+
+
+def get_chunk_index_key(job_id: str) -> str:
+    """get the sorted set of chunk etag keys of job scored by the upload timestamp."""
+    return 'chunk_index:{}'.format(job_id)
+
+
+def get_session_jobs_index(session_id: str) -> str:
+    """get the sorted set of job ids in the session ordered by creation."""
+    return 'upload_session_jobs:{}'.format(session_id)
+
+
+def get_session_job_keys_index(session_id: str) -> str:
+    """get the hash from job id to the key of job record in the session."""
+    return 'upload_session_job_keys:{}'.format(session_id)
+
+
 async def get_fsm_object(session_id: str, project_code: str, operator: str, job_id: str = None) -> SessionJob:
 
     fms_object = SessionJob(session_id, project_code, operator, job_id)
@@ -139,36 +363,205 @@ async def get_fsm_object(session_id: str, project_code: str, operator: str, job_
     return fms_object
 
 
-async def session_job_set_status(
+async def get_fsm_objects(session_id: str, jobs: list) -> list:
+    """
+    Summary:
+        read many jobs of session in one round trip through the session
+        index, the job not in index is read one by one.
+    Parameter:
+        - session_id(str): the unique session id
+        - jobs(list): the (project_code, operator, job_id) of each job
+    Return:
+        - (list) the SessionJob of each job, None if the job is not found
+    """
+
+    if not jobs:
+        return []
+
+    srv_redis = SrvAioRedisSingleton()
+    job_keys = await srv_redis.hmget_by_key(get_session_job_keys_index(session_id), [job[2] for job in jobs])
+    records = iter(await read_job_records([job_key for job_key in job_keys if job_key]))
+
+    fsm_objects = []
+    for (project_code, operator, job_id), job_key in zip(jobs, job_keys):
+        fsm_object = SessionJob(session_id, project_code, operator, job_id)
+        record = next(records) if job_key else None
+        try:
+            if record is None:
+                await fsm_object.read()
+            elif record['project_code'] != project_code or record['operator'] != operator:
+                raise Exception('[SessionJob] Not found job: {}'.format(job_id))
+            else:
+                fsm_object._load(record)
+        except Exception:
+            fsm_object = None
+        fsm_objects.append(fsm_object)
+
+    return fsm_objects
+
+
+async def session_job_transition(
     session_id: str,
     job_id: str,
-    source: str,
-    action: str,
+    job_key: str,
     target_status: str,
-    project_code: str,
-    operator: str,
-    payload: str = None,
-    progress: int = 0,
+    fields: dict = None,
+    expected_states: list = None,
+    next_statuses: list = None,
 ) -> dict:
+    """
+    Summary:
+        Transit the job to the target status atomically. The transition is
+        validated against the current status in redis, so the concurrent
+        writers can not overwrite each other, e.g. a chunk failure setting
+        TERMINATED while finalize sets SUCCEED.
+    Parameter:
+        - session_id(str): the unique session id
+        - job_id(str): the job id
+        - job_key(str): the redis key of job record
+        - target_status(str): the target status
+        - fields(dict): the encoded fields to write with the transition
+        - expected_states(list): only transit from these states, default
+            is any state allowed to transit to the target
+        - next_statuses(list): the statuses to transit through afterwards,
+            they are sent in the same round trip
+    Return:
+        - (dict) the job record after the last transition
+    Raise:
+        - InvalidStateTransition if any of the transitions is not allowed
+    """
+
+    srv_redis = SrvAioRedisSingleton()
+    target_statuses = [target_status] + list(next_statuses or [])
+    calls = _transition_calls(session_id, job_id, job_key, target_statuses, fields, expected_states)
+    with observe_stage('job_status_write'):
+        results = await _run_transition_script(calls)
+        if results[0][0] == -1:
+            # the record was saved as json string before the hash format,
+            # convert it and transit again
+            await srv_redis.replace_with_hash(
+                job_key, encode_job_fields(serializer.loads(await srv_redis.get_by_key(job_key)))
+            )
+            results = await _run_transition_script(calls)
+
+    return _transition_result(job_id, target_statuses, results)
+
+
+async def session_jobs_set_status(status_mgrs: list, status: str, *next_statuses: str) -> list:
+    """
+    Summary:
+        Transit many jobs to the status in one round trip, the changed
+        fields of each job are saved with it.
+    Parameter:
+        - status_mgrs(list): the SessionJob of each job
+        - status(str): the target status
+        - next_statuses(str): the statuses to transit through afterwards
+    Return:
+        - (list) the job record after transition of each job, or the
+            InvalidStateTransition if the job can not transit
+    """
+
+    calls, call_counts = [], []
+    for status_mgr in status_mgrs:
+        status_mgr._validate()
+        job_calls = _transition_calls(
+            status_mgr.session_id,
+            status_mgr.job_id,
+            status_mgr.get_key(),
+            [status, *next_statuses],
+            status_mgr._changed_fields(),
+        )
+        calls += job_calls
+        call_counts.append(len(job_calls))
+    if not calls:
+        return []
+
+    with observe_stage('job_status_write'):
+        results = await _run_transition_script(calls)
+
+    outcomes, position = [], 0
+    for status_mgr, call_count in zip(status_mgrs, call_counts):
+        job_end = position + call_count
+        job_results = results[position:job_end]
+        position = job_end
+        try:
+            if job_results[0][0] == -1:
+                # the record saved as json string is converted by the single transition
+                outcomes.append(await status_mgr.set_status(status, *next_statuses))
+                continue
+            job = _transition_result(status_mgr.job_id, [status, *next_statuses], job_results)
+        except InvalidStateTransition as e:
+            outcomes.append(e)
+            continue
+        status_mgr._load(job)
+        outcomes.append(job)
+
+    return outcomes
+
+
+def _transition_calls(
+    session_id: str, job_id: str, job_key: str, target_statuses: list, fields: dict, expected_states: list = None
+) -> list:
+    """build the keys and args of the transition script through the statuses."""
+
+    keys = [job_key, get_session_jobs_index(session_id), get_session_job_keys_index(session_id)]
+    # each of the next statuses can only be reached from the previous one
+    transitions = [(target_statuses[0], expected_states, fields)]
+    for previous_status, next_status in zip(target_statuses, target_statuses[1:]):
+        transitions.append((next_status, [previous_status], None))
+
+    calls = []
+    for status, expected, status_fields in transitions:
+        allowed_states = [
+            serializer.dumps(state)
+            for state, targets in JOB_TRANSITIONS.items()
+            if status in targets and (expected is None or state in expected)
+        ]
+        args = [
+            job_id,
+            get_status_channel(session_id),
+            serializer.dumps(status),
+            round(time.time() * 1000),
+            ConfigClass.JOB_RECORD_TTL if status in FINISHED_STATES else 0,
+            ConfigClass.JOB_ABANDONED_TIMEOUT + ConfigClass.JOB_RECORD_TTL,
+            len(allowed_states),
+            *allowed_states,
+        ]
+        for field, value in (status_fields or {}).items():
+            args += [field, value]
+        calls.append((keys, args))
+
+    return calls
+
+
+def _transition_result(job_id: str, target_statuses: list, results: list) -> dict:
+    """get the job record after the transitions, raise InvalidStateTransition if any is not allowed."""
+
+    for status, (transited, result) in zip(target_statuses, results):
+        if not transited:
+            raise InvalidStateTransition(job_id, serializer.loads(result), status)
+
+    job = serializer.loads(results[-1][1])
+    return {field: job[field] for field in JOB_FIELDS if field in job}
+
+
+async def _run_transition_script(calls: list) -> list:
+    """run the transition script with each of the keys and args, more than one are pipelined."""
+
+    global _transition_script
 
     srv_redis = SrvAioRedisSingleton()
-    my_key = 'dataaction:{}:Container:{}:{}:{}:{}:{}'.format(session_id, job_id, action, project_code, operator, source)
-
-    record = {
-        'session_id': session_id,
-        'job_id': job_id,
-        'source': source,
-        'action': action,
-        'status': target_status,
-        'project_code': project_code,
-        'operator': operator,
-        'progress': progress,
-        'payload': payload,
-        'update_timestamp': str(round(time.time())),
-    }
-    my_value = json.dumps(record)
-    await srv_redis.set_by_key(my_key, my_value)
-    return record
+    if _transition_script is None:
+        _transition_script = srv_redis.register_script(_TRANSITION_SCRIPT)
+
+    if len(calls) == 1:
+        keys, args = calls[0]
+        return [await _transition_script(keys=keys, args=args)]
+
+    pipeline = await srv_redis.get_pipeline()
+    for keys, args in calls:
+        await _transition_script(keys=keys, args=args, client=pipeline)
+    return await pipeline.execute()
 
 
 async def session_job_get_status(
@@ -176,9 +569,98 @@ async def session_job_get_status(
 ) -> list:
 
     srv_redis = SrvAioRedisSingleton()
-    my_key = 'dataaction:{}:Container:{}:{}:{}'.format(session_id, job_id, action, project_code)
-    if operator:
-        my_key = 'dataaction:{}:Container:{}:{}:{}:{}'.format(session_id, job_id, action, project_code, operator)
+    job_keys = []
+    if '*' not in job_id:
+        # find the job through the session index instead of scanning keys
+        job_key = await srv_redis.hget_by_key(get_session_job_keys_index(session_id), job_id)
+        job_keys = [job_key] if job_key else []
+    if not job_keys:
+        my_key = 'dataaction:{}:Container:{}:{}:{}'.format(session_id, job_id, action, project_code)
+        if operator:
+            my_key = 'dataaction:{}:Container:{}:{}:{}:{}'.format(session_id, job_id, action, project_code, operator)
+        job_keys = await srv_redis.keys_by_prefix(my_key)
+
+    conditions = {'action': action, 'project_code': project_code, 'operator': operator}
+    return [
+        job
+        for job in await read_job_records(job_keys)
+        if job is not None and all(value in (None, '*', job.get(field)) for field, value in conditions.items())
+    ]
+
+
+async def session_job_query(
+    session_id: str, job_ids: list = None, status: list = None, cursor: int = 0, page_size: int = 100
+) -> tuple:
+    """
+    Summary:
+        The function reads the jobs of session through the indexes instead
+        of scanning the keys. If the job ids are given, only those jobs
+        will be returned, otherwise all jobs of session in the order of
+        creation.
+    Parameter:
+        - session_id(str): the unique session id
+        - job_ids(list): optional job ids to fetch
+        - status(list): optional status names to filter the jobs
+        - cursor(int): the position to start the page from
+        - page_size(int): the max number of jobs in page
+    Return:
+        - the list of job records
+        - the cursor of next page, None if it is the last page
+    """
+
+    srv_redis = SrvAioRedisSingleton()
+    keys_index = get_session_job_keys_index(session_id)
 
-    res_binary = await srv_redis.mget_by_prefix(my_key)
-    return [json.loads(record.decode('utf-8')) for record in res_binary] if res_binary else []
+    jobs = []
+    while True:
+        # read a page of candidates at once, and keep reading if the
+        # status filter leaves the page unfilled
+        page_end = cursor + page_size
+        if job_ids is not None:
+            candidates = job_ids[cursor:page_end]
+        else:
+            candidates = await srv_redis.zrange_by_key(get_session_jobs_index(session_id), cursor, page_end - 1)
+            candidates = [job_id.decode('utf-8') for job_id in candidates]
+        if not candidates:
+            return jobs, None
+
+        job_keys = await srv_redis.hmget_by_key(keys_index, candidates)
+        records = await read_job_records([key for key in job_keys if key])
+        found_jobs = iter(records)
+        for position, job_key in enumerate(job_keys):
+            # the missing job is skipped and the expired record as well
+            job = next(found_jobs) if job_key else None
+            if job is None:
+                continue
+            if status and job['status'] not in status:
+                continue
+            jobs.append(job)
+            if len(jobs) == page_size:
+                # a short batch means there is nothing after the candidates
+                has_more = position + 1 < len(candidates) or len(candidates) == page_size
+                return jobs, cursor + position + 1 if has_more else None
+
+        if len(candidates) < page_size:
+            return jobs, None
+        cursor += len(candidates)
+
+
+async def session_job_scan(batch_size: int = 500):
+    """
+    Summary:
+        The generator walks through ALL job records with SCAN, it is for
+        the background maintenance instead of the api.
+    Parameter:
+        - batch_size(int): the number of records read at once
+    Return:
+        - the job records
+    """
+
+    srv_redis = SrvAioRedisSingleton()
+    job_keys = await srv_redis.scan_by_pattern('dataaction:*')
+    for index in range(0, len(job_keys), batch_size):
+        batch_end = index + batch_size
+        for job in await read_job_records(job_keys[index:batch_end]):
+            # the record might expire after the scan
+            if job is not None:
+                yield job
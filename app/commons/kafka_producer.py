@@ -19,10 +19,12 @@ import os
 from datetime import datetime
 
 from aiokafka import AIOKafkaProducer
-from common import LoggerFactory
 from fastavro import schema, schemaless_writer
+from opentelemetry.trace import SpanKind
 
+from app.commons.logger import LoggerFactory
 from app.config import ConfigClass
+from app.resources.tracing import start_span
 
 
 class KakfaProducer:
@@ -70,8 +72,10 @@ class KakfaProducer:
             - content(bytes): the byte message that will be sent to topic
         '''
 
+        attributes = {'messaging.system': 'kafka', 'messaging.destination': topic, 'upload.bytes': len(content)}
         try:
-            await self.producer.send_and_wait(topic, content)
+            with start_span('kafka.send', attributes, SpanKind.PRODUCER):
+                await self.producer.send_and_wait(topic, content)
         except Exception as e:
             self.logger.error('Fail to send message:%s' % (str(e)))
             raise e
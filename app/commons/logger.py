@@ -0,0 +1,163 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from common import LoggerFactory as CommonLoggerFactory
+
+from app.config import ConfigClass
+from app.resources.metrics import LOG_RECORDS_DROPPED, LOG_RECORDS_SUPPRESSED
+
+# the message templates tracked by each sampling filter, the filter is
+# reset when the eagerly formatted messages fill it up
+_SAMPLING_MAX_TEMPLATES = 1000
+
+
+class AsyncLogDispatcher:
+    """
+    Summary:
+        The log records are put into a queue and handled in a background
+        thread by the handlers of their logger, so writing the log file and
+        stdout does not block the event loop. One thread serves all the
+        loggers. When the queue is full the record is dropped instead of
+        blocking the caller.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.handlers = {}
+        self._queue = queue.Queue(queue_size)
+        self._listener = None
+
+    def start(self) -> None:
+        """start the background thread if it is not running."""
+        if self._listener is None:
+            self._listener = QueueListener(self._queue, self)
+            self._listener.start()
+
+    def stop(self) -> None:
+        """stop the background thread after the queued records are handled."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def after_fork_in_child(self) -> None:
+        # the thread is not copied into the forked gunicorn worker and the
+        # queue might be locked by it, so both are recreated
+        self._queue = queue.Queue(self.queue_size)
+        self._listener = None
+        if self.handlers:
+            self.start()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def handle(self, record: logging.LogRecord) -> None:
+        """handle the record in the background thread by the handlers of its logger."""
+        for handler in self.handlers.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Summary:
+        The handler puts the record into the queue of dispatcher. Unlike
+        QueueHandler it does not format the message in the calling thread,
+        the message and its arguments are formatted by the handlers in the
+        background thread.
+    """
+
+    def __init__(self, dispatcher: AsyncLogDispatcher):
+        super().__init__(None)
+        self.dispatcher = dispatcher
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.dispatcher.enqueue(record)
+
+
+class LogSamplingFilter(logging.Filter):
+    """
+    Summary:
+        The filter lets at most `max_per_second` records of each message
+        template below WARNING pass in every second, e.g. the logs of each
+        chunk. The template is the message before formatting, so the
+        records with different arguments are counted together. The warning
+        and error records always pass.
+    """
+
+    def __init__(self, max_per_second: int):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self._windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        window = self._windows.get(record.msg)
+        if window is None or now - window[0] >= 1:
+            if len(self._windows) >= _SAMPLING_MAX_TEMPLATES:
+                self._windows.clear()
+            window = self._windows[record.msg] = [now, 0]
+        window[1] += 1
+        if window[1] <= self.max_per_second:
+            return True
+
+        LOG_RECORDS_SUPPRESSED.labels(record.name).inc()
+        return False
+
+
+log_dispatcher = AsyncLogDispatcher(ConfigClass.LOG_QUEUE_SIZE)
+atexit.register(log_dispatcher.stop)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=log_dispatcher.after_fork_in_child)
+
+
+class LoggerFactory(CommonLoggerFactory):
+    """
+    Summary:
+        The logger factory of common with the handlers moved behind the
+        queue of log_dispatcher, and the sampling filter for the logger in
+        LOG_RATE_LIMITS.
+    """
+
+    def get_logger(self) -> logging.Logger:
+        logger = super().get_logger()
+
+        if ConfigClass.LOG_ASYNC_ENABLED and not any(isinstance(h, LazyQueueHandler) for h in logger.handlers):
+            log_dispatcher.handlers[logger.name] = list(logger.handlers)
+            logger.handlers = [LazyQueueHandler(log_dispatcher)]
+            log_dispatcher.start()
+
+        max_per_second = ConfigClass.LOG_RATE_LIMITS.get(logger.name)
+        if max_per_second and not any(isinstance(f, LogSamplingFilter) for f in logger.filters):
+            logger.addFilter(LogSamplingFilter(max_per_second))
+
+        return logger
@@ -73,6 +73,93 @@ class Settings(BaseSettings):
     KAFKA_URL: str
     KAFKA_ACTIVITY_TOPIC: str = 'metadata.items.activity'
 
+    # chunk upload
+    CHUNK_SIZE_DEFAULT: int = 2 * 1024 * 1024
+    CHUNK_SIZE_MAX: int = 100 * 1024 * 1024
+    CHUNK_SIZE_LOAD_THRESHOLD: float = 0.75
+    MULTIPART_MAX_PARTS: int = 10000
+    # the file part of multipart body is kept in memory up to
+    # CHUNK_SPOOL_MAX_SIZE instead of the 1MB of starlette, the larger one
+    # is spooled into CHUNK_SPOOL_DIR(default is the system temp dir). The
+    # memory is bounded by the chunk admission budget
+    CHUNK_SPOOL_MAX_SIZE: int = 100 * 1024 * 1024
+    CHUNK_SPOOL_DIR: str = ''
+    # the file not larger than SMALL_FILE_MAX_SIZE is uploaded in one
+    # request with a plain PUT instead of the multipart upload if client
+    # asks for single upload in pre upload api, 0 to disable
+    SMALL_FILE_MAX_SIZE: int = 1024 * 1024
+
+    # chunk admission control per worker
+    CHUNK_ADMISSION_MAX_BYTES: int = 256 * 1024 * 1024
+    CHUNK_ADMISSION_MAX_CONCURRENCY: int = 64
+    CHUNK_ADMISSION_RETRY_AFTER: int = 1
+
+    # distributed rate limit, the values are per second
+    RATE_LIMIT_ENABLED: bool = False
+    RATE_LIMIT_BURST_SECONDS: int = 10
+    RATE_LIMIT_PROJECT_CHUNK_BYTES: int = 200 * 1024 * 1024
+    RATE_LIMIT_USER_CHUNK_BYTES: int = 100 * 1024 * 1024
+    RATE_LIMIT_PROJECT_PRE_UPLOAD_FILES: int = 2000
+    RATE_LIMIT_USER_PRE_UPLOAD_FILES: int = 1000
+    RATE_LIMIT_PROJECT_OVERRIDES: Dict[str, Dict[str, int]] = {}
+
+    # seconds between the keep-alive comments of the status stream
+    STATUS_STREAM_HEARTBEAT: int = 15
+    # max seconds of the long polling on job status
+    STATUS_LONG_POLL_MAX_WAIT: int = 30
+
+    # redis garbage collection, all in seconds. The finished job records
+    # expire after JOB_RECORD_TTL, the unfinished job without any update
+    # for JOB_ABANDONED_TIMEOUT will be terminated by the sweeper
+    JOB_RECORD_TTL: int = 7 * 24 * 3600
+    JOB_ABANDONED_TIMEOUT: int = 24 * 3600
+    CHUNK_KEY_TTL: int = 7 * 24 * 3600
+    JOB_SWEEP_ENABLED: bool = True
+    JOB_SWEEP_INTERVAL: int = 3600
+    # the multipart upload older than MULTIPART_UPLOAD_MAX_AGE without a
+    # running job will be aborted, the one whose job record has expired
+    # only after JOB_RECORD_TTL as well. In dry run it is only reported.
+    # The on demand reap api is disabled if the admin token is empty
+    MULTIPART_REAPER_ENABLED: bool = True
+    MULTIPART_REAPER_DRY_RUN: bool = True
+    MULTIPART_REAPER_ADMIN_TOKEN: str = ''
+    MULTIPART_REAPER_INTERVAL: int = 6 * 3600
+    MULTIPART_UPLOAD_MAX_AGE: int = 3 * 24 * 3600
+
+    # the json backend of the api responses and the redis records, json
+    # or orjson. It falls back to json if orjson is not installed
+    JSON_SERIALIZER: str = 'orjson'
+
+    # the max number of files finalized at the same time by bulk finalize
+    BULK_FINALIZE_CONCURRENCY: int = 16
+    # the file items of concurrent finalizers are created in the metadata
+    # service with one batch request. A batch is sent once it has
+    # METADATA_BATCH_MAX_SIZE items or METADATA_BATCH_WINDOW milliseconds
+    # passed since its first item. The file with lineage(process pipeline
+    # or parents) still goes through the dataops service
+    METADATA_BATCH_ENABLED: bool = False
+    METADATA_BATCH_WINDOW: int = 20
+    METADATA_BATCH_MAX_SIZE: int = 100
+
+    # the log records are written by a background thread from a queue of
+    # LOG_QUEUE_SIZE records. The logger in LOG_RATE_LIMITS writes at most
+    # the number of records below WARNING for each message per second
+    LOG_ASYNC_ENABLED: bool = True
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_RATE_LIMITS: Dict[str, int] = {'api_data_upload': 10}
+
+    # the event loop lag is sampled every LOOP_MONITOR_INTERVAL milliseconds,
+    # the stack of the loop is logged when it is blocked longer than
+    # LOOP_MONITOR_THRESHOLD milliseconds
+    LOOP_MONITOR_ENABLED: bool = True
+    LOOP_MONITOR_INTERVAL: int = 100
+    LOOP_MONITOR_THRESHOLD: int = 500
+
+    # the admin token of the on demand profiling api, it is disabled if
+    # the token is empty
+    PROFILING_ADMIN_TOKEN: str = ''
+    PROFILING_MAX_SECONDS: int = 60
+
     OPEN_TELEMETRY_ENABLED: bool = False
     OPEN_TELEMETRY_HOST: str = '127.0.0.1'
     OPEN_TELEMETRY_PORT: int = 6831
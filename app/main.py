@@ -18,7 +18,6 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from opentelemetry import trace
 from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.instrumentation.asyncpg import AsyncPGInstrumentor
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
@@ -27,6 +26,7 @@ from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
 from app.api_registry import api_registry
 from app.config import ConfigClass
+from app.resources.admission import ChunkAdmissionMiddleware
 
 
 def create_app():
@@ -41,12 +41,18 @@ def create_app():
         version=ConfigClass.VERSION,
     )
 
+    # reject the chunk uploads before the body is buffered when worker
+    # is saturated. It is added first so the CORS headers still apply
+    app.add_middleware(ChunkAdmissionMiddleware, path='/v1/files/chunks')
+    app.add_middleware(ChunkAdmissionMiddleware, path='/v1/files/single')
+
     app.add_middleware(
         CORSMiddleware,
         allow_origins='*',
         allow_credentials=True,
         allow_methods=['*'],
         allow_headers=['*'],
+        expose_headers=['Retry-After', 'ETag'],
     )
 
     api_registry(app)
@@ -69,7 +75,6 @@ def instrument_app(app: FastAPI) -> None:
 
     FastAPIInstrumentor.instrument_app(app)
     HTTPXClientInstrumentor().instrument()
-    AsyncPGInstrumentor().instrument()
 
     jaeger_exporter = JaegerExporter(
         agent_host_name=ConfigClass.OPEN_TELEMETRY_HOST, agent_port=ConfigClass.OPEN_TELEMETRY_PORT
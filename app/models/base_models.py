@@ -16,9 +16,10 @@
 
 from enum import Enum
 
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
+from app.commons.serializer import FastJSONResponse
+
 
 class EAPIResponseCode(Enum):
     # fastapi.status implements something like this already
@@ -29,6 +30,10 @@ class EAPIResponseCode(Enum):
     forbidden = 403
     unauthorized = 401
     conflict = 409
+    payload_too_large = 413
+    unsupported_media_type = 415
+    too_many_requests = 429
+    service_unavailable = 503
 
 
 class APIResponse(BaseModel):
@@ -39,10 +44,10 @@ class APIResponse(BaseModel):
     num_of_pages: int = 1
     result = []
 
-    def json_response(self):
+    def json_response(self, headers: dict = None):
         data = self.dict()
         data['code'] = self.code.value
-        return JSONResponse(status_code=self.code.value, content=data)
+        return FastJSONResponse(status_code=self.code.value, content=data, headers=headers)
 
 
 class PaginationRequest(BaseModel):
@@ -14,9 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import uuid
+
 import httpx
 
 from app.config import ConfigClass
+from app.models.folder import get_item_payload
+from app.resources.metadata_batcher import metadata_batcher
 
 
 class SrvFileDataMgr:
@@ -44,8 +49,25 @@ class SrvFileDataMgr:
         from_parents=None,
         process_pipeline=None,
         parent_folder_geid=None,
+        client=None,
     ):
-        """Create File Data Entity V2."""
+        """Create File Data Entity V2, the client can be shared by the batch of files."""
+
+        # the lineage is only created by the dataops service
+        if ConfigClass.METADATA_BATCH_ENABLED and not process_pipeline and not from_parents:
+            item = self.get_metadata_item(
+                uploader,
+                file_name,
+                file_size,
+                namespace,
+                project_code,
+                labels,
+                minio_bucket,
+                minio_object_path,
+                version_id,
+                parent_folder_geid,
+            )
+            return {'result': await metadata_batcher.create(item)}
 
         url = self.base_url + 'filedata/'
         post_json_form = {
@@ -71,9 +93,48 @@ class SrvFileDataMgr:
         if from_parents:
             post_json_form['parent_query'] = from_parents
 
-        async with httpx.AsyncClient() as client:
+        if client:
             res = await client.post(url=url, json=post_json_form, timeout=3600)
+        else:
+            async with httpx.AsyncClient() as client:
+                res = await client.post(url=url, json=post_json_form, timeout=3600)
         self.logger.debug('SrvFileDataMgr create results: ' + res.text)
         if res.status_code != 200:
             raise Exception('Fail to create data entity: ' + str(res.__dict__))
         return res.json()
+
+    def get_metadata_item(
+        self,
+        uploader,
+        file_name,
+        file_size,
+        namespace,
+        project_code,
+        labels,
+        minio_bucket,
+        minio_object_path,
+        version_id,
+        parent_folder_geid=None,
+    ):
+        """Get the file item of metadata service, same as the one dataops service creates."""
+
+        # the parent path is the relative path of folder joined with dot
+        folder_path = os.path.dirname(minio_object_path)
+        parent_path = '.'.join(name for name in folder_path.split('/') if name not in ('', '.'))
+        scheme = 'https' if ConfigClass.S3_INTERNAL_HTTPS else 'http'
+        location_uri = 'minio://%s://%s/%s/%s' % (scheme, ConfigClass.S3_INTERNAL, minio_bucket, minio_object_path)
+
+        return get_item_payload(
+            str(uuid.uuid4()),
+            parent_folder_geid if parent_folder_geid else '',
+            parent_path,
+            'file',
+            namespace,
+            file_name,
+            file_size,
+            uploader,
+            project_code,
+            location_uri,
+            version_id,
+            labels,
+        )
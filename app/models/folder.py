@@ -15,13 +15,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import time
 import uuid
 
 import httpx
-from common import LoggerFactory
 
+from app.commons.logger import LoggerFactory
 from app.config import ConfigClass
+from app.resources.metrics import observe_stage
 
 _file_mgr_logger = LoggerFactory('folder_manager').get_logger()
 
@@ -50,14 +50,13 @@ class FolderMgr:
                 else []
             )
             node_chain = []
-            read_db_duration = 0
             for name_and_level in nl_pairs:
                 folder_relative_path = '.'.join(path_splitted[: name_and_level['level']])
-                read_db_start_time = time.time()
 
-                new_node = await get_folder_node(
-                    self.project_code, name_and_level['name'], folder_relative_path, creator, self.zone
-                )
+                with observe_stage('folder_lookup'):
+                    new_node = await get_folder_node(
+                        self.project_code, name_and_level['name'], folder_relative_path, creator, self.zone
+                    )
                 # print("Node Name:           ", new_node.folder_name)
                 # print("Node relative path:  ", new_node.folder_relative_path)
                 # print("Node geid:           ", new_node.global_entity_id)
@@ -78,14 +77,10 @@ class FolderMgr:
                     lazy_save = await new_node.lazy_save()
                     self.to_create.append(lazy_save)
 
-                read_db_duration += time.time() - read_db_start_time
-
                 node_chain.append(new_node)
                 self.last_node = new_node
                 # print()
 
-            _file_mgr_logger.warn('Read From db cost ' + str(read_db_duration))
-
             return []
         except Exception:
             raise
@@ -145,23 +140,17 @@ class FolderNode:
     # why dont we just return the self as dict
     async def lazy_save(self):
 
-        zone_mapping = {'greenroom': 0}.get(self.zone, 1)
-
-        payload = {
-            'id': self.global_entity_id,
-            'parent': self.folder_parent_geid,
-            'parent_path': self.folder_relative_path,
-            'type': 'folder',
-            'zone': zone_mapping,
-            'name': self.folder_name,
-            'size': 0,
-            'owner': self.folder_creator,
-            'container_code': self.project_code,
-            'container_type': 'project',
-            'location_uri': '',
-            'version': '',
-            'tags': [],
-        }
+        payload = get_item_payload(
+            self.global_entity_id,
+            self.folder_parent_geid,
+            self.folder_relative_path,
+            'folder',
+            self.zone,
+            self.folder_name,
+            0,
+            self.folder_creator,
+            self.project_code,
+        )
 
         return payload
 
@@ -211,3 +200,36 @@ class FolderNode:
         cache.update({obj_path: self.__dict__})
 
         return self.__dict__
+
+
+def get_item_payload(
+    item_id,
+    parent,
+    parent_path,
+    item_type,
+    zone,
+    name,
+    size,
+    owner,
+    project_code,
+    location_uri='',
+    version='',
+    tags=None,
+):
+    """get the payload of item created in the metadata service."""
+
+    return {
+        'id': item_id,
+        'parent': parent,
+        'parent_path': parent_path,
+        'type': item_type,
+        'zone': 0 if zone == 'greenroom' else 1,
+        'name': name,
+        'size': size,
+        'owner': owner,
+        'container_code': project_code,
+        'container_type': 'project',
+        'location_uri': location_uri,
+        'version': version,
+        'tags': tags if tags is not None else [],
+    }
@@ -27,9 +27,15 @@ class EUploadJobType(Enum):
     AS_FILE = 'AS_FILE'
 
 
+class EUploadMode(Enum):
+    MULTIPART = 'MULTIPART'
+    SINGLE = 'SINGLE'
+
+
 class SingleFileForm(BaseModel):
     resumable_filename: str
     resumable_relative_path: str = ''
+    resumable_total_size: int = None
 
 
 class PreUploadPOST(BaseModel):
@@ -41,6 +47,13 @@ class PreUploadPOST(BaseModel):
     data: List[SingleFileForm]
     current_folder_node = ''
     incremental = False  # TODO remove
+    # the client uploads with the chunk size in response, the number of
+    # chunks is then checked in finalize. The legacy client keeps its own
+    # chunk size and is not checked
+    negotiate_chunk_size: bool = False
+    # the client uploads the file of SINGLE upload_mode in response with
+    # the single upload api. The legacy client always uploads chunks
+    single_upload: bool = False
 
 
 class PreUploadResponse(APIResponse):
@@ -61,6 +74,8 @@ class PreUploadResponse(APIResponse):
                 'payload': {
                     'resumable_identifier': '1bfe8fd8-8b41-11eb-a8bd-eaff9e667817-1616439732',
                     'parent_folder_geid': '1bcbe182-8b41-11eb-bf7a-eaff9e667817-1616439732',
+                    'chunk_size': 2097152,
+                    'upload_mode': 'MULTIPART | SINGLE',
                 },
                 'update_timestamp': '1616439731',
             },
@@ -105,6 +120,38 @@ class OnSuccessUploadPOST(BaseModel):
     upload_message = ''  # cli
 
 
+class BulkOnSuccessUploadPOST(BaseModel):
+    """bulk merge chunks payload model."""
+
+    items: List[OnSuccessUploadPOST] = Field(..., min_items=1, max_items=1000)
+
+
+class BulkOnSuccessUploadResponse(APIResponse):
+    """bulk merge chunks response class."""
+
+    result: list = Field(
+        [],
+        example=[
+            {
+                'job_id': 'upload-0a572418-7c2b-11eb-8428-be498ca98c54-1614780986',
+                'code': 200,
+                'error_msg': '',
+                'job': {
+                    'job_id': 'upload-0a572418-7c2b-11eb-8428-be498ca98c54-1614780986',
+                    'source': '<path>',
+                    'status': 'CHUNK_UPLOADED',
+                },
+            },
+            {
+                'job_id': 'upload-1b683529-7c2b-11eb-8428-be498ca98c54-1614780986',
+                'code': 404,
+                'error_msg': '[SessionJob] Not found job: upload-1b683529-7c2b-11eb-8428-be498ca98c54-1614780986',
+                'job': None,
+            },
+        ],
+    )
+
+
 class GETJobStatusResponse(APIResponse):
     """get Job status response class."""
 
@@ -124,12 +171,56 @@ class GETJobStatusResponse(APIResponse):
                     'resumable_identifier': 'upload-0a572418-7c2b-11eb-8428-be498ca98c54-1614780986',
                     'parent_folder_geid': '1e3fa930-8b41-11eb-845f-eaff9e667817-1616439736',
                 },
+                'timeline': {
+                    'PRE_UPLOADED': 1614780986012,
+                    'CHUNK_UPLOADED': 1614780991250,
+                    'FINALIZED': 1614780993871,
+                    'SUCCEED': 1614780993874,
+                },
+                'stage_durations': {
+                    'folder_creation': 105,
+                    'etag_fetch': 2,
+                    'combine': 1830,
+                    'chunk_cleanup': 1,
+                    'metadata_create': 640,
+                    'kafka': 12,
+                    'finalize': 2484,
+                },
+                'critical_path': ['etag_fetch', 'combine', 'metadata_create', 'kafka'],
                 'update_timestamp': '1614780986',
             }
         ],
     )
 
 
+class JobStatusQueryPOST(BaseModel):
+    """Batch job status query class."""
+
+    job_ids: List[str] = Field(None, max_items=1000)
+    status: List[str] = None
+    fields: List[str] = None
+    cursor: int = Field(0, ge=0)
+    page_size: int = Field(100, ge=1, le=1000)
+
+
+class JobStatusQueryResponse(APIResponse):
+    """Batch job status query response class."""
+
+    result: dict = Field(
+        {},
+        example={
+            'jobs': [
+                {
+                    'job_id': 'upload-0a572418-7c2b-11eb-8428-be498ca98c54-1614780986',
+                    'source': '<path>',
+                    'status': 'SUCCEED',
+                }
+            ],
+            'next_cursor': 100,
+        },
+    )
+
+
 class POSTCombineChunksResponse(APIResponse):
     """get Job status response class."""
 
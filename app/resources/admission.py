@@ -0,0 +1,186 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.models.base_models import APIResponse, EAPIResponseCode
+from app.resources.metrics import (
+    CHUNK_INFLIGHT_BYTES,
+    CHUNK_INFLIGHT_REQUESTS,
+    CHUNK_REJECTED,
+)
+
+_logger = LoggerFactory('chunk_admission').get_logger()
+
+
+class ChunkAdmissionController:
+    """
+    Summary:
+        The per worker budget for chunk uploads. Each chunk is fully buffered
+        in memory before it goes to object storage, so the controller limits
+        both the number of concurrent chunk requests and the sum of their
+        body size. Since each gunicorn worker runs one event loop, the
+        counters do not need any lock.
+    """
+
+    def __init__(self, max_inflight_bytes: int, max_concurrency: int):
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_concurrency = max_concurrency
+        self.inflight_bytes = 0
+        self.inflight_requests = 0
+        self.rejected_requests = 0
+
+    def try_acquire(self, size: int) -> bool:
+        """
+        Summary:
+            Reserve the budget for one chunk request. The request larger
+            than the whole budget is still admitted when worker is idle,
+            otherwise it will never be accepted.
+        Parameter:
+            - size(int): the size of request body in bytes
+        Return:
+            - (bool) True if the request is admitted
+        """
+
+        if self.inflight_requests >= self.max_concurrency or (
+            self.inflight_requests > 0 and self.inflight_bytes + size > self.max_inflight_bytes
+        ):
+            self.rejected_requests += 1
+            CHUNK_REJECTED.inc()
+            return False
+
+        self.inflight_requests += 1
+        self.inflight_bytes += size
+        CHUNK_INFLIGHT_REQUESTS.inc()
+        CHUNK_INFLIGHT_BYTES.inc(size)
+        return True
+
+    def release(self, size: int) -> None:
+        """release the budget reserved by `try_acquire`."""
+        self.inflight_requests -= 1
+        self.inflight_bytes -= size
+        CHUNK_INFLIGHT_REQUESTS.dec()
+        CHUNK_INFLIGHT_BYTES.dec(size)
+
+    def resize(self, size: int, new_size: int) -> None:
+        """
+        Summary:
+            Change the budget reserved by `try_acquire` once the real size
+            of an admitted request is known. The request is never rejected
+            here since its body is already being read.
+        Parameter:
+            - size(int): the size reserved before
+            - new_size(int): the size to reserve instead
+        """
+
+        self.inflight_bytes += new_size - size
+        CHUNK_INFLIGHT_BYTES.inc(new_size - size)
+
+    def get_utilization(self) -> float:
+        """return the ratio of used budget, the larger one of bytes and concurrency."""
+        return max(
+            self.inflight_bytes / max(self.max_inflight_bytes, 1),
+            self.inflight_requests / max(self.max_concurrency, 1),
+        )
+
+    def get_usage(self) -> dict:
+        """return current usage of the worker for autoscaling."""
+        return {
+            'worker_pid': os.getpid(),
+            'inflight_bytes': self.inflight_bytes,
+            'inflight_requests': self.inflight_requests,
+            'max_inflight_bytes': self.max_inflight_bytes,
+            'max_concurrency': self.max_concurrency,
+            'rejected_requests': self.rejected_requests,
+            'utilization': self.get_utilization(),
+        }
+
+
+chunk_admission = ChunkAdmissionController(
+    ConfigClass.CHUNK_ADMISSION_MAX_BYTES, ConfigClass.CHUNK_ADMISSION_MAX_CONCURRENCY
+)
+
+
+class ChunkReservation:
+    """The budget reserved for one admitted chunk request, kept in the ASGI scope."""
+
+    def __init__(self, controller: ChunkAdmissionController, size: int):
+        self.controller = controller
+        self.size = size
+
+    def resize(self, size: int) -> None:
+        """reserve `size` bytes instead of the current size."""
+        self.controller.resize(self.size, size)
+        self.size = size
+
+    def release(self) -> None:
+        """release the budget of request."""
+        self.controller.release(self.size)
+
+
+class ChunkAdmissionMiddleware:
+    """
+    Summary:
+        The ASGI middleware in front of chunk upload api. It checks the budget
+        with Content-Length header BEFORE the multipart body is read. If the
+        worker is saturated, it returns 503 with `Retry-After` header instead
+        of buffering more chunks. The reservation is kept in the scope as
+        `chunk_reservation`, so the compressed request can be resized to
+        the negotiated chunk size of its job once it is known.
+    """
+
+    def __init__(self, app, path: str, controller: ChunkAdmissionController = chunk_admission):
+        self.app = app
+        self.path = path
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        content_length = headers.get(b'content-length')
+        if content_length is not None and not content_length.strip().isdigit():
+            _res = APIResponse()
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = 'Invalid Content-Length header'
+            await _res.json_response()(scope, receive, send)
+            return
+        # the request without content length is counted as the largest chunk.
+        # the compressed one is counted with its declared size up to the
+        # largest chunk, and resized when the chunk size of job is known
+        size = int(content_length) if content_length else ConfigClass.CHUNK_SIZE_MAX
+        if headers.get(b'content-encoding', b'identity').strip().lower() != b'identity':
+            size = min(size, ConfigClass.CHUNK_SIZE_MAX)
+
+        if not self.controller.try_acquire(size):
+            _logger.warning('Reject chunk upload, worker usage: %s', self.controller.get_usage())
+            _res = APIResponse()
+            _res.code = EAPIResponseCode.service_unavailable
+            _res.error_msg = 'Upload service is busy, please retry later'
+            response = _res.json_response(headers={'Retry-After': str(ConfigClass.CHUNK_ADMISSION_RETRY_AFTER)})
+            await response(scope, receive, send)
+            return
+
+        reservation = ChunkReservation(self.controller, size)
+        scope['chunk_reservation'] = reservation
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            reservation.release()
@@ -0,0 +1,485 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import tempfile
+import time
+import zlib
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+from multipart.exceptions import FormParserError
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.datastructures import FormData, Headers, UploadFile
+
+from app.commons import serializer
+from app.commons.data_providers.redis import SrvAioRedisSingleton
+from app.config import ConfigClass
+from app.models.base_models import APIResponse, EAPIResponseCode
+from app.resources.metrics import (
+    CHUNK_COMPRESSED_BYTES,
+    CHUNK_COMPRESSION_RATIO,
+    CHUNK_DECOMPRESS_CPU_SECONDS,
+    CHUNK_DECOMPRESSED_BYTES,
+    CHUNK_SPOOL_AVOIDED_BYTES,
+    CHUNK_SPOOLED_BYTES,
+)
+from app.resources.rate_limit import ERateLimit, RateLimitExceeded, consume_rate_limit
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+_PART_BEGIN = 'part_begin'
+_PART_DATA = 'part_data'
+_PART_END = 'part_end'
+_HEADER_FIELD = 'header_field'
+_HEADER_VALUE = 'header_value'
+_HEADER_END = 'header_end'
+_HEADERS_FINISHED = 'headers_finished'
+
+# the decompressed multipart body is the chunk plus the form fields and
+# boundaries, anything larger than the max chunk with this allowance is
+# treated as a decompression bomb
+_FORM_MAX_OVERHEAD = 1024 * 1024
+# the max bytes of zstd frame header
+_ZSTD_FRAME_HEADER_MAX = 18
+
+
+class ContentDecodeError(Exception):
+    """The compressed upload body cannot be decoded."""
+
+    def __init__(self, code: EAPIResponseCode, error_msg: str):
+        super().__init__(error_msg)
+        self.code = code
+
+
+class MultipartBodyError(Exception):
+    """The multipart upload body is malformed."""
+
+
+class GzipDecoder:
+    """The streaming decoder of gzip body."""
+
+    errors = (zlib.error,)
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        # the output is capped so the bomb is detected before it is
+        # inflated into memory, the left input is kept as unconsumed tail
+        return self._decompressor.decompress(data, max_length)
+
+    @property
+    def eof(self) -> bool:
+        return self._decompressor.eof
+
+
+class _OutputLimitExceeded(Exception):
+    """The decompressed output exceeds the max length."""
+
+
+class _BoundedSink:
+    """The writer collects the decompressed output and stops the decompression over the max length."""
+
+    def __init__(self):
+        self.pieces, self.size, self.max_length = [], 0, 0
+
+    def reset(self, max_length: int) -> None:
+        self.pieces, self.size, self.max_length = [], 0, max_length
+
+    def write(self, data: bytes) -> int:
+        piece = bytes(data[: self.max_length - self.size])
+        self.pieces.append(piece)
+        self.size += len(piece)
+        if self.size >= self.max_length:
+            raise _OutputLimitExceeded()
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        return b''.join(self.pieces)
+
+
+class ZstdDecoder:
+    """
+    Summary:
+        The streaming decoder of zstd body. The decompressobj of zstandard
+        can not cap its output, so the body is written through a stream
+        writer into a sink which stops the decompression once the output
+        reaches the max length. The output over it is dropped since such
+        body is rejected anyway.
+    """
+
+    def __init__(self):
+        self.errors = (zstandard.ZstdError,)
+        self._sink = _BoundedSink()
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            self._sink, write_size=zstandard.DECOMPRESSION_RECOMMENDED_OUTPUT_SIZE
+        )
+        self._header = b''
+        self._content_size = None
+        self._decompressed_size = 0
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        # the content size in frame header is used to detect the truncated
+        # stream, the header might be split across the pieces
+        if self._content_size is None and len(self._header) < _ZSTD_FRAME_HEADER_MAX:
+            self._header += data[: _ZSTD_FRAME_HEADER_MAX - len(self._header)]
+            try:
+                self._content_size = zstandard.get_frame_parameters(self._header).content_size
+            except zstandard.ZstdError:
+                pass
+
+        self._sink.reset(max_length)
+        try:
+            self._writer.write(data)
+        except _OutputLimitExceeded:
+            pass
+        body = self._sink.getvalue()
+        self._decompressed_size += len(body)
+        return body
+
+    @property
+    def eof(self) -> bool:
+        # the frame without content size can not be checked here, but the
+        # truncated body still fails the parser without the closing boundary
+        if self._content_size is None or self._content_size == zstandard.CONTENTSIZE_UNKNOWN:
+            return True
+        return self._decompressed_size >= self._content_size
+
+
+def get_decoder(encoding: str):
+    """
+    Summary:
+        The function returns the streaming decoder of content encoding.
+    Parameter:
+        - encoding(str): the value of Content-Encoding header
+    Return:
+        - the decoder object
+    """
+
+    if encoding == 'gzip':
+        return GzipDecoder()
+    if encoding == 'zstd' and zstandard is not None:
+        return ZstdDecoder()
+    raise ContentDecodeError(EAPIResponseCode.unsupported_media_type, 'Content-Encoding %s is not supported' % encoding)
+
+
+async def decode_body(stream, encoding: str, get_max_size):
+    """
+    Summary:
+        The async generator decompresses the request body piece by piece
+        so the compressed chunk is never inflated as a whole. The size,
+        ratio and cpu time of decompression are recorded in metrics.
+    Parameter:
+        - stream(async generator): the compressed request body
+        - encoding(str): the value of Content-Encoding header
+        - get_max_size(callable): return the max bytes of decompressed body.
+          It is checked again after each piece is parsed, since the limit
+          is lowered once the chunk size of job is known
+    Return:
+        - the decompressed body pieces
+    """
+
+    def check_size(max_size: int) -> None:
+        if decompressed_size > max_size:
+            raise ContentDecodeError(
+                EAPIResponseCode.payload_too_large, 'Decompressed body is larger than %d bytes' % max_size
+            )
+
+    decoder = get_decoder(encoding)
+    compressed_size, decompressed_size, cpu_time = 0, 0, 0.0
+    async for data in stream:
+        # the stream ends with an empty piece, zstd refuses any input
+        # after the frame is finished
+        if not data:
+            continue
+        compressed_size += len(data)
+        max_size = get_max_size()
+        start_time = time.thread_time()
+        try:
+            body = decoder.decompress(data, max_size - decompressed_size + 1)
+        except decoder.errors as e:
+            raise ContentDecodeError(EAPIResponseCode.bad_request, 'Invalid %s body: %s' % (encoding, e))
+        cpu_time += time.thread_time() - start_time
+
+        decompressed_size += len(body)
+        check_size(max_size)
+        if body:
+            yield body
+            check_size(get_max_size())
+
+    if not decoder.eof:
+        raise ContentDecodeError(EAPIResponseCode.bad_request, 'Invalid %s body: truncated stream' % encoding)
+
+    CHUNK_COMPRESSED_BYTES.labels(encoding).inc(compressed_size)
+    CHUNK_DECOMPRESSED_BYTES.labels(encoding).inc(decompressed_size)
+    CHUNK_DECOMPRESS_CPU_SECONDS.labels(encoding).inc(cpu_time)
+    if compressed_size:
+        CHUNK_COMPRESSION_RATIO.labels(encoding).observe(decompressed_size / compressed_size)
+
+
+class ChunkMultiPartParser:
+    """
+    Summary:
+        The multipart parser of upload body. It is the same as the one of
+        starlette except the file part is written into the buffer with the
+        configured spool size and location. Starlette spools any file over
+        1MB to local disk, so each chunk is written to disk and read back
+        before it goes to object storage.
+    """
+
+    def __init__(self, headers: Headers, stream, spool_max_size: int, spool_dir: str = None, on_file=None):
+        """
+        Parameter:
+            - headers(Headers): the request headers
+            - stream(async generator): the request body
+            - spool_max_size(int): the max bytes of file kept in memory
+            - spool_dir(str): the directory of the larger file, default is
+                the system temp dir
+            - on_file(coroutine function): called with the text fields
+                parsed so far before the data of each file part is read
+        """
+        self.headers = headers
+        self.stream = stream
+        self.spool_max_size = spool_max_size
+        self.spool_dir = spool_dir or None
+        self.on_file = on_file
+
+    async def parse(self) -> FormData:
+        _, params = parse_options_header(self.headers['Content-Type'])
+        charset = params.get(b'charset', 'utf-8')
+        if isinstance(charset, bytes):
+            charset = charset.decode('latin-1')
+
+        # the callbacks only collect the events, the file is written after
+        # each piece of body since the write might go to disk
+        events = []
+        callbacks = {
+            'on_part_begin': lambda: events.append((_PART_BEGIN, b'')),
+            'on_part_data': lambda data, start, end: events.append((_PART_DATA, data[start:end])),
+            'on_part_end': lambda: events.append((_PART_END, b'')),
+            'on_header_field': lambda data, start, end: events.append((_HEADER_FIELD, data[start:end])),
+            'on_header_value': lambda data, start, end: events.append((_HEADER_VALUE, data[start:end])),
+            'on_header_end': lambda: events.append((_HEADER_END, b'')),
+            'on_headers_finished': lambda: events.append((_HEADERS_FINISHED, b'')),
+        }
+        if not params.get(b'boundary'):
+            raise MultipartBodyError('Missing boundary in multipart body')
+        parser = MultipartParser(params[b'boundary'], callbacks)
+
+        header_field, header_value = b'', b''
+        content_disposition, content_type = None, b''
+        field_name, data, file = '', b'', None
+        items, item_headers = [], []
+
+        async for body in self.stream:
+            try:
+                parser.write(body)
+            except FormParserError as e:
+                raise MultipartBodyError(str(e))
+            piece_events, events[:] = list(events), []
+            for event, event_bytes in piece_events:
+                if event == _PART_BEGIN:
+                    content_disposition, content_type, data, item_headers = None, b'', b'', []
+                elif event == _HEADER_FIELD:
+                    header_field += event_bytes
+                elif event == _HEADER_VALUE:
+                    header_value += event_bytes
+                elif event == _HEADER_END:
+                    field = header_field.lower()
+                    if field == b'content-disposition':
+                        content_disposition = header_value
+                    elif field == b'content-type':
+                        content_type = header_value
+                    item_headers.append((field, header_value))
+                    header_field, header_value = b'', b''
+                elif event == _HEADERS_FINISHED:
+                    _, options = parse_options_header(content_disposition or b'')
+                    if b'name' not in options:
+                        raise MultipartBodyError('Missing field name in multipart body')
+                    field_name = options[b'name'].decode(charset, errors='replace')
+                    file = None
+                    if b'filename' in options:
+                        if self.on_file:
+                            await self.on_file({name: value for name, value in items if isinstance(value, str)})
+                        file = UploadFile(
+                            filename=options[b'filename'].decode(charset, errors='replace'),
+                            file=tempfile.SpooledTemporaryFile(max_size=self.spool_max_size, dir=self.spool_dir),
+                            content_type=content_type.decode('latin-1'),
+                            headers=Headers(raw=item_headers),
+                        )
+                elif event == _PART_DATA:
+                    if file is None:
+                        data += event_bytes
+                    else:
+                        await file.write(event_bytes)
+                elif event == _PART_END:
+                    if file is None:
+                        items.append((field_name, data.decode(charset, errors='replace')))
+                    else:
+                        record_spool(file)
+                        await file.seek(0)
+                        items.append((field_name, file))
+
+        try:
+            parser.finalize()
+        except FormParserError as e:
+            raise MultipartBodyError(str(e))
+        return FormData(items)
+
+
+def record_spool(file: UploadFile) -> None:
+    """count the bytes of file spooled to disk, or kept in memory but spooled by starlette."""
+
+    size = file.file.tell()
+    if getattr(file.file, '_rolled', True):
+        CHUNK_SPOOLED_BYTES.inc(size)
+    elif size > UploadFile.spool_max_size:
+        CHUNK_SPOOL_AVOIDED_BYTES.inc(size)
+
+
+def is_multipart(request: Request) -> bool:
+    content_type, _ = parse_options_header(request.headers.get('Content-Type'))
+    return content_type == b'multipart/form-data'
+
+
+class ChunkIngestionRequest(Request):
+    """
+    Summary:
+        The request parses the multipart body with ChunkMultiPartParser.
+        The body compressed with gzip or zstd(Content-Encoding header) is
+        decompressed in stream before parsing, so the chunk stored in
+        object storage is the same as the original bytes.
+        The chunk bytes rate limit is charged with the declared size once
+        the project and operator are parsed, before the file is read. The
+        request without session id is rejected by the api, so it is not
+        charged.
+    """
+
+    async def form(self) -> FormData:
+        if not hasattr(self, '_form'):
+            if not is_multipart(self):
+                return await super().form()
+            stream = self.stream()
+            encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+            if encoding != 'identity':
+                stream = decode_body(stream, encoding, lambda: self.get_chunk_size() + _FORM_MAX_OVERHEAD)
+            multipart_parser = ChunkMultiPartParser(
+                self.headers,
+                stream,
+                ConfigClass.CHUNK_SPOOL_MAX_SIZE,
+                ConfigClass.CHUNK_SPOOL_DIR,
+                on_file=self.on_file,
+            )
+            form = await multipart_parser.parse()
+            # the file part might come before the fields
+            await self.charge_rate_limit({name: value for name, value in form.multi_items() if isinstance(value, str)})
+            self._form = form
+        return self._form
+
+    async def on_file(self, fields: dict) -> None:
+        """the callback before the file part is read, `fields` are the text fields parsed so far."""
+        if self.headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+            await self.limit_chunk_size(fields)
+        await self.charge_rate_limit(fields)
+
+    def get_chunk_size(self) -> int:
+        """return the max size of chunk in request, the max chunk size until the job is known."""
+        return getattr(self, '_chunk_size', ConfigClass.CHUNK_SIZE_MAX)
+
+    async def limit_chunk_size(self, fields: dict) -> None:
+        """
+        Summary:
+            The function reads the chunk size negotiated in pre upload api
+            of the job in form. The compressed body is decompressed up to
+            this size and the admission budget is resized to it, instead of
+            counting every compressed chunk as the largest one.
+        Parameter:
+            - fields(dict): the text fields of form
+        """
+
+        if hasattr(self, '_chunk_size'):
+            return
+        chunk_size = None
+        if 'resumable_identifier' in fields:
+            chunk_config = await SrvAioRedisSingleton().get_by_key('chunk_config:%s' % fields['resumable_identifier'])
+            chunk_size = serializer.loads(chunk_config).get('chunk_size') if chunk_config else None
+        self._chunk_size = min(chunk_size or ConfigClass.CHUNK_SIZE_MAX, ConfigClass.CHUNK_SIZE_MAX)
+
+        reservation = self.scope.get('chunk_reservation')
+        if reservation is not None:
+            reservation.resize(self._chunk_size)
+
+    def get_declared_size(self) -> int:
+        """return the Content-Length of request, or the max chunk size if it is not declared."""
+
+        content_length = self.headers.get('Content-Length', '').strip()
+        if content_length.isdigit():
+            return int(content_length)
+        return ConfigClass.CHUNK_SIZE_MAX
+
+    async def charge_rate_limit(self, fields: dict) -> None:
+        """
+        Summary:
+            The function charges the chunk bytes rate limit of project and
+            operator in the form once per request.
+        Parameter:
+            - fields(dict): the text fields of form
+        """
+
+        if getattr(self, '_rate_limit_charged', False) or not self.headers.get('Session-Id'):
+            return
+        if 'project_code' not in fields or 'operator' not in fields:
+            return
+        self._rate_limit_charged = True
+        await consume_rate_limit(
+            ERateLimit.CHUNK_BYTES, fields['project_code'], fields['operator'], self.get_declared_size()
+        )
+
+
+class ChunkIngestionRoute(APIRoute):
+    """The route of upload apis, the request is ChunkIngestionRequest."""
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def chunk_ingestion_route_handler(request: Request):
+            request = ChunkIngestionRequest(request.scope, request.receive)
+            # parse the body ahead so the decode error and rate limit are
+            # returned with proper code instead of the generic 400 of fastapi
+            if is_multipart(request):
+                api_response = APIResponse()
+                try:
+                    await request.form()
+                except ContentDecodeError as e:
+                    api_response.code = e.code
+                    api_response.error_msg = str(e)
+                    return api_response.json_response()
+                except RateLimitExceeded as e:
+                    api_response.code = EAPIResponseCode.too_many_requests
+                    api_response.error_msg = str(e)
+                    api_response.result = {'retry_after': e.retry_after}
+                    return api_response.json_response(headers=e.get_retry_after_header())
+                except MultipartBodyError:
+                    api_response.code = EAPIResponseCode.bad_request
+                    api_response.error_msg = 'There was an error parsing the body'
+                    return api_response.json_response()
+            return await route_handler(request)
+
+        return chunk_ingestion_route_handler
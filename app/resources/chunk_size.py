@@ -0,0 +1,164 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+
+from app.config import ConfigClass
+from app.resources.admission import chunk_admission
+
+_MB = 1024 * 1024
+
+
+class ChunkSizeExceeded(Exception):
+    pass
+
+
+class InvalidChunk(Exception):
+    pass
+
+
+def get_server_load() -> float:
+    """
+    Summary:
+        The function returns the load of current worker as the ratio
+        of chunk admission budget in use.
+    Return:
+        - (float) 0 means idle, 1 means the worker is saturated
+    """
+
+    return chunk_admission.get_utilization()
+
+
+def get_recommended_chunk_size(file_size: int = None, load: float = None) -> int:
+    """
+    Summary:
+        The function calculates the chunk size that client should use to
+        upload the file. The result is based on:
+            1. the default chunk size(2MB).
+            2. the multipart limit that one object can only have
+                MULTIPART_MAX_PARTS parts.
+            3. the server load. When the worker uses more than
+                CHUNK_SIZE_LOAD_THRESHOLD of its admission budget, the chunk
+                size will be doubled to reduce the number of requests.
+        The chunk size is always rounded up to whole MB.
+    Parameter:
+        - file_size(int): the size of file in bytes. None if client does
+            not provide it
+        - load(float): the load of worker. Default is current worker load
+    Return:
+        - (int) chunk size in bytes
+    """
+
+    if load is None:
+        load = get_server_load()
+
+    chunk_size = ConfigClass.CHUNK_SIZE_DEFAULT
+    if load >= ConfigClass.CHUNK_SIZE_LOAD_THRESHOLD:
+        chunk_size = min(chunk_size * 2, ConfigClass.CHUNK_SIZE_MAX)
+
+    if file_size:
+        min_chunk_size = math.ceil(file_size / ConfigClass.MULTIPART_MAX_PARTS)
+        if min_chunk_size > ConfigClass.CHUNK_SIZE_MAX:
+            raise ChunkSizeExceeded('File size %s exceeds the upload limit' % file_size)
+        chunk_size = max(chunk_size, min_chunk_size)
+
+    return math.ceil(chunk_size / _MB) * _MB
+
+
+def is_small_file(file_size: int = None) -> bool:
+    """
+    Summary:
+        The function checks if the file is small enough to upload in one
+        request without the multipart upload.
+    Parameter:
+        - file_size(int): the size of file in bytes. None if client does
+            not provide it, the file goes through the multipart upload
+    Return:
+        - (bool) True if the file can be uploaded in one request
+    """
+
+    return (
+        ConfigClass.SMALL_FILE_MAX_SIZE > 0 and file_size is not None and file_size <= ConfigClass.SMALL_FILE_MAX_SIZE
+    )
+
+
+def get_negotiated_chunk_size(payload: dict) -> int:
+    """
+    Summary:
+        The function returns the chunk size that client agreed to use in
+        pre upload api.
+    Parameter:
+        - payload(dict): the payload of upload job
+    Return:
+        - (int) the chunk size, None if the client does not negotiate it
+    """
+
+    return payload.get('chunk_size') if payload.get('chunk_size_negotiated') else None
+
+
+def get_expected_total_chunks(file_size: int, chunk_size: int) -> int:
+    """
+    Summary:
+        The function returns the number of chunks that file should be
+        split into with the negotiated chunk size.
+    Parameter:
+        - file_size(int): the size of file in bytes
+        - chunk_size(int): the negotiated chunk size in bytes
+    Return:
+        - (int) the number of chunks
+    """
+
+    return max(math.ceil(file_size / chunk_size), 1)
+
+
+def validate_chunk(chunk_size: int, chunk_number: int, content_size: int) -> None:
+    """
+    Summary:
+        The function checks the uploaded chunk against the chunk size
+        negotiated in pre upload api. Raise InvalidChunk if not match.
+    Parameter:
+        - chunk_size(int): the negotiated chunk size. None if not exist
+        - chunk_number(int): the part number of current chunk
+        - content_size(int): the size of received chunk in bytes
+    """
+
+    if chunk_number > ConfigClass.MULTIPART_MAX_PARTS:
+        raise InvalidChunk(
+            'Chunk number %s exceeds the limit of %s parts' % (chunk_number, ConfigClass.MULTIPART_MAX_PARTS)
+        )
+    if chunk_size and content_size > chunk_size:
+        raise InvalidChunk('Chunk size %s exceeds the negotiated chunk size %s' % (content_size, chunk_size))
+
+
+def validate_total_chunks(chunk_size: int, file_size: int, total_chunks: int) -> None:
+    """
+    Summary:
+        The function checks if the number of chunks matches the chunk size
+        negotiated in pre upload api. Raise InvalidChunk if not match.
+    Parameter:
+        - chunk_size(int): the negotiated chunk size. None if not exist
+        - file_size(int): the size of file in bytes
+        - total_chunks(int): the number of chunks reported by client
+    """
+
+    if not chunk_size:
+        return
+
+    expected_chunks = get_expected_total_chunks(file_size, chunk_size)
+    if total_chunks != expected_chunks:
+        raise InvalidChunk(
+            'Expect %s chunks with chunk size %s but received %s' % (expected_chunks, chunk_size, total_chunks)
+        )
@@ -17,9 +17,9 @@
 import enum
 from functools import wraps
 
-from common import LoggerFactory
 from fastapi import HTTPException
 
+from app.commons.logger import LoggerFactory
 from app.models.base_models import APIResponse, EAPIResponseCode
 from app.resources.decorator import HeaderMissingException
 
@@ -15,10 +15,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import httpx
-from common import LoggerFactory
 
 from app.commons.data_providers.redis import SrvAioRedisSingleton
 from app.commons.kafka_producer import get_kafka_producer
+from app.commons.logger import LoggerFactory
 from app.config import ConfigClass
 
 logger = LoggerFactory('health_check_api').get_logger()
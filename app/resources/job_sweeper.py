@@ -0,0 +1,154 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+from typing import Optional
+
+from app.commons.data_providers.redis import SrvAioRedisSingleton
+from app.commons.data_providers.redis_project_session_job import (
+    EState,
+    InvalidStateTransition,
+    encode_job_fields,
+    get_chunk_index_key,
+    get_job_key,
+    session_job_scan,
+    session_job_transition,
+)
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.resources.lock import unlock_resource
+from app.resources.metrics import JOB_SWEPT, REDIS_RECLAIMED_BYTES
+from app.resources.periodic import PeriodicWorker
+
+_logger = LoggerFactory('job_sweeper').get_logger()
+
+_ABANDONED_STATES = (EState.PRE_UPLOADED.name, EState.CHUNK_UPLOADED.name)
+
+
+class JobSweeper(PeriodicWorker):
+    """
+    Summary:
+        The background sweeper for the upload jobs which are never finished,
+        e.g. the client is closed in the middle of upload. Such job will
+        stay in PRE_UPLOADED or CHUNK_UPLOADED forever with its chunk etag
+        keys and the write lock of the file. The sweeper terminates the job
+        so the record expires, removes the chunk keys and releases the lock.
+    """
+
+    lock_key = 'upload_job_sweeper:lock'
+
+    def __init__(self, interval: int, abandoned_timeout: int):
+        super().__init__(interval)
+        self.abandoned_timeout = abandoned_timeout
+
+    async def run_once(self) -> dict:
+        return await self.sweep()
+
+    async def sweep(self, now: float = None) -> dict:
+        """
+        Summary:
+            Terminate the abandoned jobs and delete their chunk keys.
+        Parameter:
+            - now(float): the current timestamp, default is time.time()
+        Return:
+            - (dict) the number of swept jobs, deleted keys and reclaimed
+                bytes. None if other worker is sweeping in this interval
+        """
+
+        if not await self.acquire_interval_lock():
+            return None
+
+        now = now or time.time()
+        report = {'jobs': 0, 'keys': 0, 'bytes': 0}
+        async for job in session_job_scan():
+            if job['status'] not in _ABANDONED_STATES:
+                continue
+            chunk_keys = await self._get_abandoned_chunk_keys(job, now)
+            if chunk_keys is not None:
+                swept = await self._sweep_job(job, chunk_keys)
+                if swept is None:
+                    continue
+                deleted_keys, reclaimed_bytes = swept
+                report['jobs'] += 1
+                report['keys'] += deleted_keys
+                report['bytes'] += reclaimed_bytes
+
+        JOB_SWEPT.inc(report['jobs'])
+        REDIS_RECLAIMED_BYTES.inc(report['bytes'])
+        _logger.info(
+            'Swept %(jobs)s abandoned jobs, deleted %(keys)s chunk keys and reclaimed %(bytes)s bytes' % report
+        )
+        return report
+
+    async def _get_abandoned_chunk_keys(self, job: dict, now: float) -> Optional[list]:
+        """
+        Summary:
+            The job is abandoned if neither the job nor its chunks have
+            been updated in time. The chunk upload does not touch the job
+            record, so the last chunk activity is read from the chunk index
+            of job, which scores each chunk key with its upload time.
+        Parameter:
+            - job(dict): the job record
+            - now(float): the current timestamp
+        Return:
+            - (list) the chunk keys of abandoned job, None if it is active
+        """
+
+        if now - int(job['update_timestamp']) < self.abandoned_timeout:
+            return None
+
+        chunk_index = await SrvAioRedisSingleton().zrange_with_scores_by_key(get_chunk_index_key(job['job_id']))
+        if chunk_index and now - max(score for _, score in chunk_index) < self.abandoned_timeout:
+            return None
+        return [key for key, _ in chunk_index]
+
+    async def _sweep_job(self, job: dict, chunk_keys: list) -> tuple:
+        """terminate the job, delete the chunk keys and unlock the file. None if the job is updated meanwhile."""
+
+        job_id = job['job_id']
+        payload = job.get('payload') or {}
+        payload['error_msg'] = 'The job is abandoned without update in %s seconds' % self.abandoned_timeout
+        fields = encode_job_fields({'payload': payload, 'update_timestamp': str(round(time.time()))})
+        job_key = get_job_key(
+            job['session_id'], job_id, job['action'], job['project_code'], job['operator'], job['source']
+        )
+        try:
+            # the job is only terminated if it is still in the scanned state
+            await session_job_transition(
+                job['session_id'], job_id, job_key, EState.TERMINATED.name, fields, [job['status']]
+            )
+        except InvalidStateTransition as e:
+            _logger.info('Skip the job updated during the sweep: %s', str(e))
+            return None
+        _logger.info('Abandoned job %s is terminated', job_id)
+
+        srv_redis = SrvAioRedisSingleton()
+        chunk_keys = chunk_keys + ['chunk_config:%s' % job_id, get_chunk_index_key(job_id)]
+
+        reclaimed_bytes = sum(size or 0 for size in await srv_redis.memory_usage_by_keys(chunk_keys))
+        deleted_keys = await srv_redis.delete_by_keys(chunk_keys)
+
+        bucket = ('gr-' if ConfigClass.namespace == 'greenroom' else 'core-') + job['project_code']
+        try:
+            await unlock_resource(os.path.join(bucket, job['source']), 'write')
+        except Exception as e:
+            _logger.warning('Fail to unlock the file of abandoned job %s: %s', job_id, str(e))
+
+        return deleted_keys, reclaimed_bytes
+
+
+job_sweeper = JobSweeper(ConfigClass.JOB_SWEEP_INTERVAL, ConfigClass.JOB_ABANDONED_TIMEOUT)
@@ -17,6 +17,7 @@
 import httpx
 
 from app.config import ConfigClass
+from app.resources.metrics import observe_stage
 
 
 class ResourceAlreadyInUsed(Exception):
@@ -26,8 +27,9 @@ class ResourceAlreadyInUsed(Exception):
 async def data_ops_request(resource_key: str, operation: str, method: str) -> dict:
     url = ConfigClass.DATAOPS_SERVICE_V2 + 'resource/lock/'
     post_json = {'resource_key': resource_key, 'operation': operation}
-    async with httpx.AsyncClient() as client:
-        response = await client.request(url=url, method=method, json=post_json, timeout=3600)
+    with observe_stage('lock' if method == 'POST' else 'unlock', attributes={'upload.lock_key': resource_key}):
+        async with httpx.AsyncClient() as client:
+            response = await client.request(url=url, method=method, json=post_json, timeout=3600)
     if response.status_code != 200:
         raise ResourceAlreadyInUsed('resource %s already in used' % resource_key)
 
@@ -49,8 +51,9 @@ def bulk_lock_operation(resource_key: list, operation: str, lock=True) -> dict:
     # operation can be either read or write
     url = ConfigClass.DATAOPS_SERVICE_V2 + 'resource/lock/bulk'
     post_json = {'resource_keys': resource_key, 'operation': operation}
-    with httpx.Client() as client:
-        response = client.request(method, url, json=post_json, timeout=3600)
+    with observe_stage('bulk_lock' if lock else 'bulk_unlock', attributes={'upload.lock_keys': len(resource_key)}):
+        with httpx.Client() as client:
+            response = client.request(method, url, json=post_json, timeout=3600)
     if response.status_code != 200:
         raise ResourceAlreadyInUsed('resource %s already in used' % resource_key)
 
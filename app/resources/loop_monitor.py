@@ -0,0 +1,114 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.resources.metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+
+_logger = LoggerFactory('loop_monitor').get_logger()
+
+
+class LoopMonitor:
+    """
+    Summary:
+        The monitor of event loop lag. A task sleeps for the interval and
+        records how late it wakes up as the loop lag. A watchdog thread
+        checks the heartbeat of the task, when the loop is blocked longer
+        than the threshold, e.g. a sync http call or file operation in a
+        coroutine, it logs the stack of the loop thread while the blocking
+        call is still running. The cost is one wake up of the task and the
+        thread in each interval, so it is left on in production. Unlike the
+        asyncio debug mode, it does not slow down every callback.
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        """
+        Parameter:
+            - interval(float): the seconds between the lag samples
+            - threshold(float): the seconds the loop is blocked before the
+                stack is logged
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+        self._heartbeat = time.monotonic()
+
+    def start(self) -> None:
+        """start the sampler in the event loop and the watchdog thread."""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self.sample_forever())
+        self._watchdog = threading.Thread(target=self.watch, name='loop_monitor', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        """stop the sampler and the watchdog thread."""
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._watchdog.join()
+        self._task, self._watchdog = None, None
+
+    async def sample_forever(self) -> None:
+        """record the lag of loop every interval until cancelled."""
+
+        while True:
+            expected_time = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            EVENT_LOOP_LAG.observe(max(self._heartbeat - expected_time, 0))
+
+    def watch(self) -> None:
+        """log the stack of loop thread once for each time the loop is blocked over the threshold."""
+
+        reported_heartbeat = None
+        check_interval = min(self.interval, self.threshold) / 2
+        while not self._stop.wait(check_interval):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            EVENT_LOOP_BLOCKED.inc()
+            _logger.warning(
+                'Event loop is blocked for more than %.3f seconds at:\n%s',
+                blocked,
+                ''.join(traceback.format_stack(frame)),
+            )
+
+
+loop_monitor = LoopMonitor(ConfigClass.LOOP_MONITOR_INTERVAL / 1000, ConfigClass.LOOP_MONITOR_THRESHOLD / 1000)
@@ -0,0 +1,156 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+
+import httpx
+
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.resources.metrics import METADATA_BATCH_SIZE, observe_stage
+
+_logger = LoggerFactory('metadata_batcher').get_logger()
+
+
+class MetadataBatchError(Exception):
+    pass
+
+
+class MetadataItemBatcher:
+    """
+    Summary:
+        The micro batcher of the metadata item creation. The items from the
+        concurrent finalizers are gathered for a short window or until the
+        batch is full, then sent in one request to the batch api of the
+        metadata service. Each caller gets its own created item or error,
+        if the batch request fails, its items without a confirmed id are
+        retried one by one so the bad item does not fail the others.
+    """
+
+    def __init__(self, url: str, window: float, max_size: int):
+        """
+        Parameter:
+            - url(str): the batch api of metadata service
+            - window(float): the seconds to wait for more items
+            - max_size(int): the max number of items in one batch
+        """
+        self.url = url
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+
+    async def create(self, item: dict) -> dict:
+        """
+        Summary:
+            create the item with the others in the same window.
+        Parameter:
+            - item(dict): the metadata item
+        Return:
+            - (dict) the created item
+        """
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self) -> None:
+        """send the pending items now."""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: list) -> None:
+        created_items, error = {}, None
+        try:
+            METADATA_BATCH_SIZE.observe(len(batch))
+            with observe_stage('metadata_batch_create'):
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(self.url, json={'items': [item for item, _ in batch]}, timeout=3600)
+            created_items = get_created_items(response)
+            if response.status_code != 200:
+                raise MetadataBatchError('Fail to create metadata in batch: %s' % response.text)
+            if len(created_items) != len(batch):
+                raise MetadataBatchError('Expect %s created items but received %s' % (len(batch), len(created_items)))
+        except Exception as e:
+            error = e
+
+        # only the items without a confirmed id are retried, the created
+        # ones would be duplicated otherwise
+        failed = []
+        for item, future in batch:
+            created_item = created_items.get(item['id'])
+            if created_item is None:
+                failed.append((item, future))
+            else:
+                set_future_result(future, created_item)
+        if not failed:
+            return
+
+        if len(batch) > 1:
+            _logger.warning(
+                'Fail to create %s of %s items in batch, retry one by one: %s', len(failed), len(batch), error
+            )
+            await asyncio.gather(*(self._send([entry]) for entry in failed))
+            return
+        for _, future in failed:
+            set_future_result(future, error or MetadataBatchError('Item is not created in batch'))
+
+
+def get_created_items(response: httpx.Response) -> dict:
+    """get the created items in the response of batch api by the item id."""
+
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    result = body.get('result') if isinstance(body, dict) else None
+    if not isinstance(result, list):
+        return {}
+    return {
+        created_item['id']: created_item
+        for created_item in result
+        if isinstance(created_item, dict) and 'id' in created_item
+    }
+
+
+def set_future_result(future: asyncio.Future, created_item) -> None:
+    """resolve the caller with the created item or the error."""
+
+    # the caller might be cancelled in the middle
+    if future.done():
+        return
+    if isinstance(created_item, Exception):
+        future.set_exception(created_item)
+    else:
+        future.set_result(created_item)
+
+
+metadata_batcher = MetadataItemBatcher(
+    ConfigClass.METADATA_SERVICE + 'items/batch/',
+    ConfigClass.METADATA_BATCH_WINDOW / 1000,
+    ConfigClass.METADATA_BATCH_MAX_SIZE,
+)
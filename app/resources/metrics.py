@@ -0,0 +1,142 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from app.resources.tracing import start_span
+
+# the finalize stages like combine can take minutes for large file
+_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_DURATION = Histogram(
+    'upload_stage_duration_seconds',
+    'Duration of each upload stage',
+    ['stage', 'outcome'],
+    buckets=_STAGE_BUCKETS,
+)
+CHUNK_INFLIGHT_BYTES = Gauge(
+    'upload_chunk_inflight_bytes', 'Bytes of chunk requests in flight', multiprocess_mode='livesum'
+)
+CHUNK_INFLIGHT_REQUESTS = Gauge(
+    'upload_chunk_inflight_requests', 'Number of chunk requests in flight', multiprocess_mode='livesum'
+)
+CHUNK_REJECTED = Counter('upload_chunk_rejected', 'Chunk requests rejected by admission control')
+CHUNK_SPOOL_AVOIDED_BYTES = Counter(
+    'upload_chunk_spool_avoided_bytes', 'Bytes of uploaded files kept in memory that starlette spools to disk'
+)
+CHUNK_SPOOLED_BYTES = Counter('upload_chunk_spooled_bytes', 'Bytes of uploaded files spooled to disk')
+CHUNK_COMPRESSED_BYTES = Counter(
+    'upload_chunk_compressed_bytes', 'Bytes of compressed upload body received', ['encoding']
+)
+CHUNK_DECOMPRESSED_BYTES = Counter(
+    'upload_chunk_decompressed_bytes', 'Bytes of upload body after decompression', ['encoding']
+)
+CHUNK_COMPRESSION_RATIO = Histogram(
+    'upload_chunk_compression_ratio',
+    'Ratio of decompressed to compressed size of each upload body',
+    ['encoding'],
+    buckets=(1, 1.1, 1.25, 1.5, 2, 3, 5, 10, 20, 50),
+)
+CHUNK_DECOMPRESS_CPU_SECONDS = Counter(
+    'upload_chunk_decompress_cpu_seconds', 'CPU time spent on decompressing upload body', ['encoding']
+)
+RATE_LIMIT_THROTTLED = Counter('upload_rate_limit_throttled', 'Requests throttled by rate limit', ['limit'])
+JOB_SWEPT = Counter('upload_job_swept', 'Abandoned jobs terminated by the sweeper')
+REDIS_RECLAIMED_BYTES = Counter('upload_redis_reclaimed_bytes', 'Redis memory reclaimed by the sweeper')
+MULTIPART_STALE = Gauge(
+    'upload_multipart_stale', 'Stale multipart uploads found by the last reaper run', multiprocess_mode='liveall'
+)
+MULTIPART_REAPED = Counter('upload_multipart_reaped', 'Stale multipart uploads aborted by the reaper')
+MULTIPART_REAP_FAILED = Counter('upload_multipart_reap_failed', 'Stale multipart uploads fail to abort')
+EVENT_LOOP_LAG = Histogram(
+    'upload_event_loop_lag_seconds',
+    'Delay of the event loop to wake up a sleeping task',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+EVENT_LOOP_BLOCKED = Counter('upload_event_loop_blocked', 'Times the event loop is blocked over the threshold')
+LOG_RECORDS_SUPPRESSED = Counter(
+    'upload_log_records_suppressed', 'Log records suppressed by the sampling filter', ['logger']
+)
+LOG_RECORDS_DROPPED = Counter('upload_log_records_dropped', 'Log records dropped since the log queue is full')
+METADATA_BATCH_SIZE = Histogram(
+    'upload_metadata_batch_size',
+    'Number of file items in each metadata batch request',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+
+@contextmanager
+def observe_stage(stage: str, durations: dict = None, attributes: dict = None):
+    """
+    Summary:
+        The context manager records the duration of the stage in histogram
+        with the outcome label. The outcome is `error` if any exception
+        raised inside the block, otherwise `success`. The stage is also
+        traced as the span `upload.<stage>`.
+    Parameter:
+        - stage(str): the name of stage
+        - durations(dict): optional, if provided the duration in milliseconds
+            will also be saved into it with stage as key. It is used to
+            keep the stage timing in the job record
+        - attributes(dict): optional, the attributes of span, e.g. project
+            and bytes
+    """
+
+    start_time = time.perf_counter()
+    outcome = 'success'
+    try:
+        with start_span('upload.%s' % stage, attributes):
+            yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - start_time
+        STAGE_DURATION.labels(stage=stage, outcome=outcome).observe(duration)
+        if durations is not None:
+            durations[stage] = round(duration * 1000)
+
+
+def generate_metrics() -> bytes:
+    """
+    Summary:
+        The function collects the metrics in prometheus text format. When
+        running with multiple gunicorn workers, the PROMETHEUS_MULTIPROC_DIR
+        must be set so the metrics of ALL workers are aggregated from the
+        shared directory instead of the worker receiving the request.
+    Return:
+        - (bytes) the metrics
+    """
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry)
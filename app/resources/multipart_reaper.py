@@ -0,0 +1,172 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from datetime import datetime, timezone
+
+from common.object_storage_adaptor.boto3_client import get_boto3_client
+
+from app.commons.data_providers.redis_project_session_job import (
+    EState,
+    session_job_scan,
+)
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.resources.lock import unlock_resource
+from app.resources.metrics import (
+    MULTIPART_REAP_FAILED,
+    MULTIPART_REAPED,
+    MULTIPART_STALE,
+)
+from app.resources.object_storage import get_s3_client
+from app.resources.periodic import PeriodicWorker
+
+_logger = LoggerFactory('multipart_reaper').get_logger()
+
+_RUNNING_STATES = (EState.INIT.name, EState.PRE_UPLOADED.name, EState.CHUNK_UPLOADED.name)
+
+
+class MultipartUploadReaper(PeriodicWorker):
+    """
+    Summary:
+        The reaper aborts the multipart uploads left in object storage.
+        Each pre upload starts a multipart upload, if the client never
+        finalizes or the finalize is terminated, the uploaded parts stay
+        in the bucket forever. The in-progress multipart uploads of the
+        buckets in current namespace are compared with the jobs in redis,
+        the upload of a finished job older than max age is aborted. The
+        job record expires some time after the job is finished, so the
+        upload without job record is only aborted once it is older than
+        both max age and the record ttl. The write lock of the file is
+        released as well unless another running job is uploading the same
+        file.
+    """
+
+    lock_key = 'upload_multipart_reaper:lock'
+
+    def __init__(self, interval: int, max_age: int, dry_run: bool = False):
+        super().__init__(interval)
+        self.max_age = max_age
+        self.dry_run = dry_run
+
+    async def run_once(self) -> dict:
+        if not await self.acquire_interval_lock():
+            return None
+        return await self.reap(self.dry_run)
+
+    async def reap(self, dry_run: bool = None) -> dict:
+        """
+        Summary:
+            Abort the stale multipart uploads.
+        Parameter:
+            - dry_run(bool): only report the stale uploads without abort,
+                default is the dry run setting of reaper
+        Return:
+            - (dict) the number of checked, stale and aborted uploads with
+                the detail of each stale upload
+        """
+
+        dry_run = self.dry_run if dry_run is None else dry_run
+        bucket_prefix = 'gr-' if ConfigClass.namespace == 'greenroom' else 'core-'
+        job_status, running_files = {}, set()
+        async for job in session_job_scan():
+            job_status[job['job_id']] = job['status']
+            if job['status'] in _RUNNING_STATES:
+                running_files.add(os.path.join(bucket_prefix + job['project_code'], job['source']))
+        report = {
+            'dry_run': dry_run,
+            'checked': 0,
+            'unknown': 0,
+            'stale': 0,
+            'aborted': 0,
+            'failed': 0,
+            'uploads': [],
+        }
+
+        boto3_client = await get_boto3_client(
+            ConfigClass.S3_INTERNAL,
+            access_key=ConfigClass.S3_ACCESS_KEY,
+            secret_key=ConfigClass.S3_SECRET_KEY,
+            https=ConfigClass.S3_INTERNAL_HTTPS,
+        )
+        now = datetime.now(timezone.utc)
+
+        async with get_s3_client(boto3_client) as s3:
+            buckets = (await s3.list_buckets()).get('Buckets', [])
+            for bucket in [x['Name'] for x in buckets if x['Name'].startswith(bucket_prefix)]:
+                async for upload in self._list_multipart_uploads(s3, bucket):
+                    report['checked'] += 1
+                    status = job_status.get(upload['UploadId'])
+                    age = (now - upload['Initiated']).total_seconds()
+                    if status is None:
+                        # the record of running job never expires, so the
+                        # job of upload older than record ttl is finished
+                        report['unknown'] += 1
+                        if age < max(self.max_age, ConfigClass.JOB_RECORD_TTL):
+                            continue
+                    elif age < self.max_age or status in _RUNNING_STATES:
+                        continue
+
+                    report['stale'] += 1
+                    report['uploads'].append(
+                        {'bucket': bucket, 'key': upload['Key'], 'upload_id': upload['UploadId'], 'job_status': status}
+                    )
+                    if dry_run:
+                        continue
+
+                    try:
+                        await s3.abort_multipart_upload(Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+                        report['aborted'] += 1
+                    except Exception as e:
+                        report['failed'] += 1
+                        _logger.error('Fail to abort multipart upload %s: %s', upload['UploadId'], str(e))
+                        continue
+
+                    # the lock might be left by the terminated job, but
+                    # it belongs to the new upload of the same file if any
+                    lock_key = os.path.join(bucket, upload['Key'])
+                    if lock_key not in running_files:
+                        try:
+                            await unlock_resource(lock_key, 'write')
+                        except Exception as e:
+                            _logger.warning('Fail to unlock %s: %s', lock_key, str(e))
+
+        MULTIPART_STALE.set(report['stale'])
+        MULTIPART_REAPED.inc(report['aborted'])
+        MULTIPART_REAP_FAILED.inc(report['failed'])
+        _logger.info(
+            'Checked %(checked)s multipart uploads, %(unknown)s without job, %(stale)s are stale and %(aborted)s '
+            'aborted(dry run: %(dry_run)s)' % report
+        )
+        return report
+
+    async def _list_multipart_uploads(self, s3, bucket: str):
+        """walk through the pages of in-progress multipart uploads of bucket."""
+
+        params = {'Bucket': bucket}
+        while True:
+            page = await s3.list_multipart_uploads(**params)
+            for upload in page.get('Uploads', []):
+                yield upload
+            if not page.get('IsTruncated'):
+                return
+            params['KeyMarker'] = page.get('NextKeyMarker')
+            params['UploadIdMarker'] = page.get('NextUploadIdMarker')
+
+
+multipart_reaper = MultipartUploadReaper(
+    ConfigClass.MULTIPART_REAPER_INTERVAL, ConfigClass.MULTIPART_UPLOAD_MAX_AGE, ConfigClass.MULTIPART_REAPER_DRY_RUN
+)
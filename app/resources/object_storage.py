@@ -0,0 +1,42 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import aioboto3
+from botocore.client import Config
+from common.object_storage_adaptor.boto3_client import Boto3Client
+
+_SIGNATURE_VERSION = 's3v4'
+
+
+def get_s3_client(boto3_client: Boto3Client):
+    """
+    Summary:
+        The function opens the s3 client with the endpoint and credentials
+        of Boto3Client for the operations it does not provide, e.g. listing
+        the multipart uploads. Use it as `async with get_s3_client(...)`.
+    Parameter:
+        - boto3_client(Boto3Client): the initialized object storage client
+    Return:
+        - the async context manager of aioboto3 s3 client
+    """
+
+    session = aioboto3.Session(
+        aws_access_key_id=boto3_client.access_key,
+        aws_secret_access_key=boto3_client.secret_key,
+        aws_session_token=boto3_client.session_token,
+    )
+    return session.client('s3', endpoint_url=boto3_client.endpoint, config=Config(signature_version=_SIGNATURE_VERSION))
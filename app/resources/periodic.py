@@ -0,0 +1,73 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import asyncio
+import os
+
+from app.commons.data_providers.redis import SrvAioRedisSingleton
+from app.commons.logger import LoggerFactory
+
+_logger = LoggerFactory('periodic_worker').get_logger()
+
+
+class PeriodicWorker(abc.ABC):
+    """
+    Summary:
+        The base of the maintenance work which runs every interval in the
+        background of event loop. Every gunicorn worker starts it, but only
+        the one holding the redis lock of `lock_key` runs in each interval.
+    """
+
+    lock_key = None
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._task = None
+
+    def start(self) -> None:
+        """start running in the background of the event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        """cancel the background running."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_forever(self) -> None:
+        """run every interval until cancelled."""
+
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                _logger.error('Fail to run %s: %s', self.__class__.__name__, str(e))
+
+    async def acquire_interval_lock(self) -> bool:
+        """hold the lock until the end of interval, False if other worker has it."""
+        srv_redis = SrvAioRedisSingleton()
+        return bool(await srv_redis.set_if_not_exist(self.lock_key, os.getpid(), self.interval))
+
+    @abc.abstractmethod
+    async def run_once(self):
+        """the work of each interval."""
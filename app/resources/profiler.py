@@ -0,0 +1,218 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from enum import Enum
+
+from starlette.concurrency import run_in_threadpool
+
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+
+_logger = LoggerFactory('profiler').get_logger()
+
+
+class EProfileMode(str, Enum):
+    CPU = 'cpu'
+    MEMORY = 'memory'
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def get_frame_label(frame) -> str:
+    """the label of frame in the folded stack, the function with its file and first line."""
+
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.relpath(code.co_filename), code.co_firstlineno)
+
+
+def get_thread_stack(frame) -> list:
+    """the frame labels of thread stack from the root to the given frame."""
+
+    labels = []
+    while frame is not None:
+        labels.append(get_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def get_task_stack(task: asyncio.Task) -> list:
+    """
+    Summary:
+        The frame labels of the task from its coroutine to where it awaits.
+        Task.get_stack only returns the top frame of coroutine, so the
+        chain of awaited coroutines is followed instead.
+    """
+
+    labels = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        labels.append(get_frame_label(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return labels
+
+
+def format_folded_stacks(stacks: Counter) -> list:
+    """format the stacks as `frame;frame;frame count`, the input of flamegraph.pl and speedscope."""
+
+    return ['%s %d' % (';'.join(stack), count) for stack, count in stacks.most_common()]
+
+
+class Profiler:
+    """
+    Summary:
+        The on demand profiler of the worker receiving the request. The cpu
+        profile samples the stack of every thread from a separate thread,
+        and the stack of every asyncio task from the event loop, so both
+        where the cpu is burnt and where the requests are waiting show up.
+        The memory profile diffs two tracemalloc snapshots. Nothing runs and
+        tracemalloc is off unless a profile is in progress. Only one profile
+        runs at a time, since each gunicorn worker runs one event loop, the
+        flag does not need any lock.
+    """
+
+    def __init__(self, max_seconds: int):
+        self.max_seconds = max_seconds
+        self.running = False
+
+    async def profile(self, mode: EProfileMode, seconds: float, interval: float, limit: int) -> dict:
+        """
+        Summary:
+            Run the profile of the mode for the seconds.
+        Parameter:
+            - mode(EProfileMode): cpu or memory
+            - seconds(float): how long to profile
+            - interval(float): the seconds between the cpu samples
+            - limit(int): the max number of memory growth locations
+        Return:
+            - (dict) the profile result
+        """
+
+        if self.running:
+            raise ProfilerBusy('Another profile is running on worker %s' % os.getpid())
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError('The seconds must be in (0, %s]' % self.max_seconds)
+
+        self.running = True
+        _logger.info('Start %s profile for %s seconds', mode.value, seconds)
+        try:
+            if mode == EProfileMode.CPU:
+                result = await self.profile_cpu(seconds, interval)
+            else:
+                result = await self.profile_memory(seconds, limit)
+        finally:
+            self.running = False
+
+        result.update({'pid': os.getpid(), 'mode': mode.value, 'seconds': seconds})
+        return result
+
+    async def profile_cpu(self, seconds: float, interval: float) -> dict:
+        thread_stacks, task_stacks = Counter(), Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample_threads, args=(stop, interval, thread_stacks), name='profiler', daemon=True
+        )
+        sampler.start()
+        samples = 0
+        current_task = asyncio.current_task()
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for task in asyncio.all_tasks():
+                    if task is not current_task:
+                        task_stacks[('task',) + tuple(get_task_stack(task))] += 1
+                samples += 1
+                await asyncio.sleep(interval)
+        finally:
+            stop.set()
+            await run_in_threadpool(sampler.join)
+
+        return {
+            'samples': samples,
+            'thread_stacks': format_folded_stacks(thread_stacks),
+            'task_stacks': format_folded_stacks(task_stacks),
+        }
+
+    @staticmethod
+    def _sample_threads(stop: threading.Event, interval: float, stacks: Counter) -> None:
+        sampler_id = threading.get_ident()
+        while not stop.wait(interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != sampler_id:
+                    thread_name = 'thread:%s' % thread_names.get(thread_id, thread_id)
+                    stacks[(thread_name,) + tuple(get_thread_stack(frame))] += 1
+
+    async def profile_memory(self, seconds: float, limit: int) -> dict:
+        # the allocations before tracemalloc starts are not traced, so the
+        # diff only shows what grows during the profile
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        # the snapshots of a big heap take a while, they are taken and
+        # compared in the thread pool to keep the event loop responsive
+        try:
+            before = await run_in_threadpool(self._take_snapshot)
+            await asyncio.sleep(seconds)
+            after = await run_in_threadpool(self._take_snapshot)
+            traced_size, traced_peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+        stats = await run_in_threadpool(after.compare_to, before, 'lineno')
+        growth = [
+            {
+                'location': '%s:%d' % (os.path.relpath(stat.traceback[0].filename), stat.traceback[0].lineno),
+                'size_diff': stat.size_diff,
+                'size': stat.size,
+                'count_diff': stat.count_diff,
+                'count': stat.count,
+            }
+            for stat in stats[:limit]
+        ]
+        return {
+            'size_diff': sum(stat.size_diff for stat in stats),
+            'traced_size': traced_size,
+            'traced_peak': traced_peak,
+            'growth': growth,
+        }
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                tracemalloc.Filter(False, '<unknown>'),
+            )
+        )
+
+
+profiler = Profiler(ConfigClass.PROFILING_MAX_SECONDS)
@@ -0,0 +1,162 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from enum import Enum
+
+from app.commons.data_providers.redis import SrvAioRedisSingleton
+from app.commons.logger import LoggerFactory
+from app.config import ConfigClass
+from app.resources.metrics import RATE_LIMIT_THROTTLED
+
+_logger = LoggerFactory('rate_limit').get_logger()
+
+THROTTLED_COUNTER_KEY = 'upload_rate_limit:throttled'
+
+# The script checks all buckets first and only consumes the tokens when
+# every bucket has enough of them. Each bucket is a hash with the number
+# of tokens and the timestamp of last refill.
+#   KEYS: the bucket keys
+#   ARGV: rate_1, capacity_1, rate_2, capacity_2, ..., cost
+# Return:
+#   {1, '0'} if allowed, otherwise {0, '<seconds to wait>'}
+_TOKEN_BUCKET_SCRIPT = '''
+local cost = tonumber(ARGV[#ARGV])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'timestamp')
+    local available = tonumber(bucket[1]) or capacity
+    local timestamp = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(0, now - timestamp) * rate)
+    local required = math.min(cost, capacity)
+    if available < required then
+        retry_after = math.max(retry_after, (required - available) / rate)
+    end
+    tokens[i] = {available, required, math.ceil(capacity / rate) + 1}
+end
+for i, key in ipairs(KEYS) do
+    local available = tokens[i][1]
+    if retry_after == 0 then
+        available = available - tokens[i][2]
+    end
+    redis.call('HSET', key, 'tokens', tostring(available), 'timestamp', tostring(now))
+    redis.call('EXPIRE', key, tokens[i][3])
+end
+if retry_after > 0 then
+    return {0, tostring(retry_after)}
+end
+return {1, '0'}
+'''
+
+_token_bucket_script = None
+
+
+class ERateLimit(Enum):
+    """Resources protected by rate limit."""
+
+    CHUNK_BYTES = 'chunk_bytes'
+    PRE_UPLOAD_FILES = 'pre_upload_files'
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def get_retry_after_header(self) -> dict:
+        """return the `Retry-After` header in whole seconds."""
+        return {'Retry-After': str(max(math.ceil(self.retry_after), 1))}
+
+
+def get_rate_limits(limit: ERateLimit, project_code: str) -> dict:
+    """
+    Summary:
+        The function returns the per second rate of project bucket and user
+        bucket. The project specific value in RATE_LIMIT_PROJECT_OVERRIDES
+        will replace the default one. For example:
+            {"project_a": {"chunk_bytes": 10485760, "user_chunk_bytes": 5242880}}
+    Parameter:
+        - limit(ERateLimit): the resource to be limited
+        - project_code(string): the unique code of project
+    Return:
+        - (dict) {'project': <rate>, 'user': <rate>}
+    """
+
+    defaults = {
+        ERateLimit.CHUNK_BYTES: (
+            ConfigClass.RATE_LIMIT_PROJECT_CHUNK_BYTES,
+            ConfigClass.RATE_LIMIT_USER_CHUNK_BYTES,
+        ),
+        ERateLimit.PRE_UPLOAD_FILES: (
+            ConfigClass.RATE_LIMIT_PROJECT_PRE_UPLOAD_FILES,
+            ConfigClass.RATE_LIMIT_USER_PRE_UPLOAD_FILES,
+        ),
+    }
+    project_rate, user_rate = defaults[limit]
+    overrides = ConfigClass.RATE_LIMIT_PROJECT_OVERRIDES.get(project_code, {})
+
+    return {
+        'project': overrides.get(limit.value, project_rate),
+        'user': overrides.get('user_' + limit.value, user_rate),
+    }
+
+
+async def consume_rate_limit(limit: ERateLimit, project_code: str, operator: str, cost: int) -> None:
+    """
+    Summary:
+        The function takes `cost` tokens from both project bucket and user
+        bucket in redis. The buckets are shared by all workers. Raise the
+        RateLimitExceeded if either bucket does not have enough tokens, and
+        increase the throttled counter in redis.
+    Parameter:
+        - limit(ERateLimit): the resource to be limited
+        - project_code(string): the unique code of project
+        - operator(string): the name of operator
+        - cost(int): the number of tokens for this request
+    """
+
+    global _token_bucket_script
+
+    if not ConfigClass.RATE_LIMIT_ENABLED:
+        return
+
+    rates = get_rate_limits(limit, project_code)
+    keys = [
+        'upload_rate_limit:%s:project:%s' % (limit.value, project_code),
+        'upload_rate_limit:%s:user:%s:%s' % (limit.value, project_code, operator),
+    ]
+    args = []
+    for scope in ('project', 'user'):
+        args += [rates[scope], rates[scope] * ConfigClass.RATE_LIMIT_BURST_SECONDS]
+    args.append(cost)
+
+    redis_srv = SrvAioRedisSingleton()
+    if _token_bucket_script is None:
+        _token_bucket_script = redis_srv.register_script(_TOKEN_BUCKET_SCRIPT)
+    allowed, retry_after = await _token_bucket_script(keys=keys, args=args)
+
+    if not allowed:
+        await redis_srv.hincrby(THROTTLED_COUNTER_KEY, '%s:%s' % (limit.value, project_code))
+        RATE_LIMIT_THROTTLED.labels(limit=limit.value).inc()
+        _logger.warning('Throttle %s of project %s by user %s', limit.value, project_code, operator)
+        raise RateLimitExceeded(
+            'Too many %s for project %s, please retry later' % (limit.value, project_code), float(retry_after)
+        )
@@ -0,0 +1,110 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import time
+
+from app.resources.metrics import observe_stage
+
+
+class StageGraph:
+    """
+    Summary:
+        The async stages with their dependencies. Each stage starts as soon
+        as all of its dependencies are done, so the independent stages run
+        concurrently. The result of each stage is kept in `results` for
+        the stages depending on it.
+    """
+
+    def __init__(self, durations: dict = None):
+        """
+        Parameter:
+            - durations(dict): optional, the duration of each stage in
+                milliseconds will be saved into it
+        """
+        self.durations = durations
+        self.results = {}
+        self._stages = {}
+        self._finished_at = {}
+
+    def add(self, name: str, func, depends_on: tuple = ()) -> None:
+        """
+        Summary:
+            add the stage, its dependencies must be added before it.
+        Parameter:
+            - name(str): the name of stage
+            - func(coroutine function): the stage without argument
+            - depends_on(tuple): the names of the stages to wait for
+        """
+
+        for dependency in depends_on:
+            if dependency not in self._stages:
+                raise ValueError('Unknown dependency %s of stage %s' % (dependency, name))
+        self._stages[name] = (func, tuple(depends_on))
+
+    async def _run_stage(self, name: str, tasks: dict) -> None:
+        func, depends_on = self._stages[name]
+        await asyncio.gather(*(tasks[dependency] for dependency in depends_on))
+        with observe_stage(name, self.durations):
+            self.results[name] = await func()
+        self._finished_at[name] = time.perf_counter()
+
+    async def run(self) -> dict:
+        """
+        Summary:
+            run all the stages. If any stage fails, the running stages are
+            cancelled and the error is raised.
+        Return:
+            - (dict) the result of each stage
+        """
+
+        tasks = {}
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+        return self.results
+
+    def critical_path(self) -> list:
+        """
+        Summary:
+            the chain of stages that decides the wall clock time. It starts
+            from the last finished stage and follows the dependency which
+            finished last.
+        Return:
+            - (list) the stage names in order of execution
+        """
+
+        if not self._finished_at:
+            return []
+
+        name = max(self._finished_at, key=self._finished_at.get)
+        path = [name]
+        depends_on = self._stages[name][1]
+        while depends_on:
+            name = max(depends_on, key=self._finished_at.get)
+            path.append(name)
+            depends_on = self._stages[name][1]
+
+        return path[::-1]
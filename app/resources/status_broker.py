@@ -0,0 +1,155 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from typing import Optional
+
+from app.commons.data_providers.redis import SrvAioRedisSingleton
+from app.commons.logger import LoggerFactory
+
+_logger = LoggerFactory('status_broker').get_logger()
+
+# the messages kept for a waiter that does not read them in time, e.g. a
+# stalled event stream. The newer messages are dropped once it is full
+_QUEUE_MAX_SIZE = 1024
+
+
+class StatusSubscription:
+    """The in-process subscription of one waiter to a status channel."""
+
+    def __init__(self, broker: 'StatusBroker', channel: str):
+        self.broker = broker
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=_QUEUE_MAX_SIZE)
+
+    async def get(self, timeout: float) -> Optional[bytes]:
+        """return the next message published into the channel, None if there is none in time."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self) -> None:
+        """stop receiving the messages of channel."""
+        await self.broker.unsubscribe(self)
+
+
+class StatusBroker:
+    """
+    Summary:
+        The shared subscriber of job status channels in the worker. Each
+        long poll or event stream used to open its own redis pub/sub
+        connection, so the connections grew with the number of clients.
+        The broker keeps one pub/sub connection, subscribes to a channel
+        while it has waiters and fans the messages out to the in-process
+        queue of each waiter.
+    """
+
+    def __init__(self):
+        self._pubsub = None
+        self._reader = None
+        self._waiters = {}
+        # created in the loop of worker
+        self._lock = None
+
+    async def subscribe(self, channel: str) -> StatusSubscription:
+        """
+        Summary:
+            The function registers a waiter of channel, the channel is
+            subscribed in redis when it is the first waiter.
+        Parameter:
+            - channel(str): the status channel
+        Return:
+            - StatusSubscription
+        """
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        subscription = StatusSubscription(self, channel)
+        async with self._lock:
+            waiters = self._waiters.setdefault(channel, set())
+            waiters.add(subscription)
+            if len(waiters) == 1:
+                try:
+                    if self._pubsub is None:
+                        self._pubsub = SrvAioRedisSingleton().get_pubsub()
+                    await self._pubsub.subscribe(channel)
+                except Exception:
+                    del self._waiters[channel]
+                    raise
+            if self._reader is None:
+                self._reader = asyncio.create_task(self.read_forever())
+        return subscription
+
+    async def unsubscribe(self, subscription: StatusSubscription) -> None:
+        """remove the waiter, the channel is unsubscribed in redis after the last one."""
+
+        async with self._lock:
+            waiters = self._waiters.get(subscription.channel, set())
+            waiters.discard(subscription)
+            if waiters:
+                return
+            self._waiters.pop(subscription.channel, None)
+            try:
+                await self._pubsub.unsubscribe(subscription.channel)
+            except Exception as e:
+                # the channel will be dropped when the connection is reset
+                _logger.warning('Fail to unsubscribe %s: %s', subscription.channel, str(e))
+
+    async def read_forever(self) -> None:
+        """dispatch the messages of pub/sub connection to the waiters until cancelled."""
+
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the connection is reconnected and subscribed again in
+                # the next read
+                _logger.error('Fail to read the status channels: %s', str(e))
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            for subscription in list(self._waiters.get(channel, ())):
+                try:
+                    subscription.queue.put_nowait(message['data'])
+                except asyncio.QueueFull:
+                    _logger.warning('Drop the status message of %s for a slow waiter', channel)
+
+    async def stop(self) -> None:
+        """stop the reader and close the pub/sub connection."""
+
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.reset()
+            self._pubsub = None
+        self._waiters = {}
+
+
+status_broker = StatusBroker()
@@ -0,0 +1,112 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import functools
+from contextlib import contextmanager
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.trace import Link, Span, SpanKind
+
+# the spans are no-op until the tracer provider is set by instrument_app
+tracer = trace.get_tracer('service_upload')
+
+
+def start_span(
+    name: str, attributes: dict = None, kind: SpanKind = SpanKind.INTERNAL, context: Context = None, links: list = None
+):
+    """
+    Summary:
+        The function starts the span as the current one. The span records
+        the exception raised inside and is marked as error.
+    Parameter:
+        - name(str): the name of span
+        - attributes(dict): optional, the attributes of span, the None
+            values are skipped
+        - kind(SpanKind): the kind of span, e.g. CLIENT for downstream call
+        - context(Context): optional, the parent context, default is current
+        - links(list): optional, the links to other spans
+    Return:
+        - the context manager of span
+    """
+
+    attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+    return tracer.start_as_current_span(name, context=context, kind=kind, attributes=attributes, links=links)
+
+
+def set_span_attributes(attributes: dict) -> None:
+    """set the attributes on current span, the None values are skipped."""
+
+    span = trace.get_current_span()
+    for key, value in attributes.items():
+        if value is not None:
+            span.set_attribute(key, value)
+
+
+def get_trace_context() -> Context:
+    """get the trace context of current request to pass it to the background job."""
+
+    return otel_context.get_current()
+
+
+@contextmanager
+def background_span(name: str, trace_context: Context = None, attributes: dict = None) -> Span:
+    """
+    Summary:
+        The context manager starts the span of the background job that keeps
+        running after the response is sent. The span stays in the trace of
+        the request that starts the job and also links to the request span,
+        so the trace shows the whole lifecycle of the upload.
+    Parameter:
+        - name(str): the name of span
+        - trace_context(Context): optional, the context from get_trace_context
+            in the request, default is current
+        - attributes(dict): optional, the attributes of span
+    Return:
+        - the span
+    """
+
+    links = []
+    request_span_context = trace.get_current_span(trace_context).get_span_context()
+    if request_span_context.is_valid:
+        links.append(Link(request_span_context, {'upload.link': 'request'}))
+
+    with start_span(name, attributes, context=trace_context, links=links) as span:
+        yield span
+
+
+def traced(name: str, attributes: dict = None, kind: SpanKind = SpanKind.CLIENT):
+    """
+    Summary:
+        The decorator wraps the coroutine function in the span, it is used
+        for the downstream calls without instrumentation, e.g. aioredis.
+    Parameter:
+        - name(str): the name of span
+        - attributes(dict): optional, the attributes of span
+        - kind(SpanKind): the kind of span, default is CLIENT
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with start_span(name, attributes, kind):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -14,10 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from fastapi import APIRouter
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Header, Query, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 
 from app.commons.kafka_producer import get_kafka_producer
 from app.config import ConfigClass
+from app.models.base_models import APIResponse, EAPIResponseCode
+from app.resources.admission import chunk_admission
+from app.resources.job_sweeper import job_sweeper
+from app.resources.loop_monitor import loop_monitor
+from app.resources.metrics import generate_metrics
+from app.resources.multipart_reaper import multipart_reaper
+from app.resources.profiler import EProfileMode, ProfilerBusy, profiler
+from app.resources.status_broker import status_broker
 
 router = APIRouter()
 
@@ -33,14 +45,117 @@ async def root():
     }
 
 
+@router.get('/v1/upload/capacity', tags=['Capacity'])
+async def capacity():
+    """
+    Summary:
+        Return the chunk upload budget usage of the worker which
+        receives the request. It can be used as autoscaling signal.
+    """
+
+    return chunk_admission.get_usage()
+
+
+@router.get('/metrics', tags=['Metrics'])
+async def metrics():
+    """
+    Summary:
+        Expose the prometheus metrics. With PROMETHEUS_MULTIPROC_DIR
+        the metrics are aggregated across ALL gunicorn workers.
+    """
+
+    return Response(generate_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+def is_admin_token_valid(admin_token: Optional[str], expected_token: str) -> bool:
+    """check the Admin-Token header in constant time, always False if the expected token is empty."""
+    expected_token = expected_token.encode()
+    return bool(expected_token) and hmac.compare_digest((admin_token or '').encode(), expected_token)
+
+
+@router.post('/v1/upload/multipart/reap', tags=['Maintenance'])
+async def reap_multipart_uploads(dry_run: bool = True, admin_token: Optional[str] = Header(None)):
+    """
+    Summary:
+        Run the reaper of stale multipart uploads right away. By default
+        it is dry run which only lists the uploads would be aborted. The
+        Admin-Token header must match MULTIPART_REAPER_ADMIN_TOKEN.
+    """
+
+    if not is_admin_token_valid(admin_token, ConfigClass.MULTIPART_REAPER_ADMIN_TOKEN):
+        _res = APIResponse()
+        _res.code = EAPIResponseCode.forbidden
+        _res.error_msg = 'Reaping multipart uploads requires a valid Admin-Token'
+        return _res.json_response()
+
+    return await multipart_reaper.reap(dry_run)
+
+
+@router.post('/v1/upload/profile', tags=['Maintenance'])
+async def profile(
+    mode: EProfileMode = EProfileMode.CPU,
+    seconds: float = 10,
+    interval: float = Query(0.01, gt=0),
+    limit: int = Query(50, gt=0),
+    admin_token: Optional[str] = Header(None),
+):
+    """
+    Summary:
+        Profile the worker which receives the request for the seconds. The
+        cpu profile returns the sampled stacks of threads and asyncio tasks
+        in folded format for flamegraph. The memory profile returns the
+        locations of memory growth between two tracemalloc snapshots. The
+        Admin-Token header must match PROFILING_ADMIN_TOKEN.
+    """
+
+    _res = APIResponse()
+    if not is_admin_token_valid(admin_token, ConfigClass.PROFILING_ADMIN_TOKEN):
+        _res.code = EAPIResponseCode.forbidden
+        _res.error_msg = 'Profiling requires a valid Admin-Token'
+        return _res.json_response()
+
+    try:
+        return await profiler.profile(mode, seconds, interval, limit)
+    except ProfilerBusy as e:
+        _res.code = EAPIResponseCode.conflict
+        _res.error_msg = str(e)
+    except ValueError as e:
+        _res.code = EAPIResponseCode.bad_request
+        _res.error_msg = str(e)
+    return _res.json_response()
+
+
+@router.on_event('startup')
+async def startup_event():
+    '''
+    Summary:
+        the startup event to run the event loop monitor,
+        the sweeper of abandoned upload jobs and the
+        reaper of stale multipart uploads in background.
+    '''
+
+    if ConfigClass.LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    if ConfigClass.JOB_SWEEP_ENABLED:
+        job_sweeper.start()
+    if ConfigClass.MULTIPART_REAPER_ENABLED:
+        multipart_reaper.start()
+
+
 @router.on_event('shutdown')
 async def shutdown_event():
     '''
     Summary:
         the shutdown event to gracefully close the
-        kafka producer.
+        kafka producer, the shared status subscriber and
+        stop the background workers.
     '''
 
+    await job_sweeper.stop()
+    await multipart_reaper.stop()
+    await status_broker.stop()
+    await loop_monitor.stop()
+
     kp = await get_kafka_producer()
     await kp.close_connection()
 
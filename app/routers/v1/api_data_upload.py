@@ -15,7 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
-import json
+import hashlib
 import os
 import shutil
 import time
@@ -23,32 +23,59 @@ import unicodedata as ud
 from typing import Optional
 
 import httpx
-from common import GEIDClient, LoggerFactory, ProjectClient, ProjectNotFoundException
+from common import GEIDClient, ProjectClient, ProjectNotFoundException
 from common.object_storage_adaptor.boto3_client import TokenError, get_boto3_client
-from fastapi import APIRouter, BackgroundTasks, File, Form, Header, UploadFile
+from fastapi import APIRouter, BackgroundTasks, File, Form, Header, Query, UploadFile
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from fastapi_utils import cbv
 
+from app.commons import serializer
 from app.commons.data_providers import SrvAioRedisSingleton, session_job_get_status
 from app.commons.data_providers.redis_project_session_job import (
+    FINISHED_STATES,
+    JOB_FIELDS,
     EState,
+    InvalidStateTransition,
     SessionJob,
+    get_chunk_index_key,
     get_fsm_object,
+    get_fsm_objects,
+    get_status_channel,
+    session_job_query,
+    session_jobs_set_status,
 )
 from app.commons.kafka_producer import get_kafka_producer
+from app.commons.logger import LoggerFactory
 from app.config import ConfigClass
 from app.models.base_models import APIResponse, EAPIResponseCode
 from app.models.file_data import SrvFileDataMgr
 from app.models.folder import FolderMgr
 from app.models.models_upload import (
+    BulkOnSuccessUploadPOST,
+    BulkOnSuccessUploadResponse,
     ChunkUploadResponse,
     EUploadJobType,
+    EUploadMode,
     GETJobStatusResponse,
+    JobStatusQueryPOST,
+    JobStatusQueryResponse,
     OnSuccessUploadPOST,
     POSTCombineChunksResponse,
     PreUploadPOST,
     PreUploadResponse,
 )
+from app.resources.chunk_ingestion import ChunkIngestionRoute
+from app.resources.chunk_size import (
+    ChunkSizeExceeded,
+    InvalidChunk,
+    get_negotiated_chunk_size,
+    get_recommended_chunk_size,
+    get_server_load,
+    is_small_file,
+    validate_chunk,
+    validate_total_chunks,
+)
 from app.resources.decorator import header_enforcement
 from app.resources.error_handler import (
     ECustomizedError,
@@ -61,8 +88,19 @@ from app.resources.lock import (
     bulk_lock_operation,
     unlock_resource,
 )
+from app.resources.metrics import observe_stage
+from app.resources.object_storage import get_s3_client
+from app.resources.rate_limit import ERateLimit, RateLimitExceeded, consume_rate_limit
+from app.resources.stage_graph import StageGraph
+from app.resources.status_broker import StatusSubscription, status_broker
+from app.resources.tracing import (
+    background_span,
+    get_trace_context,
+    set_span_attributes,
+)
 
-router = APIRouter()
+# the multipart body of chunk is parsed without the temp disk round trip
+router = APIRouter(route_class=ChunkIngestionRoute)
 
 _API_TAG = 'V1 Upload'
 _API_NAMESPACE = 'api_data_upload'
@@ -80,9 +118,9 @@ class APIUpload:
         The upload process in both frontend/command line tool will follow this
         workflow:
             1. before the upload, call the pre upload api to do the name check
-            2. then each file will be chunked up into 2MB(current setting),
-                then each chunk will upload to server one by one with chunk
-                upload api.
+            2. then each file will be chunked up with the chunk size returned
+                by pre upload api(default 2MB), then each chunk will upload to
+                server one by one with chunk upload api.
             3. finally, if the client side detect it uploaded ALL chunks, it will
                 signal out the combine chunks api to backend. The backend will
                 start a background job to process chunks and meta.
@@ -143,6 +181,8 @@ class APIUpload:
                 3. normalize the filename with different client(firefox/chrome)
                 4. initialize the job for ALL upload files
                 5. lock all file/node will be
+                6. recommend the chunk size for each file based on file
+                    size, multipart limit and current server load
         Header:
             - session_id(string): The unique session id from client side
         Payload:
@@ -152,6 +192,7 @@ class APIUpload:
             - data(SingleFileForm):
                 - resumable_filename(string): the name of file
                 - resumable_relative_path: the relative path of the file
+                - resumable_total_size(int optional): the size of file
             - upload_message(string):
             - current_folder_node(string): the root level folder that will be
                 uploaded
@@ -162,6 +203,7 @@ class APIUpload:
             When the folder uplaod, the current_folder_node will be the root folder
         Return:
             - 200, job list
+            - 429, project or user exceeds the pre upload rate limit
         """
 
         _res = APIResponse()
@@ -178,6 +220,17 @@ class APIUpload:
             _res.error_msg = 'Invalid job type: {}'.format(request_payload.job_type)
             return _res.json_response()
 
+        # limit the number of files that project/user can pre upload
+        try:
+            await consume_rate_limit(
+                ERateLimit.PRE_UPLOAD_FILES, project_code, request_payload.operator, len(request_payload.data)
+            )
+        except RateLimitExceeded as e:
+            _res.code = EAPIResponseCode.too_many_requests
+            _res.error_msg = str(e)
+            _res.result = {'retry_after': e.retry_after}
+            return _res.json_response(headers=e.get_retry_after_header())
+
         try:
             _ = await self.project_client.get(code=request_payload.project_code)
 
@@ -185,15 +238,16 @@ class APIUpload:
             # handle filename conflicts
             # also check the folder confilct. Note we might have the situation
             # that folder is same name but with different files
-            conflict_folder_start_time = time.time()
-            if request_payload.job_type == EUploadJobType.AS_FILE.name:
-                conflict_file_paths = await get_conflict_file_paths(request_payload.data, request_payload.project_code)
-            elif request_payload.job_type == EUploadJobType.AS_FOLDER.name:
-                conflict_folder_paths = await get_conflict_folder_paths(
-                    request_payload.project_code,
-                    request_payload.current_folder_node,
-                )
-            self.__logger.warning('Conflict Folder Cal Time: ' + str(time.time() - conflict_folder_start_time))
+            with observe_stage('conflict_check'):
+                if request_payload.job_type == EUploadJobType.AS_FILE.name:
+                    conflict_file_paths = await get_conflict_file_paths(
+                        request_payload.data, request_payload.project_code
+                    )
+                elif request_payload.job_type == EUploadJobType.AS_FOLDER.name:
+                    conflict_folder_paths = await get_conflict_folder_paths(
+                        request_payload.project_code,
+                        request_payload.current_folder_node,
+                    )
 
             if len(conflict_file_paths) > 0 or len(conflict_folder_paths) > 0:
                 return response_conflic_folder_file_names(_res, conflict_file_paths, conflict_folder_paths)
@@ -206,41 +260,89 @@ class APIUpload:
 
             #######################################################
 
-            # initialize empty job status manager
-            status_mgr = await get_fsm_object(
-                session_id,
-                project_code,
-                request_payload.operator,
-            )
             task_id = self.geid_client.get_GEID()
-            status_mgr.add_payload('task_id', task_id)
+
+            # negotiate the chunk size for each file before preparing
+            # the multipart upload. The load is sampled once per request.
+            # The file too large to upload is rejected for any client, but
+            # the legacy client gets the default chunk size as before
+            server_load = get_server_load()
+            recommended_chunk_sizes = [
+                get_recommended_chunk_size(x.resumable_total_size, server_load) for x in request_payload.data
+            ]
+            negotiated = [
+                request_payload.negotiate_chunk_size and x.resumable_total_size is not None
+                for x in request_payload.data
+            ]
+            chunk_sizes = [
+                chunk_size if negotiate else ConfigClass.CHUNK_SIZE_DEFAULT
+                for chunk_size, negotiate in zip(recommended_chunk_sizes, negotiated)
+            ]
+
+            # the small file is uploaded in one request with a plain PUT if
+            # client asks for it, it has no multipart upload so its job id
+            # is generated here
+            small_files = [
+                request_payload.single_upload and is_small_file(x.resumable_total_size) for x in request_payload.data
+            ]
 
             # prepare the presigned upload id
             bucket = ('gr-' if namespace == 'greenroom' else 'core-') + project_code
             file_keys = [x.resumable_relative_path + '/' + x.resumable_filename for x in request_payload.data]
-            upload_ids = await self.boto3_client.prepare_multipart_upload(bucket, file_keys)
+            multipart_keys = [file_key for file_key, small in zip(file_keys, small_files) if not small]
+            multipart_ids = []
+            if multipart_keys:
+                with observe_stage(
+                    'multipart_init',
+                    attributes={'upload.project_code': project_code, 'upload.files': len(multipart_keys)},
+                ):
+                    multipart_ids = await self.boto3_client.prepare_multipart_upload(bucket, multipart_keys)
+            multipart_ids = iter(multipart_ids)
+            upload_ids = [self.geid_client.get_GEID() if small else next(multipart_ids) for small in small_files]
 
             # then prepare the job for EACH of the uploading files
-            job_list, lock_keys = [], []
+            status_mgrs, lock_keys = [], []
             redis_srv = SrvAioRedisSingleton()
             redis_pipeline = await redis_srv.get_pipeline()
-            for file_key, upload_id in zip(file_keys, upload_ids):
+            for file_key, upload_id, chunk_size, negotiate, small in zip(
+                file_keys, upload_ids, chunk_sizes, negotiated, small_files
+            ):
 
-                await status_mgr.set_job_id(upload_id)
+                status_mgr = SessionJob(session_id, project_code, request_payload.operator, upload_id)
                 # file_path = upload_data.resumable_relative_path + '/' + upload_data.resumable_filename
                 status_mgr.set_source(file_key)
+                status_mgr.add_payload('task_id', task_id)
                 status_mgr.add_payload('resumable_identifier', upload_id)
-
-                await status_mgr.set_status(EState.PRE_UPLOADED.name)
-                job_key, job_value, job_recorded = status_mgr.get_kv_entity()
-                await run_in_threadpool(redis_pipeline.set, job_key, job_value)
-                job_list.append(job_recorded)
+                status_mgr.add_payload('chunk_size', chunk_size)
+                status_mgr.add_payload('chunk_size_negotiated', negotiate)
+                upload_mode = EUploadMode.SINGLE if small else EUploadMode.MULTIPART
+                status_mgr.add_payload('upload_mode', upload_mode.name)
+                status_mgrs.append(status_mgr)
+
+                # the chunk upload api will validate the chunks with it and
+                # reject the chunk of single upload
+                chunk_config = None
+                if small:
+                    chunk_config = serializer.dumps({'upload_mode': upload_mode.name})
+                elif negotiate:
+                    chunk_config = serializer.dumps({'chunk_size': chunk_size})
+                if chunk_config:
+                    await run_in_threadpool(
+                        redis_pipeline.set, 'chunk_config:%s' % upload_id, chunk_config, ex=ConfigClass.CHUNK_KEY_TTL
+                    )
 
                 # also generate the file lock key for batch lock operation
                 lock_key = await run_in_threadpool(os.path.join, bucket, file_key)
                 lock_keys.append(lock_key)
 
-            await redis_pipeline.execute()
+            # the jobs of all files are written in one round trip, the
+            # records written are returned as they are
+            job_list = await session_jobs_set_status(status_mgrs, EState.PRE_UPLOADED.name)
+            for job_recorded in job_list:
+                if isinstance(job_recorded, InvalidStateTransition):
+                    raise job_recorded
+            with observe_stage('redis_write'):
+                await redis_pipeline.execute()
             # lock all the files to prevent other user uploading same name
             await run_in_threadpool(bulk_lock_operation, lock_keys, 'write')
 
@@ -250,6 +352,10 @@ class APIUpload:
             _res.error_msg = str(e)
             _res.code = EAPIResponseCode.bad_request
 
+        except ChunkSizeExceeded as e:
+            _res.error_msg = str(e)
+            _res.code = EAPIResponseCode.bad_request
+
         except ProjectNotFoundException as e:
             _res.error_msg = str(e)
             _res.code = EAPIResponseCode.not_found
@@ -269,30 +375,157 @@ class APIUpload:
     )
     @catch_internal(_API_NAMESPACE)
     @header_enforcement(['session_id'])
-    async def get_status(self, job_id, session_id: str = Header(None)):
+    async def get_status(
+        self,
+        job_id,
+        wait: int = Query(0, ge=0),
+        session_id: str = Header(None),
+        if_none_match: Optional[str] = Header(None),
+    ):
         """
         Summary:
-            This method allow to check file upload status.
+            This method allow to check file upload status. The response
+            carries the ETag of job detail, if the `If-None-Match` header
+            still matches it, 304 without body will be returned. With the
+            `wait` parameter, the request will be held until the job is
+            changed or the seconds elapsed.
         Header:
             - session_id(string): The unique session id from client side
+            - If-None-Match(string optional): the ETag of previous response
         Parameter:
             - job_id(string): The job identifier for each file
+            - wait(int optional): the seconds to wait for the change when
+                If-None-Match matches, capped by STATUS_LONG_POLL_MAX_WAIT
         Return:
-            - 200, job detail
+            - 200, job detail. The `timeline` contains the millisecond
+                timestamp of each status transition, `stage_durations`
+                contains the milliseconds spent in each finalize stage and
+                `critical_path` is the chain of stages deciding the finalize
+                time
+            - 304, the job is not changed
         """
 
         _res = APIResponse()
 
-        job_fetched = await session_job_get_status(session_id, job_id, '*', _JOB_TYPE, '*')
-        if len(job_fetched) == 0:
+        subscription = None
+        if if_none_match and wait:
+            # subscribe before reading the job, so the change in between
+            # will not be missed
+            subscription = await status_broker.subscribe(get_status_channel(session_id))
+        try:
+            job_fetched = await session_job_get_status(session_id, job_id, '*', _JOB_TYPE, '*')
+            if len(job_fetched) == 0:
+                _res.code = EAPIResponseCode.bad_request
+                _res.error_msg = 'Job ID %s not found' % job_id
+                return _res.json_response()
+
+            job = job_fetched[0]
+            if subscription and etag_matches(if_none_match, get_job_etag(job)):
+                timeout = min(wait, ConfigClass.STATUS_LONG_POLL_MAX_WAIT)
+                job = await wait_for_job_change(subscription, job_id, timeout) or job
+        finally:
+            if subscription:
+                await asyncio.shield(subscription.close())
+
+        etag = get_job_etag(job)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+
+        _res.code = EAPIResponseCode.success
+        _res.result = job
+        return _res.json_response(headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    @router.post(
+        '/upload/status', tags=[_API_TAG], response_model=JobStatusQueryResponse, summary='batch query job status'
+    )
+    @catch_internal(_API_NAMESPACE)
+    @header_enforcement(['session_id'])
+    async def query_status(self, request_payload: JobStatusQueryPOST, session_id: str = Header(None)):
+        """
+        Summary:
+            This method returns the status of many jobs in one call. Without
+            the job ids, all jobs in the session are returned in the order
+            of creation, page by page.
+        Header:
+            - session_id(string): The unique session id from client side
+        Payload:
+            - job_ids(list optional): only query these jobs, max 1000
+            - status(list optional): only return the jobs in these status
+            - fields(list optional): only return these fields of each job,
+                the job_id is always returned
+            - cursor(int): the cursor returned by previous page, default 0
+            - page_size(int): the max number of jobs in page, default 100
+        Return:
+            - 200, the jobs and the `next_cursor`, which is null for the
+                last page
+        """
+
+        _res = APIResponse()
+
+        job_states = [state.name for state in EState]
+        invalid_status = set(request_payload.status or []) - set(job_states)
+        invalid_fields = set(request_payload.fields or []) - set(JOB_FIELDS)
+        if invalid_status:
             _res.code = EAPIResponseCode.bad_request
-            _res.error_msg = 'Job ID %s not found' % job_id
-        else:
-            _res.code = EAPIResponseCode.success
-            _res.result = job_fetched[0]
+            _res.error_msg = 'Invalid status %s, must be one of %s' % (sorted(invalid_status), job_states)
+            return _res.json_response()
+        if invalid_fields:
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = 'Invalid fields %s, must be one of %s' % (sorted(invalid_fields), JOB_FIELDS)
+            return _res.json_response()
 
+        jobs, next_cursor = await session_job_query(
+            session_id,
+            request_payload.job_ids,
+            request_payload.status,
+            request_payload.cursor,
+            request_payload.page_size,
+        )
+        if request_payload.fields:
+            fields = set(request_payload.fields) | {'job_id'}
+            jobs = [{field: job.get(field) for field in JOB_FIELDS if field in fields} for job in jobs]
+
+        _res.code = EAPIResponseCode.success
+        _res.result = {'jobs': jobs, 'next_cursor': next_cursor}
         return _res.json_response()
 
+    @router.get('/upload/events', tags=[_API_TAG], summary='stream the job status changes of a session')
+    @catch_internal(_API_NAMESPACE)
+    @header_enforcement(['session_id'])
+    async def stream_status(self, until_finished: bool = False, session_id: str = Header(None)):
+        """
+        Summary:
+            This method streams the status of all upload jobs within the
+            session as Server-Sent Events. The current status of each job
+            is sent first, then every status change is pushed as it is
+            published by the job. So the client does not need to poll the
+            status api for each file.
+        Header:
+            - session_id(string): The unique session id from client side
+        Parameter:
+            - until_finished(bool): close the stream once all jobs of the
+                session are SUCCEED or TERMINATED, or right away if the
+                session has no job. Default is False
+        Return:
+            - 200, the `text/event-stream` with a `status` event for each
+                job change, the data is the job detail
+        """
+
+        # subscribe before reading the current status, so the change in
+        # between will not be missed
+        subscription = await status_broker.subscribe(get_status_channel(session_id))
+        try:
+            jobs = await session_job_get_status(session_id, '*', '*', _JOB_TYPE, '*')
+        except Exception:
+            await subscription.close()
+            raise
+
+        return StreamingResponse(
+            job_status_event_stream(subscription, jobs, until_finished),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+
     @router.post('/files/chunks', tags=[_API_TAG], response_model=ChunkUploadResponse, summary='upload chunks process.')
     @catch_internal(_API_NAMESPACE)
     @header_enforcement(['session_id'])
@@ -327,6 +560,11 @@ class APIUpload:
             - resumable_chunk_number(string): The integer id for each chunk
         Return:
             - 200, Succeed
+            - 400, the chunk does not match the negotiated chunk size or
+                the job is negotiated for single upload
+            - 429, project or user exceeds the chunk bytes rate limit,
+                charged before the body is read(returned by ChunkIngestionRoute)
+            - 503, the worker is saturated(returned by ChunkAdmissionMiddleware)
         """
 
         # init resp
@@ -344,21 +582,53 @@ class APIUpload:
             bucket = ('gr-' if ConfigClass.namespace == 'greenroom' else 'core-') + project_code
             file_key = resumable_relative_path + '/' + resumable_filename
 
+            # the file negotiated for single upload has no multipart upload
+            chunk_config = await redis_srv.get_by_key('chunk_config:%s' % resumable_identifier)
+            chunk_config = serializer.loads(chunk_config) if chunk_config else {}
+            if chunk_config.get('upload_mode') == EUploadMode.SINGLE.name:
+                _res.code = EAPIResponseCode.bad_request
+                _res.error_msg = get_single_upload_error(resumable_identifier)
+                return _res.json_response()
+
             # dirctly proxy to the server
             self.__logger.info('Start to read the chunks')
-            file_content = await chunk_data.read()
+            with observe_stage('chunk_read'):
+                file_content = await chunk_data.read()
             self.__logger.info('Chunk size is %s', len(file_content))
-            etag_info = await self.boto3_client.part_upload(
-                bucket, file_key, resumable_identifier, resumable_chunk_number, file_content
-            )
-            self.__logger.info('finish the chunk upload: %s', json.dumps(etag_info))
 
-            # and then collect the etag for third api
+            # check the chunk against the chunk size from pre upload api
+            validate_chunk(chunk_config.get('chunk_size'), resumable_chunk_number, len(file_content))
+
+            chunk_attributes = {
+                'upload.project_code': project_code,
+                'upload.job_id': resumable_identifier,
+                'upload.chunk_number': resumable_chunk_number,
+                'upload.bytes': len(file_content),
+            }
+            with observe_stage('part_upload', attributes=chunk_attributes):
+                etag_info = await self.boto3_client.part_upload(
+                    bucket, file_key, resumable_identifier, resumable_chunk_number, file_content
+                )
+            self.__logger.info('finish the chunk upload: %s', etag_info)
+
+            # and then collect the etag for third api. The key is also
+            # indexed with the upload time for the job sweeper
             redis_key = '%s:%s' % (resumable_identifier, resumable_chunk_number)
-            await redis_srv.set_by_key(redis_key, json.dumps(etag_info))
+            with observe_stage('redis_write'):
+                await redis_srv.set_indexed_by_key(
+                    redis_key,
+                    serializer.dumps(etag_info),
+                    ConfigClass.CHUNK_KEY_TTL,
+                    get_chunk_index_key(resumable_identifier),
+                    time.time(),
+                )
 
             _res.code = EAPIResponseCode.success
             _res.result = {'msg': 'Succeed'}
+        except InvalidChunk as e:
+            self.__logger.error('Invalid chunk: %s', str(e))
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = str(e)
         except Exception as e:
             error_message = str(e)
             self.__logger.error('Fail to upload chunks: %s', error_message)
@@ -371,7 +641,10 @@ class APIUpload:
                 resumable_identifier,
             )
             status_mgr.add_payload('error_msg', str(e))
-            await status_mgr.set_status(EState.TERMINATED.name)
+            try:
+                await status_mgr.set_status(EState.TERMINATED.name)
+            except InvalidStateTransition as transition_error:
+                self.__logger.warning('Fail to terminate the job: %s', str(transition_error))
 
             _res.code = EAPIResponseCode.internal_error
             _res.error_msg = error_message
@@ -414,6 +687,8 @@ class APIUpload:
             - upload_message(string optional): default is ''  # cli
         Return:
             - 200, Succeed
+            - 400, the job is negotiated for single upload
+            - 409, the job is terminated or finalized already
         """
 
         # init resp
@@ -432,8 +707,23 @@ class APIUpload:
             request_payload.operator,
             request_payload.resumable_identifier,
         )
+        if status_mgr.payload.get('upload_mode') == EUploadMode.SINGLE.name:
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = get_single_upload_error(request_payload.resumable_identifier)
+            return _res.json_response()
 
-        # add background task to combine all received chunks
+        # set merging status, the job might be terminated or finalized already
+        try:
+            job_recorded = await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+        except InvalidStateTransition as e:
+            self.__logger.warning(str(e))
+            _res.code = EAPIResponseCode.conflict
+            _res.error_msg = str(e)
+            return _res.json_response()
+
+        # add background task to combine all received chunks, the finalize
+        # span is linked to this request
+        set_span_attributes(get_file_span_attributes(request_payload))
         background_tasks.add_task(
             finalize_worker,
             self.__logger,
@@ -441,15 +731,320 @@ class APIUpload:
             status_mgr,
             self.boto3_client,
             session_id,
+            get_trace_context(),
         )
 
         self.__logger.info('finalize_worker started')
-        # set merging status
-        job_recorded = await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
         _res.code = EAPIResponseCode.success
         _res.result = job_recorded
         return _res.json_response()
 
+    @router.post(
+        '/files/single',
+        tags=[_API_TAG],
+        response_model=POSTCombineChunksResponse,
+        summary='upload the small file and its metadata in one request',
+    )
+    @catch_internal(_API_NAMESPACE)
+    @header_enforcement(['session_id'])
+    async def upload_single(
+        self,
+        project_code: str = Form(...),
+        operator: str = Form(...),
+        resumable_identifier: str = Form(...),
+        resumable_filename: str = Form(...),
+        resumable_relative_path: str = Form(''),
+        resumable_total_size: int = Form(...),
+        tags: list = Form([]),
+        process_pipeline: str = Form(None),
+        session_id: str = Header(None),
+        file_data: UploadFile = File(...),
+    ):
+        """
+        Summary:
+            The api replaces the chunk upload and combine chunks apis for
+            the file negotiated as SINGLE upload mode in pre upload api.
+            The whole file is uploaded with a plain PUT instead of the
+            multipart upload, then the metadata is created before return.
+        Header:
+            - session_id(string): The unique session id from client side
+        Form:
+            - project_code(string): the target project will upload to
+            - operator(string): the name of operator
+            - resumable_filename(string): the name of file
+            - resumable_relative_path(string): the relative path of the file
+            - resumable_identifier(string): The job identifier for each file
+            - resumable_total_size(int): the file size
+            - process_pipeline(string optional): default is None  # cli
+        Return:
+            - 200, the finished job
+            - 400, the job is not negotiated for single upload or the size
+                does not match
+            - 409, the job is terminated or finalized already
+            - 429, project or user exceeds the chunk bytes rate limit,
+                charged before the body is read(returned by ChunkIngestionRoute)
+            - 503, the worker is saturated(returned by ChunkAdmissionMiddleware)
+        """
+
+        _res = APIResponse()
+
+        # same as the chunk upload, some of the browser encode in NFD form
+        resumable_filename = ud.normalize('NFC', resumable_filename)
+        request_payload = OnSuccessUploadPOST(
+            project_code=project_code,
+            operator=operator,
+            resumable_identifier=resumable_identifier,
+            resumable_filename=resumable_filename,
+            resumable_relative_path=resumable_relative_path,
+            resumable_total_chunks=1,
+            resumable_total_size=resumable_total_size,
+            tags=tags,
+            process_pipeline=process_pipeline,
+        )
+
+        status_mgr = await get_fsm_object(session_id, project_code, operator, resumable_identifier)
+        if status_mgr.payload.get('upload_mode') != EUploadMode.SINGLE.name:
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = 'Job {} is not negotiated for single upload'.format(resumable_identifier)
+            return _res.json_response()
+
+        with observe_stage('chunk_read'):
+            file_content = await file_data.read()
+        if len(file_content) != resumable_total_size or not is_small_file(len(file_content)):
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = 'File size {} does not match the single upload of {} bytes'.format(
+                len(file_content), resumable_total_size
+            )
+            return _res.json_response()
+
+        lock_key = await run_in_threadpool(get_file_lock_key, request_payload)
+        temp_dir = await run_in_threadpool(os.path.join, ConfigClass.TEMP_BASE, resumable_identifier)
+        try:
+            # the job might be terminated or uploaded by another request
+            await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+
+            created_entity = await finalize_file(
+                self.__logger, request_payload, status_mgr, self.boto3_client, content=file_content
+            )
+            status_mgr.add_payload('source_geid', created_entity.get('id'))
+            _res.result = await status_mgr.set_status(EState.FINALIZED.name, EState.SUCCEED.name)
+            _res.code = EAPIResponseCode.success
+
+        except InvalidStateTransition as e:
+            self.__logger.warning(str(e))
+            _res.code = EAPIResponseCode.conflict
+            _res.error_msg = str(e)
+            # the job of other request is not unlocked
+            return _res.json_response()
+
+        except Exception as e:
+            self.__logger.error('Fail to upload the small file: %s', str(e))
+            status_mgr.add_payload('error_msg', str(e))
+            try:
+                await status_mgr.set_status(EState.TERMINATED.name)
+            except InvalidStateTransition as transition_error:
+                self.__logger.warning('Fail to terminate the job: %s', str(transition_error))
+            _res.code = EAPIResponseCode.internal_error
+            _res.error_msg = str(e)
+
+        finally:
+            # remove the zip preview if applies
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+
+        await unlock_resource(lock_key, 'write')
+        return _res.json_response()
+
+    @router.post(
+        '/files/bulk',
+        tags=[_API_TAG],
+        response_model=BulkOnSuccessUploadResponse,
+        summary='create one background worker to combine chunks of many files',
+    )
+    @catch_internal(_API_NAMESPACE)
+    @header_enforcement(['session_id'])
+    async def on_success_bulk(
+        self,
+        request_payload: BulkOnSuccessUploadPOST,
+        background_tasks: BackgroundTasks,
+        session_id: str = Header(None),
+    ):
+        """
+        Summary:
+            The bulk version of the third api for the upload of many small
+            files, e.g. a folder. The jobs are read and set to CHUNK_UPLOADED
+            in one round trip, then one background job finalizes all of
+            them. Each item gets its own result, the item not found or not
+            allowed to finalize does not fail the others.
+        Payload:
+            - items(list): the payload of third api for each file, max 1000
+        Return:
+            - 200, the result of each item
+                - job_id(string): the resumable identifier of item
+                - code(int): 200 accepted, 400 the job is negotiated for
+                    single upload, 404 job not found, 409 the job can not
+                    be finalized, e.g. terminated already
+                - error_msg(string): the reason of rejection
+                - job(dict): the job record if accepted
+        """
+
+        _res = APIResponse()
+
+        items = request_payload.items
+        job_ids = [item.resumable_identifier for item in items]
+        if len(set(job_ids)) != len(job_ids):
+            _res.code = EAPIResponseCode.bad_request
+            _res.error_msg = 'Duplicated resumable_identifier in items'
+            return _res.json_response()
+
+        # same as the single file, some of the browser encode in NFD form
+        for item in items:
+            item.resumable_filename = ud.normalize('NFC', item.resumable_filename)
+
+        status_mgrs = await get_fsm_objects(
+            session_id, [(item.project_code, item.operator, item.resumable_identifier) for item in items]
+        )
+        single_uploads = [
+            status_mgr is not None and status_mgr.payload.get('upload_mode') == EUploadMode.SINGLE.name
+            for status_mgr in status_mgrs
+        ]
+        transitions = iter(
+            await session_jobs_set_status(
+                [
+                    status_mgr
+                    for status_mgr, single in zip(status_mgrs, single_uploads)
+                    if status_mgr is not None and not single
+                ],
+                EState.CHUNK_UPLOADED.name,
+            )
+        )
+
+        results, accepted = [], []
+        for item, status_mgr, single in zip(items, status_mgrs, single_uploads):
+            result = {'job_id': item.resumable_identifier, 'code': EAPIResponseCode.success.value, 'error_msg': ''}
+            job_recorded = next(transitions) if status_mgr is not None and not single else None
+            if status_mgr is None:
+                result['code'] = EAPIResponseCode.not_found.value
+                result['error_msg'] = '[SessionJob] Not found job: {}'.format(item.resumable_identifier)
+            elif single:
+                result['code'] = EAPIResponseCode.bad_request.value
+                result['error_msg'] = get_single_upload_error(item.resumable_identifier)
+            elif isinstance(job_recorded, InvalidStateTransition):
+                self.__logger.warning(str(job_recorded))
+                result['code'] = EAPIResponseCode.conflict.value
+                result['error_msg'] = str(job_recorded)
+                job_recorded = None
+            else:
+                accepted.append((item, status_mgr))
+            result['job'] = job_recorded
+            results.append(result)
+
+        if accepted:
+            set_span_attributes({'upload.files': len(accepted)})
+            background_tasks.add_task(
+                bulk_finalize_worker, self.__logger, accepted, self.boto3_client, get_trace_context()
+            )
+            self.__logger.info('bulk_finalize_worker started for %s files', len(accepted))
+
+        _res.code = EAPIResponseCode.success
+        _res.result = results
+        _res.total = len(results)
+        return _res.json_response()
+
+
+def get_single_upload_error(job_id: str) -> str:
+    """get the error message for the chunk upload or finalize of the job negotiated for single upload."""
+    return 'Job {} is negotiated for single upload, upload the file with /v1/files/single'.format(job_id)
+
+
+def get_job_etag(job: dict) -> str:
+    """get the ETag of job detail, any change of the job will change it."""
+    return '"%s"' % hashlib.md5(serializer.dumpb(job, sort_keys=True)).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """check if the If-None-Match header matches the ETag."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    # the weak comparison is used, so the W/ prefix is ignored
+    normalized = {candidate[2:] if candidate.startswith('W/') else candidate for candidate in candidates}
+    return '*' in candidates or etag in normalized
+
+
+async def wait_for_job_change(subscription: StatusSubscription, job_id: str, timeout: float) -> Optional[dict]:
+    """
+    Summary:
+        wait for the next status change of the job published into the
+        session channel.
+    Parameter:
+        - subscription(StatusSubscription): the subscription of session channel
+        - job_id(str): the job to wait for
+        - timeout(float): the max seconds to wait
+    Return:
+        - the changed job detail, None if there is no change in time
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        message = await subscription.get(remaining)
+        if message is None:
+            continue
+        job = serializer.loads(message)
+        if job['job_id'] == job_id:
+            return job
+
+
+def format_status_event(job: dict) -> str:
+    """format the job detail as the Server-Sent Event."""
+    return 'event: status\ndata: %s\n\n' % serializer.dumps(job)
+
+
+async def job_status_event_stream(subscription: StatusSubscription, jobs: list, until_finished: bool = False):
+    """
+    Summary:
+        The generator yields the current status of jobs and then every
+        status change published into the session channel. A keep-alive
+        comment is sent when there is no change for a while so proxies
+        will not close the idle connection.
+    Parameter:
+        - subscription(StatusSubscription): the subscription of session channel
+        - jobs(list): the current job details of the session
+        - until_finished(bool): stop once all known jobs finished, the
+            session without any job is taken as finished
+    Return:
+        - the event strings
+    """
+
+    job_status = {}
+    try:
+        for job in jobs:
+            job_status[job['job_id']] = job['status']
+            yield format_status_event(job)
+
+        last_sent = time.monotonic()
+        while True:
+            if until_finished and all(status in FINISHED_STATES for status in job_status.values()):
+                break
+
+            message = await subscription.get(1.0)
+            if message is None:
+                if time.monotonic() - last_sent >= ConfigClass.STATUS_STREAM_HEARTBEAT:
+                    last_sent = time.monotonic()
+                    yield ': keep-alive\n\n'
+                continue
+
+            job = serializer.loads(message)
+            job_status[job['job_id']] = job['status']
+            last_sent = time.monotonic()
+            yield format_status_event(job)
+    finally:
+        # release the subscription even if the client disconnected
+        await asyncio.shield(subscription.close())
+
 
 def save_file(dest: str, my_file: UploadFile) -> None:
     """save file on the disk."""
@@ -457,6 +1052,26 @@ def save_file(dest: str, my_file: UploadFile) -> None:
         shutil.copyfileobj(my_file.file, buffer)
 
 
+async def put_object(boto3_client, bucket: str, key: str, content: bytes) -> dict:
+    """
+    Summary:
+        The function uploads the small file with one plain PUT. The boto3
+        client from common only wraps the multipart upload, so the s3
+        client is opened with its endpoint and credentials.
+    Parameters:
+        - boto3_client(Boto3Client): the object storage client
+        - bucket(str): the bucket name
+        - key(str): the object path of file
+        - content(bytes): the content of file
+    Return:
+        - object meta: contains the version_id
+    """
+
+    with observe_stage('object_put', attributes={'upload.bucket': bucket, 'upload.bytes': len(content)}):
+        async with get_s3_client(boto3_client) as s3:
+            return await s3.put_object(Bucket=bucket, Key=key, Body=content)
+
+
 async def folder_creation(project_code: str, operator: str, file_path: str, file_name: str):
     """
     Summary:
@@ -476,28 +1091,23 @@ async def folder_creation(project_code: str, operator: str, file_path: str, file
 
     __logger = LoggerFactory('api_data_upload').get_logger()
     namespace = ConfigClass.namespace
-    folder_create_duration = 0
-
-    __logger.info('test')
 
     # create folder and folder nodes
-    folder_create_start_time = time.time()
     folder_mgr = FolderMgr(
         project_code,
         file_path,
     )
 
     # TODO somehow simplify here
-    await folder_mgr.create(operator)
+    with observe_stage(
+        'folder_resolution', attributes={'upload.project_code': project_code, 'upload.folder_path': file_path}
+    ):
+        await folder_mgr.create(operator)
     to_create_folders = folder_mgr.to_create
 
     # last_folder_node_geid = folder_mgr.last_node.folder_parent_geid if folder_mgr.last_node else None
-    folder_create_duration += time.time() - folder_create_start_time
-
-    __logger.info('Save to Cache Folder Time: ' + str(folder_create_duration))
 
     # batch create folder nodes
-    batch_folder_create_start_time = time.time()
     if len(to_create_folders) > 0:
         # also try to lock the those new folder
         try:
@@ -509,16 +1119,15 @@ async def folder_creation(project_code: str, operator: str, file_path: str, file
                 lock_keys.append(lock_key)
 
             await run_in_threadpool(bulk_lock_operation, lock_keys, 'write')
-            __logger.info('Folder lock time: ' + str(time.time() - batch_folder_create_start_time))
 
             url = ConfigClass.METADATA_SERVICE + 'items/batch/'
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json={'items': to_create_folders}, timeout=10)
-                if response.status_code != 200:
-                    raise Exception('Fail to create metadata in postgres: %s' % (response.__dict__))
+            with observe_stage('folder_batch_create'):
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(url, json={'items': to_create_folders}, timeout=10)
+                    if response.status_code != 200:
+                        raise Exception('Fail to create metadata in postgres: %s' % (response.__dict__))
 
             __logger.info('New Folders saved: {}'.format(len(to_create_folders)))
-            __logger.info('New Node Creation Time: ' + str(time.time() - batch_folder_create_start_time))
 
             # here we unlock the locked nodes ONLY
             await run_in_threadpool(bulk_lock_operation, lock_keys, 'write', False)
@@ -537,44 +1146,34 @@ async def folder_creation(project_code: str, operator: str, file_path: str, file
     return folder_mgr.last_node
 
 
-async def finalize_worker(
+async def finalize_file(
     logger,
     request_payload: OnSuccessUploadPOST,
     status_mgr: SessionJob,
     boto3_client,
-    session_id,
-):
+    chunks_info: list = None,
+    folder_node=None,
+    client: httpx.AsyncClient = None,
+    content: bytes = None,
+) -> dict:
     """
     Summary:
-        The function is the background job to combine chunks and process the
-        metadata. The metadata process including following:
-            - lock the target file node.
-            - create the folder tree if the folder structure does not exist.
-            - combine chunks and upload to minio.
-            - calling the dataops utility api to create postgres/es/atlas record.
-            - calling the provenence service to create activity log of file.
-            - calling the dataops utiltiy api to add the zip preview if upload
-                zip file.
-            - update the job status.
-            - remove the temperary folder
-            - unlock the file node
+        The function combines the chunks of file and creates its metadata.
+        The steps run as a stage graph so the independent ones overlap, the
+        duration of each stage and the critical path are kept in the job.
+        The bulk finalize passes in what it already fetched for all files.
+        The small file passes in its content to upload with a plain PUT
+        instead of combining the chunks.
     Parameter:
-        - request_payload(OnSuccessUploadPOST)
-            - project_code(string): the target project will upload to
-            - operator(string): the name of operator
-            - resumable_filename(string): the name of file
-            - resumable_relative_path(string): the relative path of the file
-            - resumable_identifier(string): The job identifier for each file
-            - resumable_total_chunks(string): The number of total chunks
-            - resumable_total_size(float): the file size
-            - process_pipeline(string optional): default is None  # cli
-            - from_parents(list optional): default is None  # cli
-            - upload_message(string optional): default is ''  # cli
+        - request_payload(OnSuccessUploadPOST): the file to finalize
         - status_mgr(SessionJob): the object manage the job status
-        - access_token(str): the token for user to upload into minio
-        - refresh_token(str): the token to refresh the access
+        - chunks_info(list): optional, the etag info of chunks in order of
+            part number, the chunk keys are left for the caller to remove
+        - folder_node(FolderNode): optional, the parent folder of file
+        - client(httpx.AsyncClient): optional, the client shared by files
+        - content(bytes): optional, the whole content of small file
     Return:
-        - None
+        - (dict) the created file entity
     """
 
     namespace = ConfigClass.namespace
@@ -585,8 +1184,6 @@ async def finalize_worker(
     resumable_identifier = request_payload.resumable_identifier
     bucket = ('gr-' if namespace == 'greenroom' else 'core-') + project_code
     obj_path = await run_in_threadpool(os.path.join, file_path, file_name)
-    lock_key = await run_in_threadpool(os.path.join, bucket, file_path, file_name)
-
     temp_dir = await run_in_threadpool(os.path.join, ConfigClass.TEMP_BASE, resumable_identifier)
     target_file_full_path = await run_in_threadpool(
         os.path.join,
@@ -596,26 +1193,69 @@ async def finalize_worker(
         request_payload.resumable_filename,
     )
 
-    try:
+    redis_srv = SrvAioRedisSingleton()
+    target_head, target_tail = await run_in_threadpool(os.path.split, target_file_full_path)
+    is_zip = (await run_in_threadpool(os.path.splitext, file_name))[1] == '.zip'
+    # the stages only wait for what they depend on, e.g. the folder tree
+    # is created while the chunks are combined
+    graph = StageGraph(status_mgr.stage_durations)
+    object_writes = []
+
+    async def write_object(coroutine):
+        # the write is not cancelled with the failed graph, so the object
+        # can be removed once it is done
+        object_writes.append(asyncio.ensure_future(coroutine))
+        return await asyncio.shield(object_writes[-1])
+
+    async def remove_orphan_object():
+        # the object is left without file item if e.g. the folder creation
+        # fails after the chunks are combined
+        written = await asyncio.gather(*object_writes, return_exceptions=True)
+        if 'metadata_create' in graph.results or all(isinstance(x, BaseException) for x in written):
+            return
+        logger.warning('Remove the object %s/%s of failed finalize', bucket, obj_path)
+        try:
+            await boto3_client.delete_object(bucket, obj_path)
+        except Exception as e:
+            logger.error('Fail to remove the object %s/%s: %s', bucket, obj_path, str(e))
 
+    async def create_folders():
         # create folder tree if not exist. The function is to check if
         # /a/b/c.txt that b is not exist in database. And will create it
         logger.info('Start to create folder trees')
-        last_node = await folder_creation(project_code, operator, file_path, file_name)
-
-        target_head, target_tail = await run_in_threadpool(os.path.split, target_file_full_path)
+        return await folder_creation(project_code, operator, file_path, file_name)
 
-        redis_srv = SrvAioRedisSingleton()
+    async def fetch_etags():
         # get all chunk info like etag
-        logger.info('Start server side chunk combination')
         chunks_info = await redis_srv.mget_by_prefix(resumable_identifier)
-        chunks_info = [json.loads(x) for x in chunks_info]
-        chunks_info = sorted(chunks_info, key=lambda d: d.get('PartNumber'))
+        chunks_info = [serializer.loads(x) for x in chunks_info]
+        return sorted(chunks_info, key=lambda d: d.get('PartNumber'))
 
+    async def combine():
         # send the message to combine the chunks on server side
-        result = await boto3_client.combine_chunks(bucket, obj_path, resumable_identifier, chunks_info)
-        version_id = result.get('VersionId', '')
+        logger.info('Start server side chunk combination')
+        set_span_attributes({'upload.part_count': len(graph.results['etag_fetch'])})
+        result = await write_object(
+            boto3_client.combine_chunks(bucket, obj_path, resumable_identifier, graph.results['etag_fetch'])
+        )
+        return result.get('VersionId', '')
+
+    async def put():
+        # the small file has no multipart upload
+        logger.info('Start to put the small file')
+        result = await write_object(put_object(boto3_client, bucket, obj_path, content))
+        return result.get('VersionId', '')
+
+    async def cleanup_chunks():
+        # the chunk keys are useless once the parts are combined
+        chunk_keys = [
+            '%s:%s' % (resumable_identifier, chunk.get('PartNumber')) for chunk in graph.results['etag_fetch']
+        ]
+        await redis_srv.delete_by_keys(
+            chunk_keys + ['chunk_config:%s' % resumable_identifier, get_chunk_index_key(resumable_identifier)]
+        )
 
+    async def create_metadata():
         # create entity file data
         logger.info('start to create item in metadata service')
         file_meta_mgr = SrvFileDataMgr(logger)
@@ -630,52 +1270,150 @@ async def finalize_worker(
             request_payload.tags,
             bucket,  # minio attribute
             obj_path,  # minio attribute
-            version_id,  # minio attribute
+            graph.results[upload_stage],  # minio attribute
             operator=operator,
             process_pipeline=request_payload.process_pipeline,
             from_parents=request_payload.from_parents,
-            parent_folder_geid=last_node.global_entity_id,
+            parent_folder_geid=graph.results['folder_creation'].global_entity_id,
+            client=client,
         )
         # get created entity
-        created_entity = res_create_meta.get('result')
+        return res_create_meta.get('result')
+
+    async def generate_zip_preview():
+        # new update and temperory solution here: if the file is zip
+        # then we download again to read the structure
+        await boto3_client.downlaod_object(bucket, obj_path, temp_dir + '/' + obj_path)
+        return await generate_archive_preview(temp_dir + '/' + obj_path)
 
+    async def save_zip_preview():
         # Store zip file preview in postgres
+        geid = graph.results['metadata_create'].get('id')
         try:
-            file_type = await run_in_threadpool(os.path.splitext, file_name)
-            if file_type[1] == '.zip':
-                # new update and temperory solution here: if the file is zip
-                # then we download again to read the structure
-                await boto3_client.downlaod_object(bucket, obj_path, temp_dir + '/' + obj_path)
-
-                archive_preview = await generate_archive_preview(temp_dir + '/' + obj_path)
-                payload = {
-                    'archive_preview': archive_preview,
-                    'file_id': created_entity.get('id'),
-                }
-                async with httpx.AsyncClient() as client:
-                    await client.post(ConfigClass.DATAOPS_SERVICE + 'archive', json=payload, timeout=3600)
+            payload = {'archive_preview': graph.results['zip_preview'], 'file_id': geid}
+            async with httpx.AsyncClient() as client:
+                await client.post(ConfigClass.DATAOPS_SERVICE + 'archive', json=payload, timeout=3600)
         except Exception as e:
-            geid = created_entity.get('id')
             logger.error(f'Error adding file preview for {geid}: {str(e)}')
             raise e
 
-        # update full path to Greenroom/<display_path> for audit log
-        obj_path = (
-            (ConfigClass.GREEN_ZONE_LABEL if namespace == 'greenroom' else ConfigClass.CORE_ZONE_LABEL) + '/' + obj_path
-        )
-
+    async def create_activity_log():
         # update full path to Greenroom/<display_path> for audit log
         kp = await get_kafka_producer()
         await kp.create_activity_log(
-            created_entity, 'metadata_items_activity.avsc', operator, ConfigClass.KAFKA_ACTIVITY_TOPIC
+            graph.results['metadata_create'],
+            'metadata_items_activity.avsc',
+            operator,
+            ConfigClass.KAFKA_ACTIVITY_TOPIC,
         )
 
-        await status_mgr.set_status(EState.FINALIZED.name)
+    # the stages of what is passed in are skipped
+    folder_stages, etag_stages = (), ()
+    if folder_node is None:
+        graph.add('folder_creation', create_folders)
+        folder_stages = ('folder_creation',)
+    else:
+        graph.results['folder_creation'] = folder_node
+    if content is not None:
+        upload_stage = 'object_put'
+        graph.add(upload_stage, put)
+    else:
+        upload_stage = 'combine'
+        if chunks_info is None:
+            graph.add('etag_fetch', fetch_etags)
+            etag_stages = ('etag_fetch',)
+        else:
+            graph.results['etag_fetch'] = chunks_info
+        graph.add(upload_stage, combine, depends_on=etag_stages)
+        if chunks_info is None:
+            graph.add('chunk_cleanup', cleanup_chunks, depends_on=(upload_stage,))
+    graph.add('metadata_create', create_metadata, depends_on=folder_stages + (upload_stage,))
+    if is_zip:
+        graph.add('zip_preview', generate_zip_preview, depends_on=(upload_stage,))
+        graph.add('zip_preview_save', save_zip_preview, depends_on=('zip_preview', 'metadata_create'))
+    graph.add('kafka', create_activity_log, depends_on=('metadata_create',))
+
+    with observe_stage('finalize', status_mgr.stage_durations, get_file_span_attributes(request_payload)):
+        try:
+            await graph.run()
+        except Exception:
+            await remove_orphan_object()
+            raise
+    status_mgr.critical_path = graph.critical_path()
+
+    return graph.results['metadata_create']
 
+
+async def finalize_worker(
+    logger,
+    request_payload: OnSuccessUploadPOST,
+    status_mgr: SessionJob,
+    boto3_client,
+    session_id,
+    trace_context=None,
+):
+    """
+    Summary:
+        The function is the background job to combine chunks and process the
+        metadata. The metadata process including following:
+            - lock the target file node.
+            - create the folder tree if the folder structure does not exist.
+            - combine chunks and upload to minio.
+            - calling the dataops utility api to create postgres/es/atlas record.
+            - calling the provenence service to create activity log of file.
+            - calling the dataops utiltiy api to add the zip preview if upload
+                zip file.
+            - update the job status.
+            - remove the temperary folder
+            - unlock the file node
+    Parameter:
+        - request_payload(OnSuccessUploadPOST)
+            - project_code(string): the target project will upload to
+            - operator(string): the name of operator
+            - resumable_filename(string): the name of file
+            - resumable_relative_path(string): the relative path of the file
+            - resumable_identifier(string): The job identifier for each file
+            - resumable_total_chunks(string): The number of total chunks
+            - resumable_total_size(float): the file size
+            - process_pipeline(string optional): default is None  # cli
+            - from_parents(list optional): default is None  # cli
+            - upload_message(string optional): default is ''  # cli
+        - status_mgr(SessionJob): the object manage the job status
+        - access_token(str): the token for user to upload into minio
+        - refresh_token(str): the token to refresh the access
+        - trace_context(Context): optional, the trace context of on_success
+            request, the span of job is linked to it
+    Return:
+        - None
+    """
+
+    with background_span('upload.finalize_worker', trace_context, get_file_span_attributes(request_payload)):
+        await _finalize_worker(logger, request_payload, status_mgr, boto3_client)
+
+
+async def _finalize_worker(logger, request_payload: OnSuccessUploadPOST, status_mgr: SessionJob, boto3_client):
+    lock_key = await run_in_threadpool(get_file_lock_key, request_payload)
+    temp_dir = await run_in_threadpool(os.path.join, ConfigClass.TEMP_BASE, request_payload.resumable_identifier)
+
+    try:
+        # make sure the chunks are uploaded with the negotiated chunk size
+        validate_total_chunks(
+            get_negotiated_chunk_size(status_mgr.payload),
+            int(request_payload.resumable_total_size),
+            request_payload.resumable_total_chunks,
+        )
+
+        created_entity = await finalize_file(logger, request_payload, status_mgr, boto3_client)
+
+        # both of the statuses are written in one round trip
         status_mgr.add_payload('source_geid', created_entity.get('id'))
-        await status_mgr.set_status(EState.SUCCEED.name)
+        await status_mgr.set_status(EState.FINALIZED.name, EState.SUCCEED.name)
         logger.info('Upload Job Done.')
 
+    except InvalidStateTransition as e:
+        # the job is terminated by others in the middle, e.g. the sweeper
+        logger.warning(str(e))
+
     except FileNotFoundError as e:
         error_msg = 'folder {} is already empty: {}'.format(temp_dir, str(e))
         logger.error(error_msg)
@@ -696,6 +1434,166 @@ async def finalize_worker(
             shutil.rmtree(temp_dir)
 
 
+async def bulk_finalize_worker(logger, accepted: list, boto3_client, trace_context=None):
+    """
+    Summary:
+        The background job of bulk finalize. The work shared by the files
+        is done once for all of them:
+            - the etags of all files are fetched in one round trip.
+            - the folder tree of each folder is created once.
+            - the files are finalized concurrently with one http client,
+                at most BULK_FINALIZE_CONCURRENCY at the same time.
+            - the statuses of all files are written in one round trip.
+            - the chunk keys are removed and the files are unlocked at once.
+        A failed file is terminated without failing the others.
+    Parameter:
+        - accepted(list): the (OnSuccessUploadPOST, SessionJob) of each file
+        - trace_context(Context): optional, the trace context of bulk
+            on_success request, the span of job is linked to it
+    Return:
+        - None
+    """
+
+    with background_span('upload.bulk_finalize_worker', trace_context, {'upload.files': len(accepted)}):
+        await _bulk_finalize_worker(logger, accepted, boto3_client)
+
+
+async def _bulk_finalize_worker(logger, accepted: list, boto3_client):
+    redis_srv = SrvAioRedisSingleton()
+    lock_keys = [get_file_lock_key(request_payload) for request_payload, _ in accepted]
+    temp_dirs = [
+        os.path.join(ConfigClass.TEMP_BASE, request_payload.resumable_identifier) for request_payload, _ in accepted
+    ]
+    errors = {}
+
+    try:
+        # make sure the chunks are uploaded with the negotiated chunk size
+        items = []
+        for request_payload, status_mgr in accepted:
+            try:
+                validate_total_chunks(
+                    get_negotiated_chunk_size(status_mgr.payload),
+                    int(request_payload.resumable_total_size),
+                    request_payload.resumable_total_chunks,
+                )
+                items.append((request_payload, status_mgr))
+            except Exception as e:
+                errors[request_payload.resumable_identifier] = e
+
+        # the etags of all files in one round trip, the missing chunks are
+        # left for the combination to fail like the single file
+        chunk_key_groups = [
+            [
+                '%s:%s' % (request_payload.resumable_identifier, part_number)
+                for part_number in range(1, request_payload.resumable_total_chunks + 1)
+            ]
+            for request_payload, _ in items
+        ]
+        with observe_stage('etag_fetch', attributes={'upload.files': len(items)}):
+            chunk_groups = await redis_srv.mget_by_key_groups(chunk_key_groups) if items else []
+        chunks_infos = [[serializer.loads(chunk) for chunk in chunks if chunk] for chunks in chunk_groups]
+
+        # the folder tree is created once for the files in the same folder,
+        # the parent folder goes before its children
+        folder_nodes = {}
+        for folder in sorted({(p.project_code, p.operator, p.resumable_relative_path) for p, _ in items}):
+            try:
+                folder_nodes[folder] = await folder_creation(*folder, '')
+            except Exception as e:
+                logger.error('Fail to create folder %s: %s', folder, str(e))
+                folder_nodes[folder] = e
+
+        semaphore = asyncio.Semaphore(ConfigClass.BULK_FINALIZE_CONCURRENCY)
+
+        async with httpx.AsyncClient() as client:
+
+            async def finalize(request_payload, status_mgr, chunks_info):
+                folder = (
+                    request_payload.project_code,
+                    request_payload.operator,
+                    request_payload.resumable_relative_path,
+                )
+                if isinstance(folder_nodes[folder], Exception):
+                    raise folder_nodes[folder]
+                async with semaphore:
+                    return await finalize_file(
+                        logger, request_payload, status_mgr, boto3_client, chunks_info, folder_nodes[folder], client
+                    )
+
+            created_entities = await asyncio.gather(
+                *(
+                    finalize(request_payload, status_mgr, chunks_info)
+                    for (request_payload, status_mgr), chunks_info in zip(items, chunks_infos)
+                ),
+                return_exceptions=True,
+            )
+
+        succeeded, combined_keys = [], []
+        for (request_payload, status_mgr), chunk_keys, created_entity in zip(items, chunk_key_groups, created_entities):
+            if isinstance(created_entity, Exception):
+                errors[request_payload.resumable_identifier] = created_entity
+                continue
+            status_mgr.add_payload('source_geid', created_entity.get('id'))
+            succeeded.append(status_mgr)
+            combined_keys += chunk_keys + [
+                'chunk_config:%s' % request_payload.resumable_identifier,
+                get_chunk_index_key(request_payload.resumable_identifier),
+            ]
+
+        # the statuses of all files in one round trip
+        terminated = []
+        for request_payload, status_mgr in accepted:
+            error = errors.get(request_payload.resumable_identifier)
+            if error is not None:
+                logger.error('Fail to finalize %s: %s', request_payload.resumable_identifier, str(error))
+                status_mgr.add_payload('error_msg', str(error))
+                terminated.append(status_mgr)
+        transitions = await session_jobs_set_status(succeeded, EState.FINALIZED.name, EState.SUCCEED.name)
+        transitions += await session_jobs_set_status(terminated, EState.TERMINATED.name)
+        for transition in transitions:
+            if isinstance(transition, InvalidStateTransition):
+                # the job is terminated by others in the middle, e.g. the sweeper
+                logger.warning(str(transition))
+
+        if combined_keys:
+            await redis_srv.delete_by_keys(combined_keys)
+        logger.info('Bulk upload Job Done: %s succeed, %s terminated', len(succeeded), len(terminated))
+
+    except Exception as exce:
+        logger.error(str(exce))
+        for _, status_mgr in accepted:
+            status_mgr.add_payload('error_msg', str(exce))
+        await session_jobs_set_status([status_mgr for _, status_mgr in accepted], EState.TERMINATED.name)
+        raise exce
+
+    finally:
+        try:
+            await run_in_threadpool(bulk_lock_operation, lock_keys, 'write', False)
+        except Exception as e:
+            logger.error('Fail to unlock the files: %s', str(e))
+
+        # remove the zip preview if applies
+        for temp_dir in temp_dirs:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+
+
+def get_file_span_attributes(request_payload: OnSuccessUploadPOST) -> dict:
+    """get the span attributes of the file to finalize."""
+    return {
+        'upload.project_code': request_payload.project_code,
+        'upload.job_id': request_payload.resumable_identifier,
+        'upload.bytes': int(request_payload.resumable_total_size),
+        'upload.part_count': request_payload.resumable_total_chunks,
+    }
+
+
+def get_file_lock_key(request_payload: OnSuccessUploadPOST) -> str:
+    """get the lock key of the file taken by pre upload."""
+    bucket = ('gr-' if ConfigClass.namespace == 'greenroom' else 'core-') + request_payload.project_code
+    return os.path.join(bucket, request_payload.resumable_relative_path, request_payload.resumable_filename)
+
+
 # TODO seem like we can merge following two functions
 async def get_conflict_folder_paths(project_code: str, current_folder_node: str):
     """
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from prometheus_client import multiprocess
+
 workers = 4
 threads = 2
 bind = '0.0.0.0:5079'
@@ -21,4 +23,9 @@ daemon = 'false'
 worker_connections = 1200
 accesslog = 'gunicorn_access.log'
 errorlog = 'gunicorn_error.log'
-loglevel = 'debug'
+loglevel = 'info'
+
+
+def child_exit(server, worker):
+    # remove the live gauge files of the exited worker
+    multiprocess.mark_process_dead(worker.pid)
@@ -16,4 +16,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# the shared directory for prometheus metrics of ALL workers, it must be
+# emptied before start since the files of previous run are invalid
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 gunicorn -c gunicorn_config.py "run:app" -k uvicorn.workers.UvicornWorker --timeout 300
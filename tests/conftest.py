@@ -33,8 +33,12 @@ from urllib3 import HTTPResponse
 @pytest.fixture(scope='session')
 def event_loop(request):
     """Create an instance of the default event loop for each test case."""
+    from app.resources.status_broker import status_broker
+
     loop = asyncio.get_event_loop_policy().new_event_loop()
     yield loop
+    # the shared status subscriber is started by the status apis
+    loop.run_until_complete(status_broker.stop())
     loop.close()
     asyncio.set_event_loop_policy(None)
 
@@ -84,28 +88,14 @@ def create_job_folder():
 @pytest.fixture()
 async def create_fake_job(monkeypatch):
     from app.commons.data_providers.redis import SrvAioRedisSingleton
-
-    fake_job = {
-        'session_id': '1234',
-        'job_id': 'fake_global_entity_id',
-        'source': 'any',
-        'action': 'data_upload',
-        'status': 'PRE_UPLOADED',
-        'project_code': 'any',
-        'operator': 'me',
-        'progress': 0,
-        'payload': {
-            'task_id': 'fake_global_entity_id',
-            'resumable_identifier': 'fake_global_entity_id',
-            'parent_folder_geid': None,
-        },
-        'update_timestamp': '1643041439',
-    }
-
-    async def fake_return(x, y):
-        return [bytes(json.dumps(fake_job), 'utf-8')]
-
-    monkeypatch.setattr(SrvAioRedisSingleton, 'mget_by_prefix', fake_return)
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    job = SessionJob('1234', 'any', 'me', 'fake_global_entity_id')
+    job.set_source('any')
+    job.add_payload('task_id', 'fake_global_entity_id')
+    job.add_payload('resumable_identifier', 'fake_global_entity_id')
+    job.add_payload('parent_folder_geid', None)
+    await job.set_status('PRE_UPLOADED')
 
     # mock the credential
     fake_credentials = {
@@ -0,0 +1,363 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks of the hot functions which scale with the input size.
+
+The results are machine-readable json, so a run can be stored as the
+baseline and later runs compared against it. The numbers depend on the
+machine, regenerate the baseline when the hardware changes.
+
+Usage:
+    make benchmark ARGS="run --output tests/performance/baseline.json"
+    make benchmark ARGS="compare --baseline tests/performance/baseline.json"
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from zipfile import ZipFile
+
+from tests.performance.loadtest import setup_environment
+
+_DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+_MIN_ROUND_SECONDS = 0.2
+
+
+class Benchmark:
+    """
+    Summary:
+        One benchmark case. The `setup` builds the input once and returns
+        the callable to measure, the callable can be a coroutine function.
+    """
+
+    def __init__(self, name: str, setup, size: int):
+        self.name = name
+        self.setup = setup
+        self.size = size
+
+    def run(self, loop: asyncio.AbstractEventLoop, repeat: int) -> dict:
+        func = self.setup(self.size)
+        if asyncio.iscoroutinefunction(func):
+            coroutine_func = func
+
+            def func():
+                return loop.run_until_complete(coroutine_func())
+
+        # calibrate the loop count so each round is long enough to time
+        number = 1
+        while True:
+            elapsed = self._time(func, number)
+            if elapsed >= _MIN_ROUND_SECONDS or number >= 1000000:
+                break
+            number *= 10 if elapsed < _MIN_ROUND_SECONDS / 10 else 2
+
+        rounds = [self._time(func, number) / number for _ in range(repeat)]
+        return {
+            'size': self.size,
+            'loops': number,
+            'rounds': repeat,
+            'min_seconds': min(rounds),
+            'median_seconds': statistics.median(rounds),
+            'mean_seconds': statistics.mean(rounds),
+        }
+
+    @staticmethod
+    def _time(func, number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - start
+
+
+def setup_archive_preview(size: int):
+    from app.resources.helpers import generate_archive_preview
+
+    archive_path = os.path.join(tempfile.mkdtemp(prefix='upload-benchmark-'), 'preview.zip')
+    with ZipFile(archive_path, 'w') as archive:
+        for index in range(size):
+            # spread the files over a tree of 10 wide and 3 deep
+            folders = '/'.join('folder_%d' % (index // 10**level % 10) for level in range(1, 4))
+            archive.writestr('root/%s/file_%d.txt' % (folders, index), b'')
+
+    async def func():
+        return await generate_archive_preview(archive_path)
+
+    return func
+
+
+def setup_folder_create(size: int):
+    from app.models import folder
+    from app.models.folder import FolderMgr, FolderNode
+
+    async def get_folder_node(project_code, folder_name, folder_relative_path, creator, zone):
+        # only the name folder exists, the rest will be created
+        node = FolderNode.__new__(FolderNode)
+        node.__dict__.update(
+            exist=folder_relative_path == '',
+            global_entity_id='geid-%s' % folder_name,
+            folder_name=folder_name,
+            folder_level=None,
+            folder_parent_geid=None,
+            folder_parent_name=None,
+            folder_creator=creator,
+            zone=zone,
+            project_code=project_code,
+            folder_relative_path=folder_relative_path,
+        )
+        return node
+
+    folder.get_folder_node = get_folder_node
+    relative_path = '/'.join(['admin'] + ['folder_%d' % level for level in range(size)])
+
+    async def func():
+        folder_mgr = FolderMgr('benchmark', relative_path)
+        await folder_mgr.create('admin')
+        return folder_mgr.to_create
+
+    return func
+
+
+def _build_session_job(size: int):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    job = SessionJob('session', 'benchmark', 'admin', 'job-id')
+    job.set_source('admin/folder/file.txt')
+    job.add_payload('resumable_identifier', 'upload-id')
+    job.add_payload('chunk_size', 2 * 1024 * 1024)
+    job.timeline = {'STATUS_%d' % index: 1660000000000 + index for index in range(size)}
+    job.stage_durations = {'stage_%d' % index: index for index in range(size)}
+    return job
+
+
+def setup_get_kv_entity(size: int):
+    job = _build_session_job(size)
+    return job.get_kv_entity
+
+
+def setup_session_job_transition_calls(size: int):
+    from app.commons.data_providers.redis_project_session_job import _transition_calls
+
+    job = _build_session_job(size)
+    job.add_payload('items', ['item_%d' % index for index in range(size)])
+
+    def func():
+        # the job writes go through the transition script, so only the
+        # encoding of its keys and arguments is measured
+        return _transition_calls(
+            job.session_id, job.job_id, job.get_key(), ['FINALIZED', 'SUCCEED'], job._changed_fields()
+        )
+
+    return func
+
+
+def _setup_serialize_job_list(size: int, backend: str):
+    from app.commons.serializer import get_serializer
+    from app.models.base_models import APIResponse
+
+    serializer = get_serializer(backend)
+    job = _build_session_job(10)
+    _, _, record = job.get_kv_entity()
+    response = APIResponse()
+    response.result = [dict(record, job_id='job-%d' % index) for index in range(size)]
+    content = response.dict()
+    content['code'] = response.code.value
+
+    def func():
+        # the pre upload response of large folder, and the records back
+        return serializer.loads(serializer.dumps(content))
+
+    return func
+
+
+def setup_serialize_job_list_json(size: int):
+    return _setup_serialize_job_list(size, 'json')
+
+
+def setup_serialize_job_list_orjson(size: int):
+    return _setup_serialize_job_list(size, 'orjson')
+
+
+def setup_validate_message(size: int):
+    from app.commons.kafka_producer import KakfaProducer
+
+    producer = KakfaProducer()
+    message = {
+        'activity_type': 'upload',
+        'activity_time': datetime.utcnow(),
+        'item_id': 'item-id',
+        'item_type': 'file',
+        'item_name': 'n' * size,
+        'item_parent_path': 'admin/folder',
+        'container_code': 'benchmark',
+        'container_type': 'project',
+        'zone': 0,
+        'user': 'admin',
+        'imported_from': '',
+        'changes': [],
+    }
+
+    async def func():
+        return await producer._validate_message('metadata_items_activity.avsc', message)
+
+    return func
+
+
+def setup_pre_upload_parse(size: int):
+    from app.models.models_upload import PreUploadPOST
+
+    payload = {
+        'project_code': 'benchmark',
+        'operator': 'admin',
+        'job_type': 'AS_FOLDER',
+        'data': [
+            {
+                'resumable_filename': 'file_%d.txt' % index,
+                'resumable_relative_path': 'admin/folder_%d' % (index % 100),
+                'resumable_total_size': index,
+            }
+            for index in range(size)
+        ],
+    }
+
+    def func():
+        return PreUploadPOST.parse_obj(payload)
+
+    return func
+
+
+BENCHMARKS = [
+    Benchmark('archive_preview_1k', setup_archive_preview, 1000),
+    Benchmark('archive_preview_10k', setup_archive_preview, 10000),
+    Benchmark('folder_create_depth_10', setup_folder_create, 10),
+    Benchmark('folder_create_depth_100', setup_folder_create, 100),
+    Benchmark('get_kv_entity_10', setup_get_kv_entity, 10),
+    Benchmark('get_kv_entity_1k', setup_get_kv_entity, 1000),
+    Benchmark('session_job_transition_calls_10', setup_session_job_transition_calls, 10),
+    Benchmark('session_job_transition_calls_1k', setup_session_job_transition_calls, 1000),
+    Benchmark('serialize_job_list_json_10k', setup_serialize_job_list_json, 10000),
+    Benchmark('serialize_job_list_orjson_10k', setup_serialize_job_list_orjson, 10000),
+    Benchmark('kafka_validate_message', setup_validate_message, 32),
+    Benchmark('kafka_validate_message_long_name', setup_validate_message, 4096),
+    Benchmark('pre_upload_parse_10k', setup_pre_upload_parse, 10000),
+    Benchmark('pre_upload_parse_100k', setup_pre_upload_parse, 100000),
+]
+
+
+def run_benchmarks(name_filter: str = None, repeat: int = 5, stream=sys.stdout) -> dict:
+    setup_environment('http://127.0.0.1:1')
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for benchmark in BENCHMARKS:
+            if name_filter and name_filter not in benchmark.name:
+                continue
+            results[benchmark.name] = benchmark.run(loop, repeat)
+            stream.write('%-36s %12.3f us\n' % (benchmark.name, results[benchmark.name]['min_seconds'] * 1e6))
+    finally:
+        loop.close()
+
+    return {
+        'created_time': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'benchmarks': results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float, stream=sys.stdout) -> list:
+    """
+    Summary:
+        Compare each benchmark with the baseline. The fastest round is
+        compared since it is the least affected by the noise of the machine.
+    Parameter:
+        - baseline(dict): the stored result
+        - current(dict): the result of this run
+        - threshold(float): the allowed slowdown, 0.2 means 20% slower
+    Return:
+        - the names of the regressed benchmarks
+    """
+
+    regressions = []
+    for name, result in sorted(current['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            stream.write('%-36s %12.3f us %12s\n' % (name, result['min_seconds'] * 1e6, 'new'))
+            continue
+        ratio = result['min_seconds'] / base['min_seconds']
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        stream.write(
+            '%-36s %12.3f us %+11.1f%%%s\n'
+            % (name, result['min_seconds'] * 1e6, (ratio - 1) * 100, '  REGRESSION' if regressed else '')
+        )
+    return regressions
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the upload service hot functions.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', help='write the result as json, e.g. to store a new baseline')
+
+    compare_parser = subparsers.add_parser('compare', help='compare with the baseline, exit 1 on regression')
+    compare_parser.add_argument('--baseline', default=_DEFAULT_BASELINE)
+    compare_parser.add_argument('--current', help='compare a stored result instead of running the benchmarks')
+    compare_parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, default 20%%')
+
+    for sub_parser in (run_parser, compare_parser):
+        sub_parser.add_argument('--filter', help='only run the benchmarks containing the text')
+        sub_parser.add_argument('--repeat', type=int, default=5, help='rounds of each benchmark')
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(argv)
+
+    if args.command == 'run':
+        result = run_benchmarks(args.filter, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(result, output, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if args.current:
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+    else:
+        current = run_benchmarks(args.filter, args.repeat, stream=io.StringIO())
+
+    regressions = compare_results(baseline, current, args.threshold)
+    if regressions:
+        sys.stdout.write('%d benchmark(s) regressed over %d%%\n' % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hermetic end-to-end load test of the upload service.
+
+The service runs in-process against the stubs in `tests.performance.stubs`
+so a run needs neither minio, kafka nor the other pilot services. Redis is
+the only real dependency, pass `--fake-redis` to use in-memory fakeredis
+instead.
+
+Usage:
+    make loadtest ARGS="--scenario mixed --scale 2 --output report.json"
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import uuid
+from io import BytesIO
+
+from tests.performance.stubs import (
+    StubBehaviour,
+    StubHTTPServices,
+    StubKafka,
+    StubObjectStorage,
+    install_fake_redis,
+    install_stubs,
+)
+
+MB = 1024 * 1024
+_PROJECT_CODE = 'loadtest'
+_OPERATOR = 'loadtest-user'
+
+# each scenario is a list of (file count, file size, folder depth)
+SCENARIOS = {
+    'small_files': [(200, 16 * 1024, 0)],
+    'huge_files': [(2, 64 * MB, 0)],
+    'deep_folders': [(50, 256 * 1024, 20)],
+    'mixed': [(100, 16 * 1024, 0), (1, 48 * MB, 0), (20, 512 * 1024, 10)],
+}
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Run the upload flow against in-process stub services.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the file count of the scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent requests in flight')
+    parser.add_argument('--storage-latency', type=float, default=0.005)
+    parser.add_argument('--storage-error-rate', type=float, default=0.0)
+    parser.add_argument('--metadata-latency', type=float, default=0.002)
+    parser.add_argument('--metadata-error-rate', type=float, default=0.0)
+    parser.add_argument('--dataops-latency', type=float, default=0.002)
+    parser.add_argument('--dataops-error-rate', type=float, default=0.0)
+    parser.add_argument('--kafka-latency', type=float, default=0.001)
+    parser.add_argument('--kafka-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--finalize-timeout', type=float, default=300, help='seconds to wait for all jobs to finish')
+    parser.add_argument('--fake-redis', action='store_true', help='use in-memory fakeredis instead of redis server')
+    parser.add_argument('--output', help='write the report as json to the file')
+    parser.add_argument('--verbose', action='store_true', help='keep the service logging')
+    return parser.parse_args(argv)
+
+
+def setup_environment(services_url: str) -> None:
+    """point the service configuration to the stubs, must run before `app` is imported."""
+
+    root_path = tempfile.mkdtemp(prefix='upload-loadtest-')
+    defaults = {
+        'namespace': 'greenroom',
+        'ROOT_PATH': root_path,
+        'CORE_ZONE_LABEL': 'Core',
+        'GREEN_ZONE_LABEL': 'Greenroom',
+        'DATAOPS_SERVICE': services_url,
+        'METADATA_SERVICE': services_url,
+        'PROJECT_SERVICE': services_url,
+        'S3_INTERNAL': '127.0.0.1:9000',
+        'S3_ACCESS_KEY': 'loadtest',
+        'S3_SECRET_KEY': 'loadtest',
+        'REDIS_HOST': 'localhost',
+        'REDIS_PORT': '6379',
+        'REDIS_DB': '0',
+        'REDIS_PASSWORD': '',
+        'KAFKA_URL': '127.0.0.1:9092',
+        'CONFIG_CENTER_ENABLED': 'false',
+        'OPEN_TELEMETRY_ENABLED': 'false',
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    # the stubs must always win over any existing service configuration
+    for key in ('DATAOPS_SERVICE', 'METADATA_SERVICE', 'PROJECT_SERVICE'):
+        os.environ[key] = services_url
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(percent / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class LoadTestRunner:
+    """
+    Summary:
+        Drive the whole upload flow for every file of the scenario:
+            1. pre upload with the file size to negotiate the chunk size
+            2. upload all chunks
+            3. signal the finalize with the on success api
+            4. poll the job status until SUCCEED or TERMINATED
+    """
+
+    def __init__(self, client, files: list, concurrency: int, finalize_timeout: float):
+        self.client = client
+        self.files = files
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.finalize_timeout = finalize_timeout
+        self.latencies = {}
+        self.status_codes = {}
+        self.finalize_durations = []
+        self.job_status = {}
+        self.chunks_uploaded = 0
+        self.bytes_uploaded = 0
+        self._random_block = b''
+
+    def _payload(self, size: int) -> bytes:
+        # random bytes like the real files, a repeated byte is a
+        # pathological input for the multipart parser
+        if len(self._random_block) < size:
+            self._random_block = os.urandom(size)
+        return self._random_block[:size]
+
+    async def _request(self, endpoint: str, method: str, path: str, **kwargs):
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                response = await getattr(self.client, method)(path, **kwargs)
+                status_code = response.status_code
+            # the in-process client re-raises the unhandled exceptions,
+            # including the ones from the background tasks, which the
+            # server would log and answer with 500
+            except Exception:
+                response, status_code = None, 500
+            self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        codes = self.status_codes.setdefault(endpoint, {})
+        codes[status_code] = codes.get(status_code, 0) + 1
+        return response
+
+    async def upload_file(self, session_id: str, relative_path: str, file_name: str, file_size: int) -> None:
+        headers = {'Session-Id': session_id}
+        response = await self._request(
+            'pre_upload',
+            'post',
+            '/v1/files/jobs',
+            headers=headers,
+            json={
+                'project_code': _PROJECT_CODE,
+                'operator': _OPERATOR,
+                'job_type': 'AS_FILE',
+                'data': [
+                    {
+                        'resumable_filename': file_name,
+                        'resumable_relative_path': relative_path,
+                        'resumable_total_size': file_size,
+                    }
+                ],
+                'negotiate_chunk_size': True,
+                'single_upload': True,
+            },
+        )
+        if response is None or response.status_code != 200:
+            self.job_status[file_name] = 'PRE_UPLOAD_FAILED'
+            return
+
+        job = response.json()['result'][0]
+        job_id = job['job_id']
+        if job['payload'].get('upload_mode') == 'SINGLE':
+            await self.upload_single_file(headers, job, relative_path, file_name, file_size)
+            return
+
+        chunk_size = job['payload'].get('chunk_size') or 2 * MB
+        total_chunks = max(1, math.ceil(file_size / chunk_size))
+
+        async def upload_chunk(chunk_number: int) -> int:
+            size = min(chunk_size, file_size - (chunk_number - 1) * chunk_size)
+            chunk_response = await self._request(
+                'chunks',
+                'post',
+                '/v1/files/chunks',
+                headers=headers,
+                files={
+                    'project_code': _PROJECT_CODE,
+                    'operator': _OPERATOR,
+                    'resumable_identifier': job['payload']['resumable_identifier'],
+                    'resumable_filename': file_name,
+                    'resumable_relative_path': relative_path,
+                    'resumable_chunk_number': str(chunk_number),
+                    'resumable_total_chunks': str(total_chunks),
+                    'resumable_total_size': str(file_size),
+                    'chunk_data': ('chunk', BytesIO(self._payload(size)), 'application/octet-stream'),
+                },
+            )
+            if chunk_response is None:
+                return 500
+            if chunk_response.status_code == 200:
+                self.chunks_uploaded += 1
+                self.bytes_uploaded += size
+            return chunk_response.status_code
+
+        codes = await asyncio.gather(*[upload_chunk(n) for n in range(1, total_chunks + 1)])
+        if any(code != 200 for code in codes):
+            self.job_status[job_id] = 'CHUNK_FAILED'
+            return
+
+        finalize_start = time.perf_counter()
+        response = await self._request(
+            'on_success',
+            'post',
+            '/v1/files',
+            headers=headers,
+            json={
+                'project_code': _PROJECT_CODE,
+                'operator': _OPERATOR,
+                'resumable_identifier': job['payload']['resumable_identifier'],
+                'resumable_filename': file_name,
+                'resumable_relative_path': relative_path,
+                'resumable_total_chunks': total_chunks,
+                'resumable_total_size': file_size,
+            },
+        )
+        # no response means the finalize worker raised in the background,
+        # the job status will still tell the outcome
+        if response is not None and response.status_code != 200:
+            self.job_status[job_id] = 'ON_SUCCESS_FAILED'
+            return
+
+        deadline = finalize_start + self.finalize_timeout
+        while time.perf_counter() < deadline:
+            response = await self._request('status', 'get', '/v1/upload/status/%s' % job_id, headers=headers)
+            job = response.json().get('result', {}) if response and response.status_code == 200 else {}
+            status = job.get('status')
+            if status in ('SUCCEED', 'TERMINATED'):
+                # prefer the server side timeline so the queueing of the
+                # status polling does not count into the finalize duration
+                timeline = job.get('timeline', {})
+                if 'CHUNK_UPLOADED' in timeline and status in timeline:
+                    duration = (timeline[status] - timeline['CHUNK_UPLOADED']) / 1000
+                else:
+                    duration = time.perf_counter() - finalize_start
+                self.finalize_durations.append(duration)
+                self.job_status[job_id] = status
+                return
+            await asyncio.sleep(0.05)
+        self.job_status[job_id] = 'TIMEOUT'
+
+    async def upload_single_file(
+        self, headers: dict, job: dict, relative_path: str, file_name: str, file_size: int
+    ) -> None:
+        # the small file is uploaded and finalized in one request
+        response = await self._request(
+            'single',
+            'post',
+            '/v1/files/single',
+            headers=headers,
+            files={
+                'project_code': _PROJECT_CODE,
+                'operator': _OPERATOR,
+                'resumable_identifier': job['payload']['resumable_identifier'],
+                'resumable_filename': file_name,
+                'resumable_relative_path': relative_path,
+                'resumable_total_size': str(file_size),
+                'file_data': ('file', BytesIO(self._payload(file_size)), 'application/octet-stream'),
+            },
+        )
+        if response is None or response.status_code != 200:
+            self.job_status[job['job_id']] = 'SINGLE_FAILED'
+            return
+
+        self.chunks_uploaded += 1
+        self.bytes_uploaded += file_size
+        job = response.json()['result']
+        timeline = job.get('timeline', {})
+        if 'CHUNK_UPLOADED' in timeline and job['status'] in timeline:
+            self.finalize_durations.append((timeline[job['status']] - timeline['CHUNK_UPLOADED']) / 1000)
+        self.job_status[job['job_id']] = job['status']
+
+    async def run(self) -> float:
+        session_id = 'loadtest-%s' % uuid.uuid4().hex[:8]
+        start = time.perf_counter()
+        await asyncio.gather(*[self.upload_file(session_id, *item) for item in self.files])
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint, values in self.latencies.items():
+            endpoints[endpoint] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'status_codes': {str(k): v for k, v in self.status_codes[endpoint].items()},
+            }
+
+        outcomes = {}
+        for status in self.job_status.values():
+            outcomes[status] = outcomes.get(status, 0) + 1
+
+        return {
+            'files': len(self.files),
+            'elapsed_seconds': round(elapsed, 3),
+            'chunks_per_second': round(self.chunks_uploaded / elapsed, 2) if elapsed else 0,
+            'megabytes_per_second': round(self.bytes_uploaded / MB / elapsed, 2) if elapsed else 0,
+            'endpoints': endpoints,
+            'finalize': {
+                'count': len(self.finalize_durations),
+                'p50_ms': round(percentile(self.finalize_durations, 50) * 1000, 2),
+                'p99_ms': round(percentile(self.finalize_durations, 99) * 1000, 2),
+            },
+            'outcomes': outcomes,
+        }
+
+
+def build_files(scenario: str, scale: float) -> list:
+    """expand the scenario into (relative path, file name, file size) items."""
+
+    files = []
+    for group, (count, size, depth) in enumerate(SCENARIOS[scenario]):
+        for index in range(max(1, int(count * scale))):
+            folders = ['level_%d' % level for level in range(depth)]
+            relative_path = '/'.join([_OPERATOR] + folders)
+            files.append((relative_path, 'file_%d_%d.bin' % (group, index), size))
+    return files
+
+
+def print_report(report: dict, stream=sys.stdout) -> None:
+    stream.write(
+        'files: %(files)s  elapsed: %(elapsed_seconds)ss  chunks/s: %(chunks_per_second)s  '
+        'MB/s: %(megabytes_per_second)s\n' % report
+    )
+    for endpoint, stats in sorted(report['endpoints'].items()):
+        stream.write(
+            '  %-12s count=%-6s p50=%8.2fms p99=%8.2fms codes=%s\n'
+            % (endpoint, stats['count'], stats['p50_ms'], stats['p99_ms'], stats['status_codes'])
+        )
+    finalize = report['finalize']
+    stream.write(
+        '  %-12s count=%-6s p50=%8.2fms p99=%8.2fms\n'
+        % ('finalize', finalize['count'], finalize['p50_ms'], finalize['p99_ms'])
+    )
+    stream.write('  outcomes: %s\n' % report['outcomes'])
+
+
+async def main(args: argparse.Namespace) -> dict:
+    services = StubHTTPServices(
+        metadata=StubBehaviour(args.metadata_latency, args.metadata_error_rate, args.seed),
+        dataops=StubBehaviour(args.dataops_latency, args.dataops_error_rate, args.seed),
+        lock=StubBehaviour(args.dataops_latency, args.dataops_error_rate, args.seed),
+    )
+    services.start()
+    setup_environment(services.url)
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    # the app reads the configuration on import
+    from async_asgi_testclient import TestClient
+
+    from app.main import create_app
+
+    object_storage = StubObjectStorage(StubBehaviour(args.storage_latency, args.storage_error_rate, args.seed))
+    kafka = StubKafka(StubBehaviour(args.kafka_latency, args.kafka_error_rate, args.seed))
+    install_stubs(object_storage, kafka)
+    if args.fake_redis:
+        install_fake_redis()
+
+    try:
+        files = build_files(args.scenario, args.scale)
+        async with TestClient(create_app()) as client:
+            runner = LoadTestRunner(client, files, args.concurrency, args.finalize_timeout)
+            elapsed = await runner.run()
+        report = runner.report(elapsed)
+        report['scenario'] = args.scenario
+        report['stub_requests'] = dict(services.request_count, kafka=kafka.messages)
+        return report
+    finally:
+        services.stop()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    result = asyncio.run(main(arguments))
+    print_report(result)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(result, output, indent=2)
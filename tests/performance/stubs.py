@@ -0,0 +1,303 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process stand-ins for the services the upload service depends on.
+
+Each stub takes a `StubBehaviour` so the latency and the error rate of
+every dependency can be tuned independently. The HTTP stubs run in a
+background thread so the sync `httpx.Client` calls made by the service
+on the event loop do not deadlock.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from zipfile import ZipFile
+
+
+class StubError(Exception):
+    pass
+
+
+class StubBehaviour:
+    """Latency and error injection for one stubbed dependency."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def wait_sync(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    async def wait(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class StubHTTPServices:
+    """
+    Summary:
+        One HTTP server which serves the api of project service, metadata
+        service(`items/search`, `items/batch`) and dataops service(`filedata`,
+        `archive`, `resource/lock`). The behaviour is chosen by the service
+        that owns the route.
+    """
+
+    def __init__(
+        self,
+        metadata: StubBehaviour = None,
+        dataops: StubBehaviour = None,
+        lock: StubBehaviour = None,
+        project: StubBehaviour = None,
+    ):
+        self.behaviours = {
+            'metadata': metadata or StubBehaviour(),
+            'dataops': dataops or StubBehaviour(),
+            'lock': lock or StubBehaviour(),
+            'project': project or StubBehaviour(),
+        }
+        self.request_count = {}
+        self._count_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, route: str) -> None:
+        with self._count_lock:
+            self.request_count[route] = self.request_count.get(route, 0) + 1
+
+    def handle(self, method: str, path: str, body: dict) -> tuple:
+        """return the status code and json body for the request."""
+
+        path, _, query = path.partition('?')
+        params = parse_qs(query)
+        if path.startswith('/v1/projects/'):
+            service, route = 'project', 'projects'
+            result = {'id': str(uuid.uuid4()), 'code': path.rsplit('/', 1)[-1]}
+        elif path.startswith('/v1/items/search'):
+            # only the name folder exists, so there is never a conflict and
+            # every sub folder will be created by the upload
+            service, route, result = 'metadata', 'items/search', []
+            if 'parent_path' not in params:
+                result = [
+                    {
+                        'id': str(uuid.uuid4()),
+                        'name': params['name'][0],
+                        'owner': params['name'][0],
+                        'parent_path': '',
+                        'container_code': params.get('container_code', [''])[0],
+                    }
+                ]
+        elif path.startswith('/v1/items/batch'):
+            service, route, result = 'metadata', 'items/batch', body.get('items', [])
+        elif path.startswith('/v1/filedata'):
+            service, route = 'dataops', 'filedata'
+            result = {
+                'id': str(uuid.uuid4()),
+                'type': 'file',
+                'name': body.get('file_name'),
+                'parent_path': body.get('path'),
+                'container_code': body.get('project_code'),
+                'container_type': 'project',
+                'zone': 0 if body.get('namespace') == 'greenroom' else 1,
+            }
+        elif path.startswith('/v1/archive'):
+            service, route, result = 'dataops', 'archive', {}
+        elif path.startswith('/v2/resource/lock'):
+            service, route, result = 'lock', method + ' ' + path.strip('/').split('/', 1)[1], {}
+        else:
+            return 404, {'error_msg': 'not found'}
+
+        self._count(route)
+        behaviour = self.behaviours[service]
+        behaviour.wait_sync()
+        if behaviour.should_fail():
+            return 500, {'error_msg': 'injected %s error' % service}
+        # project service returns the project itself rather than an envelope
+        if service == 'project':
+            return 200, result
+        return 200, {'code': 200, 'result': result}
+
+    def _get_handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = json.loads(raw) if raw else {}
+                status, content = services.handle(self.command, self.path, body)
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _reply
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StubObjectStorage:
+    """
+    Summary:
+        Replacement of the `Boto3Client` multipart api. It only keeps the
+        size and etag of each part, so large uploads do not hold memory.
+    """
+
+    def __init__(self, behaviour: StubBehaviour = None):
+        self.behaviour = behaviour or StubBehaviour()
+        self.uploads = {}
+        self.objects = {}
+
+    async def _call(self, operation: str) -> None:
+        await self.behaviour.wait()
+        if self.behaviour.should_fail():
+            raise StubError('injected object storage error in %s' % operation)
+
+    async def prepare_multipart_upload(self, bucket: str, keys: list) -> list:
+        await self._call('prepare_multipart_upload')
+        upload_ids = []
+        for key in keys:
+            upload_id = str(uuid.uuid4())
+            self.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {}}
+            upload_ids.append(upload_id)
+        return upload_ids
+
+    async def part_upload(self, bucket: str, key: str, upload_id: str, part_number: int, content: bytes) -> dict:
+        await self._call('part_upload')
+        etag = hashlib.md5(content).hexdigest()
+        self.uploads[upload_id]['parts'][part_number] = (etag, len(content))
+        return {'ETag': etag, 'PartNumber': part_number}
+
+    async def combine_chunks(self, bucket: str, key: str, upload_id: str, parts: list) -> dict:
+        await self._call('combine_chunks')
+        upload = self.uploads.pop(upload_id)
+        for part in parts:
+            etag, _ = upload['parts'][part['PartNumber']]
+            if etag != part['ETag']:
+                raise StubError('etag mismatch for part %s' % part['PartNumber'])
+        self.objects[(bucket, key)] = sum(size for _, size in upload['parts'].values())
+        return {'VersionId': str(uuid.uuid4())}
+
+    async def put_object(self, bucket: str, key: str, content: bytes) -> dict:
+        await self._call('put_object')
+        self.objects[(bucket, key)] = len(content)
+        return {'VersionId': str(uuid.uuid4())}
+
+    async def downlaod_object(self, bucket: str, key: str, local_path: str) -> None:
+        await self._call('downlaod_object')
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with ZipFile(local_path, 'w') as archive:
+            archive.writestr('folder/file.txt', b'stub')
+
+
+class StubKafka:
+    """Replacement of the `AIOKafkaProducer` used by `KakfaProducer`."""
+
+    def __init__(self, behaviour: StubBehaviour = None):
+        self.behaviour = behaviour or StubBehaviour()
+        self.messages = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def send_and_wait(self, topic: str, content: bytes) -> None:
+        await self.behaviour.wait()
+        if self.behaviour.should_fail():
+            raise StubError('injected kafka error')
+        self.messages += 1
+
+
+def install_stubs(object_storage: StubObjectStorage, kafka: StubKafka) -> None:
+    """
+    Summary:
+        Plug the object storage and kafka stubs into the service. The app
+        modules must be imported AFTER the environment points the http
+        services to `StubHTTPServices.url`.
+    """
+
+    from app.commons import kafka_producer
+    from app.routers.v1 import api_data_upload
+
+    async def get_stub_boto3_client(*args, **kwargs):
+        return object_storage
+
+    async def put_stub_object(boto3_client, bucket: str, key: str, content: bytes) -> dict:
+        return await boto3_client.put_object(bucket, key, content)
+
+    api_data_upload.get_boto3_client = get_stub_boto3_client
+    api_data_upload.put_object = put_stub_object
+    kafka_producer.kakfa_producer.producer = kafka
+    kafka_producer.kakfa_producer.connected = True
+
+
+def install_fake_redis():
+    """
+    Summary:
+        Replace the redis connection of the service and the project client
+        with in-memory fakeredis, so the harness does not need redis server.
+    Return:
+        - the fake redis instance
+    """
+
+    import fakeredis.aioredis
+    from common import ProjectClient
+
+    from app.commons.data_providers import redis
+
+    fake_redis = fakeredis.aioredis.FakeRedis()
+    redis.REDIS_INSTANCE = fake_redis
+
+    async def connect_fake_redis(self):
+        self.redis = fake_redis
+
+    ProjectClient.connect_redis = connect_fake_redis
+
+    return fake_redis
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
 import pytest
 
 from app.config import ConfigClass
@@ -28,3 +30,236 @@ async def test_root_request_should_return_app_status(test_async_client):
         'name': ConfigClass.APP_NAME,
         'version': ConfigClass.VERSION,
     }
+
+
+@pytest.mark.asyncio
+async def test_capacity_should_return_chunk_admission_usage(test_async_client):
+    response = await test_async_client.get('/v1/upload/capacity')
+    assert response.status_code == 200
+    result = response.json()
+    assert result['inflight_requests'] == 0
+    assert result['inflight_bytes'] == 0
+    assert result['max_concurrency'] == ConfigClass.CHUNK_ADMISSION_MAX_CONCURRENCY
+    assert result['max_inflight_bytes'] == ConfigClass.CHUNK_ADMISSION_MAX_BYTES
+
+
+@pytest.mark.asyncio
+async def test_metrics_should_return_stage_histograms_in_prometheus_format(test_async_client):
+    from app.resources.metrics import observe_stage
+
+    with observe_stage('part_upload'):
+        pass
+
+    response = await test_async_client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert 'upload_stage_duration_seconds_count{outcome="success",stage="part_upload"}' in response.text
+
+
+class FakeS3:
+    def __init__(self, uploads: dict):
+        self.uploads = uploads
+        self.aborted = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def list_buckets(self):
+        return {'Buckets': [{'Name': name} for name in self.uploads]}
+
+    async def list_multipart_uploads(self, Bucket, **kwargs):
+        return {'Uploads': self.uploads[Bucket], 'IsTruncated': False}
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+@pytest.fixture
+async def fake_multipart_uploads(monkeypatch):
+    from datetime import datetime, timedelta, timezone
+
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+    from app.resources import multipart_reaper
+
+    monkeypatch.setattr(ConfigClass, 'MULTIPART_REAPER_ADMIN_TOKEN', 'secret')
+    for job_id, status in (('running_upload', EState.PRE_UPLOADED), ('terminated_upload', EState.TERMINATED)):
+        status_mgr = SessionJob('1234', 'any', 'me', job_id)
+        status_mgr.set_source('me/%s.txt' % job_id.split('_')[0])
+        await status_mgr.set_status(status.name)
+
+    stale_time = datetime.now(timezone.utc) - timedelta(seconds=ConfigClass.MULTIPART_UPLOAD_MAX_AGE + 60)
+    # the job record of this upload has expired
+    expired_time = datetime.now(timezone.utc) - timedelta(
+        seconds=max(ConfigClass.MULTIPART_UPLOAD_MAX_AGE, ConfigClass.JOB_RECORD_TTL) + 60
+    )
+    fake_s3 = FakeS3(
+        {
+            'core-any': [
+                {'Key': 'me/running.txt', 'UploadId': 'running_upload', 'Initiated': stale_time},
+                {'Key': 'me/terminated.txt', 'UploadId': 'terminated_upload', 'Initiated': stale_time},
+                {'Key': 'me/orphan.txt', 'UploadId': 'orphan_upload', 'Initiated': stale_time},
+                {'Key': 'me/new.txt', 'UploadId': 'new_upload', 'Initiated': datetime.now(timezone.utc)},
+                {'Key': 'me/expired.txt', 'UploadId': 'expired_upload', 'Initiated': expired_time},
+            ],
+            'gr-any': [{'Key': 'me/other_zone.txt', 'UploadId': 'other_zone_upload', 'Initiated': stale_time}],
+        }
+    )
+
+    async def get_fake_boto3_client(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(multipart_reaper, 'get_boto3_client', get_fake_boto3_client)
+    monkeypatch.setattr(multipart_reaper, 'get_s3_client', lambda boto3_client: fake_s3)
+    return fake_s3
+
+
+@pytest.mark.asyncio
+async def test_reap_multipart_uploads_should_return_403_without_admin_token(test_async_client, fake_multipart_uploads):
+    response = await test_async_client.post(
+        '/v1/upload/multipart/reap', headers={'Admin-Token': 'wrong'}, query_string={'dry_run': False}
+    )
+    assert response.status_code == 403
+    assert fake_multipart_uploads.aborted == []
+
+
+@pytest.mark.asyncio
+async def test_reap_multipart_uploads_dry_run_should_only_report_stale_uploads(
+    test_async_client, fake_multipart_uploads
+):
+    response = await test_async_client.post(
+        '/v1/upload/multipart/reap', headers={'Admin-Token': 'secret'}, query_string={'dry_run': True}
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result['checked'] == 5
+    assert result['unknown'] == 3
+    assert result['stale'] == 2
+    assert result['aborted'] == 0
+    assert [upload['upload_id'] for upload in result['uploads']] == ['terminated_upload', 'expired_upload']
+    assert fake_multipart_uploads.aborted == []
+
+
+@pytest.mark.asyncio
+async def test_reap_multipart_uploads_should_abort_stale_uploads_and_unlock_file(
+    test_async_client, httpx_mock, fake_multipart_uploads
+):
+    for resource_key in ('core-any/me/terminated.txt', 'core-any/me/expired.txt'):
+        httpx_mock.add_response(
+            method='DELETE',
+            url='http://DATAOPS_SERVICE/v2/resource/lock/',
+            match_content=json.dumps({'resource_key': resource_key, 'operation': 'write'}).encode(),
+            json={},
+        )
+
+    response = await test_async_client.post(
+        '/v1/upload/multipart/reap', headers={'Admin-Token': 'secret'}, query_string={'dry_run': False}
+    )
+    assert response.status_code == 200
+    assert response.json()['aborted'] == 2
+    assert fake_multipart_uploads.aborted == ['terminated_upload', 'expired_upload']
+
+
+@pytest.mark.asyncio
+async def test_reap_multipart_uploads_should_keep_lock_of_file_uploaded_by_running_job(
+    test_async_client, httpx_mock, fake_multipart_uploads
+):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    for job_id, source in (('reupload', 'me/terminated.txt'), ('expired_reupload', 'me/expired.txt')):
+        status_mgr = SessionJob('1234', 'any', 'me', job_id)
+        status_mgr.set_source(source)
+        await status_mgr.set_status(EState.PRE_UPLOADED.name)
+
+    response = await test_async_client.post(
+        '/v1/upload/multipart/reap', headers={'Admin-Token': 'secret'}, query_string={'dry_run': False}
+    )
+    assert response.status_code == 200
+    assert fake_multipart_uploads.aborted == ['terminated_upload', 'expired_upload']
+    assert httpx_mock.get_requests() == []
+
+
+@pytest.mark.asyncio
+async def test_profile_should_return_403_without_admin_token(test_async_client, monkeypatch):
+    monkeypatch.setattr(ConfigClass, 'PROFILING_ADMIN_TOKEN', 'secret')
+
+    response = await test_async_client.post('/v1/upload/profile', headers={'Admin-Token': 'wrong'})
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_profile_cpu_should_return_folded_thread_and_task_stacks(test_async_client, monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(ConfigClass, 'PROFILING_ADMIN_TOKEN', 'secret')
+
+    async def waiting_task():
+        await asyncio.sleep(10)
+
+    task = asyncio.create_task(waiting_task())
+    response = await test_async_client.post(
+        '/v1/upload/profile', headers={'Admin-Token': 'secret'}, query_string={'mode': 'cpu', 'seconds': 0.2}
+    )
+    task.cancel()
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result['mode'] == 'cpu'
+    assert result['samples'] > 0
+    assert any(stack.startswith('thread:MainThread;') for stack in result['thread_stacks'])
+    assert any('waiting_task (tests/routers/test_app_root.py:' in stack for stack in result['task_stacks'])
+
+
+@pytest.mark.asyncio
+async def test_profile_memory_should_return_locations_of_memory_growth(test_async_client, monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(ConfigClass, 'PROFILING_ADMIN_TOKEN', 'secret')
+    buffered_chunks = []
+
+    async def growing_task():
+        while True:
+            buffered_chunks.append(bytearray(64 * 1024))
+            await asyncio.sleep(0.01)
+
+    task = asyncio.create_task(growing_task())
+    response = await test_async_client.post(
+        '/v1/upload/profile', headers={'Admin-Token': 'secret'}, query_string={'mode': 'memory', 'seconds': 0.3}
+    )
+    task.cancel()
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result['mode'] == 'memory'
+    assert result['growth'][0]['location'].startswith('tests/routers/test_app_root.py:')
+    assert result['growth'][0]['size_diff'] > 0
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_should_log_stack_when_loop_is_blocked(mocker):
+    import asyncio
+    import time
+
+    from prometheus_client import REGISTRY
+
+    from app.resources import loop_monitor
+
+    warning = mocker.patch.object(loop_monitor._logger, 'warning')
+    blocked_count = REGISTRY.get_sample_value('upload_event_loop_blocked_total')
+    lag_count = REGISTRY.get_sample_value('upload_event_loop_lag_seconds_count')
+
+    def blocking_call():
+        time.sleep(0.3)
+
+    monitor = loop_monitor.LoopMonitor(0.01, 0.1)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    blocking_call()
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+
+    assert REGISTRY.get_sample_value('upload_event_loop_blocked_total') - blocked_count == 1
+    assert REGISTRY.get_sample_value('upload_event_loop_lag_seconds_count') > lag_count
+    assert 'in blocking_call' in warning.call_args[0][2]
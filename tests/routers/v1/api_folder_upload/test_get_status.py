@@ -14,7 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import json
+import time
+
 import pytest
+from aioredis import StrictRedis
+from starlette.config import environ
 
 pytestmark = pytest.mark.asyncio  # set the mark to all tests in this file.
 
@@ -46,3 +52,368 @@ async def test_get_files_jobs_return_200_and_job_data_in_results(test_async_clie
     assert result['operator'] == 'me'
     assert result['payload']['task_id'] == 'fake_global_entity_id'
     assert result['payload']['resumable_identifier'] == 'fake_global_entity_id'
+
+
+async def test_get_files_jobs_return_timeline_of_status_transitions(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'timeline_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+    status_mgr.stage_durations['combine'] = 10
+    await status_mgr.set_status(EState.FINALIZED.name)
+    await status_mgr.set_status(EState.SUCCEED.name)
+
+    response = await test_async_client.get(
+        '/v1/upload/status/timeline_job_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    assert response.status_code == 200
+    result = response.json()['result']
+    assert result['status'] == 'SUCCEED'
+    assert list(result['timeline']) == ['PRE_UPLOADED', 'CHUNK_UPLOADED', 'FINALIZED', 'SUCCEED']
+    assert result['timeline']['PRE_UPLOADED'] <= result['timeline']['SUCCEED']
+    assert result['stage_durations'] == {'combine': 10}
+
+
+async def test_stream_status_return_400_when_session_id_header_is_missing(test_async_client, httpx_mock):
+    response = await test_async_client.get('/v1/upload/events', query_string={})
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'session_id is required'
+
+
+async def test_stream_status_push_current_and_changed_status_until_finished(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'stream_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+
+    response = await test_async_client.get(
+        '/v1/upload/events', headers={'Session-Id': '1234'}, query_string={'until_finished': True}, stream=True
+    )
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+
+    await status_mgr.set_status(EState.TERMINATED.name)
+    content = b''
+    async for chunk in response.iter_content(1024):
+        content += chunk
+
+    events = [event for event in content.decode().split('\n\n') if event]
+    assert [json.loads(event.split('data: ')[1])['status'] for event in events] == ['PRE_UPLOADED', 'TERMINATED']
+    assert all(event.startswith('event: status\n') for event in events)
+
+
+async def test_stream_status_until_finished_should_close_stream_of_session_without_job(test_async_client, httpx_mock):
+    response = await test_async_client.get(
+        '/v1/upload/events', headers={'Session-Id': 'empty_session'}, query_string={'until_finished': True}, stream=True
+    )
+    assert response.status_code == 200
+
+    content = b''
+    async for chunk in response.iter_content(1024):
+        content += chunk
+    assert content == b''
+
+
+async def create_session_jobs(count: int, session_id: str = '1234') -> None:
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    for index in range(count):
+        status_mgr = SessionJob(session_id, 'any', 'me', 'batch_job_%d' % index)
+        status_mgr.set_source('file_%d' % index)
+        await status_mgr.set_status(EState.PRE_UPLOADED.name)
+        if index % 2:
+            for status in (EState.CHUNK_UPLOADED, EState.FINALIZED, EState.SUCCEED):
+                await status_mgr.set_status(status.name)
+
+
+async def test_query_status_return_session_jobs_page_by_page(test_async_client, httpx_mock):
+    await create_session_jobs(5)
+    await create_session_jobs(1, session_id='other_session')
+
+    job_ids, cursor = [], 0
+    while cursor is not None:
+        response = await test_async_client.post(
+            '/v1/upload/status', headers={'Session-Id': '1234'}, json={'cursor': cursor, 'page_size': 2}
+        )
+        assert response.status_code == 200
+        result = response.json()['result']
+        assert len(result['jobs']) <= 2
+        job_ids += [job['job_id'] for job in result['jobs']]
+        cursor = result['next_cursor']
+
+    assert job_ids == ['batch_job_%d' % index for index in range(5)]
+
+
+async def test_query_status_filter_jobs_by_ids_and_status_with_projection(test_async_client, httpx_mock):
+    await create_session_jobs(5)
+
+    response = await test_async_client.post(
+        '/v1/upload/status',
+        headers={'Session-Id': '1234'},
+        json={
+            'job_ids': ['batch_job_0', 'batch_job_1', 'batch_job_3', 'not_exist'],
+            'status': ['SUCCEED'],
+            'fields': ['status', 'source'],
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()['result'] == {
+        'jobs': [
+            {'job_id': 'batch_job_1', 'source': 'file_1', 'status': 'SUCCEED'},
+            {'job_id': 'batch_job_3', 'source': 'file_3', 'status': 'SUCCEED'},
+        ],
+        'next_cursor': None,
+    }
+
+
+async def test_query_status_return_400_when_status_is_invalid(test_async_client, httpx_mock):
+    response = await test_async_client.post(
+        '/v1/upload/status', headers={'Session-Id': '1234'}, json={'status': ['DONE']}
+    )
+    assert response.status_code == 400
+    assert response.json()['error_msg'].startswith("Invalid status ['DONE']")
+
+
+async def test_get_files_jobs_return_304_when_etag_is_not_changed(test_async_client, httpx_mock, create_fake_job):
+    response = await test_async_client.get(
+        '/v1/upload/status/fake_global_entity_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = await test_async_client.get(
+        '/v1/upload/status/fake_global_entity_id',
+        headers={'Session-Id': '1234', 'If-None-Match': etag},
+        query_string={},
+    )
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.content == b''
+
+
+async def test_get_files_jobs_wait_return_changed_job_before_timeout(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'long_poll_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    response = await test_async_client.get(
+        '/v1/upload/status/long_poll_job_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    etag = response.headers['ETag']
+
+    long_poll = asyncio.create_task(
+        test_async_client.get(
+            '/v1/upload/status/long_poll_job_id',
+            headers={'Session-Id': '1234', 'If-None-Match': etag},
+            query_string={'wait': 10},
+        )
+    )
+    await asyncio.sleep(0.2)
+    assert not long_poll.done()
+    await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+
+    response = await asyncio.wait_for(long_poll, 5)
+    assert response.status_code == 200
+    assert response.json()['result']['status'] == 'CHUNK_UPLOADED'
+    assert response.headers['ETag'] != etag
+
+
+async def test_get_files_jobs_wait_should_share_one_redis_subscription_between_clients(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import (
+        EState,
+        SessionJob,
+        get_status_channel,
+    )
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'shared_poll_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    response = await test_async_client.get(
+        '/v1/upload/status/shared_poll_job_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    etag = response.headers['ETag']
+
+    long_polls = [
+        asyncio.create_task(
+            test_async_client.get(
+                '/v1/upload/status/shared_poll_job_id',
+                headers={'Session-Id': '1234', 'If-None-Match': etag},
+                query_string={'wait': 10},
+            )
+        )
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0.2)
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    assert await cache.pubsub_numsub(get_status_channel('1234')) == [(get_status_channel('1234').encode(), 1)]
+    await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+
+    responses = await asyncio.wait_for(asyncio.gather(*long_polls), 5)
+    assert [response.json()['result']['status'] for response in responses] == ['CHUNK_UPLOADED'] * 3
+    assert await cache.pubsub_numsub(get_status_channel('1234')) == [(get_status_channel('1234').encode(), 0)]
+
+
+async def test_finished_job_record_expires_after_job_record_ttl(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+    from app.config import ConfigClass
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'ttl_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    job_key, _, _ = status_mgr.get_kv_entity()
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    assert await cache.ttl(job_key) == -1
+
+    await status_mgr.set_status(EState.TERMINATED.name)
+    assert 0 < await cache.ttl(job_key) <= ConfigClass.JOB_RECORD_TTL
+
+
+async def test_sweeper_terminate_abandoned_job_and_delete_chunk_keys(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+    from app.config import ConfigClass
+    from app.resources.job_sweeper import JobSweeper
+
+    httpx_mock.add_response(method='DELETE', url='http://DATAOPS_SERVICE/v2/resource/lock/', json={})
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    for job_id in ('abandoned_job_id', 'active_job_id'):
+        status_mgr = SessionJob('1234', 'any', 'me', job_id)
+        status_mgr.set_source('any/%s' % job_id)
+        await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    now = time.time() + 7200
+    # the chunks of abandoned job were uploaded two hours ago, the second
+    # chunk is newer than the first one
+    chunk = json.dumps({'ETag': 'etag', 'PartNumber': 1})
+    for chunk_number, uploaded_at in ((1, now - 7300), (2, now - 7200)):
+        chunk_key = 'abandoned_job_id:%d' % chunk_number
+        await cache.set(chunk_key, chunk, ex=ConfigClass.CHUNK_KEY_TTL)
+        await cache.zadd('chunk_index:abandoned_job_id', {chunk_key: uploaded_at})
+    await cache.set('chunk_config:abandoned_job_id', json.dumps({'chunk_size': 1}))
+    # the first chunk of active job is old but the second one is just uploaded
+    for chunk_number, uploaded_at in ((1, now - 7200), (2, now)):
+        chunk_key = 'active_job_id:%d' % chunk_number
+        await cache.set(chunk_key, chunk, ex=ConfigClass.CHUNK_KEY_TTL)
+        await cache.zadd('chunk_index:active_job_id', {chunk_key: uploaded_at})
+
+    sweeper = JobSweeper(interval=60, abandoned_timeout=3600)
+    report = await sweeper.sweep(now=now)
+
+    assert report['jobs'] == 1
+    assert report['keys'] == 4
+    assert report['bytes'] > 0
+    assert (
+        await cache.exists(
+            'abandoned_job_id:1', 'abandoned_job_id:2', 'chunk_config:abandoned_job_id', 'chunk_index:abandoned_job_id'
+        )
+        == 0
+    )
+    assert await cache.exists('active_job_id:1', 'active_job_id:2') == 2
+
+    response = await test_async_client.get(
+        '/v1/upload/status/abandoned_job_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    assert response.json()['result']['status'] == 'TERMINATED'
+    response = await test_async_client.get('/v1/upload/status/active_job_id', headers={'Session-Id': '1234'})
+    assert response.json()['result']['status'] == 'PRE_UPLOADED'
+
+    # the other worker will not sweep in the same interval
+    assert await sweeper.sweep(now=time.time() + 7200) is None
+
+
+async def test_job_status_change_should_only_write_changed_fields(test_async_client, httpx_mock, monkeypatch):
+    from app.commons.data_providers import redis_project_session_job
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    status_mgr = SessionJob('1234', 'any', 'me', 'hash_job_id')
+    status_mgr.set_source('any')
+    status_mgr.add_payload('resumable_identifier', 'hash_job_id')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    job_key = status_mgr.get_key()
+    assert await cache.type(job_key) == b'hash'
+
+    written_fields = []
+    session_job_transition = redis_project_session_job.session_job_transition
+
+    async def spy_transition(session_id, job_id, job_key, target_status, fields=None, **kwargs):
+        written_fields.extend(fields)
+        return await session_job_transition(session_id, job_id, job_key, target_status, fields, **kwargs)
+
+    monkeypatch.setattr(redis_project_session_job, 'session_job_transition', spy_transition)
+    status_mgr.set_progress(50)
+    await status_mgr.set_status(EState.CHUNK_UPLOADED.name)
+
+    assert 'progress' in written_fields
+    assert 'payload' not in written_fields and 'session_id' not in written_fields
+    assert json.loads(await cache.hget(job_key, 'status')) == EState.CHUNK_UPLOADED.name
+    assert json.loads(await cache.hget(job_key, 'progress')) == 50
+    assert json.loads(await cache.hget(job_key, 'payload')) == {'resumable_identifier': 'hash_job_id'}
+
+
+async def test_job_status_transition_should_be_rejected_when_not_allowed(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import (
+        EState,
+        InvalidStateTransition,
+        SessionJob,
+    )
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'transition_job_id')
+    status_mgr.set_source('any')
+    await status_mgr.set_status(EState.PRE_UPLOADED.name)
+    with pytest.raises(InvalidStateTransition):
+        await status_mgr.set_status(EState.SUCCEED.name)
+
+    # the stale writer can not overwrite the job terminated by others
+    stale_mgr = SessionJob('1234', 'any', 'me', 'transition_job_id')
+    await stale_mgr.read()
+    await status_mgr.set_status(EState.TERMINATED.name)
+    with pytest.raises(InvalidStateTransition) as e:
+        await stale_mgr.set_status(EState.CHUNK_UPLOADED.name)
+    assert e.value.current_status == EState.TERMINATED.name
+
+    response = await test_async_client.get(
+        '/v1/upload/status/transition_job_id', headers={'Session-Id': '1234'}, query_string={}
+    )
+    assert response.json()['result']['status'] == 'TERMINATED'
+    assert list(response.json()['result']['timeline']) == ['PRE_UPLOADED', 'TERMINATED']
+
+
+async def test_job_saved_as_json_string_should_be_read_and_replaced_with_hash(test_async_client, httpx_mock):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    status_mgr = SessionJob('1234', 'any', 'me', 'legacy_job_id')
+    status_mgr.set_source('any')
+    job_key, job_value, _ = status_mgr.get_kv_entity()
+    await cache.delete(job_key, 'upload_session_job_keys:1234')
+    await cache.set(job_key, job_value)
+
+    legacy_job = SessionJob('1234', 'any', 'me', 'legacy_job_id')
+    await legacy_job.read()
+    assert legacy_job.status == EState.INIT.name
+    await legacy_job.set_status(EState.PRE_UPLOADED.name)
+
+    assert await cache.type(job_key) == b'hash'
+    assert json.loads(await cache.hget(job_key, 'status')) == EState.PRE_UPLOADED.name
+    assert json.loads(await cache.hget(job_key, 'source')) == 'any'
+
+
+async def test_job_etag_should_not_change_with_json_serializer(test_async_client, httpx_mock, monkeypatch):
+    from app.commons import serializer
+    from app.routers.v1.api_data_upload import get_job_etag
+
+    job = {'job_id': 'job_id', 'status': 'SUCCEED', 'source': 'folder/файл.txt', 'progress': 100, 'payload': {}}
+    etags = []
+    for backend in ('json', 'orjson'):
+        monkeypatch.setattr(serializer, 'backend', serializer.get_serializer(backend))
+        etags.append(get_job_etag(job))
+    assert etags[0] == etags[1]
+
+    # the standard library is used when orjson is not installed
+    monkeypatch.setattr(serializer, 'orjson', None)
+    assert serializer.get_serializer('orjson').name == 'json'
+    with pytest.raises(ValueError):
+        serializer.get_serializer('msgpack')
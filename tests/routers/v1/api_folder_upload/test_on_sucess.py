@@ -14,9 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import json
 from unittest import mock
 
+import httpx
 import pytest
+from aioredis import StrictRedis
+from starlette.config import environ
 
 pytestmark = pytest.mark.asyncio  # set the mark to all tests in this file.
 
@@ -152,3 +157,392 @@ async def test_upload_any_file_should_return_200(
     assert result['operator'] == 'me'
     assert result['payload']['task_id'] == 'fake_global_entity_id'
     assert result['payload']['resumable_identifier'] == 'fake_global_entity_id'
+
+
+async def test_on_success_return_409_when_job_is_terminated(test_async_client, httpx_mock, create_fake_job):
+    from app.commons.data_providers.redis_project_session_job import EState, SessionJob
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_global_entity_id')
+    await status_mgr.read()
+    await status_mgr.set_status(EState.TERMINATED.name)
+
+    response = await test_async_client.post(
+        '/v1/files',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any',
+            'resumable_relative_path': './',
+            'resumable_total_chunks': 1,
+            'resumable_total_size': 10,
+        },
+    )
+    assert response.status_code == 409
+    assert response.json()['error_msg'] == 'Job fake_global_entity_id can not transit from TERMINATED to CHUNK_UPLOADED'
+
+
+@mock.patch('minio.credentials.providers._urlopen')
+@mock.patch('os.remove')
+async def test_upload_zip_should_record_finalize_stages_and_critical_path(
+    fake_remove,
+    fake_providers_urlopen,
+    test_async_client,
+    httpx_mock,
+    create_job_folder,
+    create_fake_job,
+    mock_boto3,
+    mock_kafka_producer,
+    on_success_external_requests,
+    mocker,
+):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    class FakeLastNode:
+        global_entity_id = 'fake_geid'
+
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', return_value=FakeLastNode())
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v1/archive', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files',
+        headers={'Session-Id': '1234', 'Authorization': 'token', 'Refresh-Token': 'refresh_token'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any.zip',
+            'resumable_relative_path': './',
+            'resumable_total_chunks': 1,
+            'resumable_total_size': 10,
+        },
+    )
+    assert response.status_code == 200
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_global_entity_id')
+    await status_mgr.read()
+    assert status_mgr.status == 'SUCCEED'
+    assert list(status_mgr.timeline) == ['PRE_UPLOADED', 'CHUNK_UPLOADED', 'FINALIZED', 'SUCCEED']
+    assert set(status_mgr.stage_durations) == {
+        'folder_creation',
+        'etag_fetch',
+        'combine',
+        'chunk_cleanup',
+        'metadata_create',
+        'zip_preview',
+        'zip_preview_save',
+        'kafka',
+        'finalize',
+    }
+    assert status_mgr.critical_path[0] in ('folder_creation', 'etag_fetch')
+    assert status_mgr.critical_path[-1] in ('kafka', 'zip_preview_save', 'chunk_cleanup')
+
+
+async def test_on_success_should_remove_combined_object_when_folder_creation_fails(
+    test_async_client, httpx_mock, create_job_folder, create_fake_job, mock_boto3, mock_kafka_producer, mocker
+):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    async def fail_folder_creation(*args):
+        # the folder creation fails after the chunks are combined
+        await asyncio.sleep(0.1)
+        raise Exception('fail to create folder')
+
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', new=fail_folder_creation)
+    delete_object = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.delete_object', new=mocker.AsyncMock()
+    )
+    httpx_mock.add_response(method='DELETE', url='http://DATAOPS_SERVICE/v2/resource/lock/', json={})
+
+    # the error of background finalize is raised by the test client
+    with pytest.raises(Exception, match='fail to create folder'):
+        await test_async_client.post(
+            '/v1/files',
+            headers={'Session-Id': '1234'},
+            json={
+                'project_code': 'any',
+                'operator': 'me',
+                'resumable_identifier': 'fake_global_entity_id',
+                'resumable_filename': 'any',
+                'resumable_relative_path': 'folder',
+                'resumable_total_chunks': 1,
+                'resumable_total_size': 10,
+            },
+        )
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_global_entity_id')
+    await status_mgr.read()
+    assert status_mgr.status == 'TERMINATED'
+    delete_object.assert_awaited_once_with('core-any', 'folder/any')
+
+
+@mock.patch('minio.credentials.providers._urlopen')
+@mock.patch('os.remove')
+async def test_on_success_should_trace_finalize_stages_linked_to_request(
+    fake_remove,
+    fake_providers_urlopen,
+    test_async_client,
+    httpx_mock,
+    create_job_folder,
+    create_fake_job,
+    mock_boto3,
+    mock_kafka_producer,
+    on_success_external_requests,
+    mocker,
+    monkeypatch,
+):
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    from app.resources import tracing
+
+    class FakeLastNode:
+        global_entity_id = 'fake_geid'
+
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', return_value=FakeLastNode())
+    exporter = InMemorySpanExporter()
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, 'tracer', tracer_provider.get_tracer('test'))
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    await cache.set('fake_global_entity_id:1', json.dumps({'ETag': 'etag', 'PartNumber': 1}))
+
+    with tracing.start_span('request') as request_span:
+        response = await test_async_client.post(
+            '/v1/files',
+            headers={'Session-Id': '1234', 'Authorization': 'token', 'Refresh-Token': 'refresh_token'},
+            json={
+                'project_code': 'any',
+                'operator': 'me',
+                'resumable_identifier': 'fake_global_entity_id',
+                'resumable_filename': 'any',
+                'resumable_relative_path': './',
+                'resumable_total_chunks': 1,
+                'resumable_total_size': 10,
+            },
+        )
+    assert response.status_code == 200
+
+    spans = {span.name: span for span in exporter.get_finished_spans()}
+    request_context = request_span.get_span_context()
+    worker_span = spans['upload.finalize_worker']
+    assert worker_span.context.trace_id == request_context.trace_id
+    assert [link.context.span_id for link in worker_span.links] == [request_context.span_id]
+    assert worker_span.attributes['upload.project_code'] == 'any'
+    assert worker_span.attributes['upload.part_count'] == 1
+    assert spans['upload.finalize'].parent.span_id == worker_span.context.span_id
+    assert spans['upload.combine'].parent.span_id == spans['upload.finalize'].context.span_id
+    assert spans['upload.combine'].attributes['upload.part_count'] == 1
+
+
+@mock.patch('minio.credentials.providers._urlopen')
+@mock.patch('os.remove')
+async def test_bulk_on_success_should_finalize_found_jobs_and_report_each_item(
+    fake_remove,
+    fake_providers_urlopen,
+    test_async_client,
+    httpx_mock,
+    create_job_folder,
+    create_fake_job,
+    mock_boto3,
+    mock_kafka_producer,
+    mocker,
+):
+    from app.commons.data_providers.redis import SrvAioRedisSingleton
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    class FakeLastNode:
+        global_entity_id = 'fake_geid'
+
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', return_value=FakeLastNode())
+    httpx_mock.add_response(
+        method='POST',
+        url='http://DATAOPS_SERVICE/v1/filedata/',
+        json={'result': {'id': 'fake_file_geid'}},
+        status_code=200,
+    )
+    httpx_mock.add_response(
+        method='DELETE',
+        url='http://DATAOPS_SERVICE/v2/resource/lock/bulk',
+        json={},
+        status_code=200,
+    )
+    redis_srv = SrvAioRedisSingleton()
+    await redis_srv.set_by_key('fake_global_entity_id:1', '{"PartNumber": 1, "ETag": "etag"}', 60)
+
+    item = {
+        'project_code': 'any',
+        'operator': 'me',
+        'resumable_identifier': 'fake_global_entity_id',
+        'resumable_filename': 'any',
+        'resumable_relative_path': './',
+        'resumable_total_chunks': 1,
+        'resumable_total_size': 10,
+    }
+    response = await test_async_client.post(
+        '/v1/files/bulk',
+        headers={'Session-Id': '1234'},
+        json={'items': [item, dict(item, resumable_identifier='missing_job')]},
+    )
+
+    assert response.status_code == 200
+    found, missing = response.json()['result']
+    assert found['code'] == 200
+    assert found['job']['status'] == 'CHUNK_UPLOADED'
+    assert missing == {
+        'job_id': 'missing_job',
+        'code': 404,
+        'error_msg': '[SessionJob] Not found job: missing_job',
+        'job': None,
+    }
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_global_entity_id')
+    await status_mgr.read()
+    assert status_mgr.status == 'SUCCEED'
+    assert status_mgr.payload['source_geid'] == 'fake_file_geid'
+    # the etags and folders are fetched once for the whole batch
+    assert set(status_mgr.stage_durations) == {'combine', 'metadata_create', 'kafka', 'finalize'}
+    assert not await redis_srv.check_by_key('fake_global_entity_id:1')
+
+
+async def test_bulk_on_success_return_400_when_job_is_duplicated(test_async_client, httpx_mock):
+    item = {
+        'project_code': 'any',
+        'operator': 'me',
+        'resumable_identifier': 'fake_global_entity_id',
+        'resumable_filename': 'any',
+        'resumable_relative_path': './',
+        'resumable_total_chunks': 1,
+        'resumable_total_size': 10,
+    }
+    response = await test_async_client.post(
+        '/v1/files/bulk', headers={'Session-Id': '1234'}, json={'items': [item, item]}
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'Duplicated resumable_identifier in items'
+
+
+@pytest.fixture
+async def bulk_finalize_jobs(monkeypatch, mocker, httpx_mock, mock_boto3, mock_kafka_producer):
+    from app.commons.data_providers.redis import SrvAioRedisSingleton
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+    from app.config import ConfigClass
+    from app.resources.metadata_batcher import metadata_batcher
+
+    class FakeLastNode:
+        global_entity_id = 'fake_geid'
+
+    monkeypatch.setattr(ConfigClass, 'METADATA_BATCH_ENABLED', True)
+    # the batch is sent once both files are in, however slow the machine is
+    monkeypatch.setattr(metadata_batcher, 'window', 5)
+    monkeypatch.setattr(metadata_batcher, 'max_size', 2)
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', return_value=FakeLastNode())
+    httpx_mock.add_response(method='DELETE', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={})
+
+    items = []
+    for job_id in ('fake_job_1', 'fake_job_2'):
+        job = SessionJob('1234', 'any', 'me', job_id)
+        job.set_source(job_id)
+        job.add_payload('task_id', job_id)
+        job.add_payload('resumable_identifier', job_id)
+        await job.set_status('PRE_UPLOADED')
+        await SrvAioRedisSingleton().set_by_key('%s:1' % job_id, '{"PartNumber": 1, "ETag": "etag"}', 60)
+        items.append(
+            {
+                'project_code': 'any',
+                'operator': 'me',
+                'resumable_identifier': job_id,
+                'resumable_filename': job_id,
+                'resumable_relative_path': 'folder',
+                'resumable_total_chunks': 1,
+                'resumable_total_size': 10,
+            }
+        )
+    return items
+
+
+async def test_bulk_on_success_should_create_file_items_in_one_batch(test_async_client, httpx_mock, bulk_finalize_jobs):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    batches = []
+
+    def create_items(request: httpx.Request):
+        batch = json.loads(request.content)['items']
+        batches.append(batch)
+        return httpx.Response(200, json={'result': batch})
+
+    httpx_mock.add_callback(create_items, method='POST', url='http://metadata_service/v1/items/batch/')
+
+    response = await test_async_client.post(
+        '/v1/files/bulk', headers={'Session-Id': '1234'}, json={'items': bulk_finalize_jobs}
+    )
+
+    assert response.status_code == 200
+    assert len(batches) == 1
+    assert [item['name'] for item in batches[0]] == ['fake_job_1', 'fake_job_2']
+    assert batches[0][0]['parent'] == 'fake_geid'
+    assert batches[0][0]['parent_path'] == 'folder'
+    for item in batches[0]:
+        status_mgr = SessionJob('1234', 'any', 'me', item['name'])
+        await status_mgr.read()
+        assert status_mgr.status == 'SUCCEED'
+        assert status_mgr.payload['source_geid'] == item['id']
+
+
+async def test_bulk_on_success_should_retry_failed_batch_one_by_one(test_async_client, httpx_mock, bulk_finalize_jobs):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    def create_items(request: httpx.Request):
+        batch = json.loads(request.content)['items']
+        if len(batch) > 1 or batch[0]['name'] == 'fake_job_2':
+            return httpx.Response(500, json={'error_msg': 'invalid item'})
+        return httpx.Response(200, json={'result': batch})
+
+    httpx_mock.add_callback(create_items, method='POST', url='http://metadata_service/v1/items/batch/')
+
+    response = await test_async_client.post(
+        '/v1/files/bulk', headers={'Session-Id': '1234'}, json={'items': bulk_finalize_jobs}
+    )
+
+    assert response.status_code == 200
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_job_1')
+    await status_mgr.read()
+    assert status_mgr.status == 'SUCCEED'
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_job_2')
+    await status_mgr.read()
+    assert status_mgr.status == 'TERMINATED'
+    assert status_mgr.payload['error_msg'] == 'Fail to create metadata in batch: {"error_msg": "invalid item"}'
+
+
+async def test_bulk_on_success_should_only_retry_items_not_created_in_batch(
+    test_async_client, httpx_mock, bulk_finalize_jobs
+):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    batches = []
+
+    def create_items(request: httpx.Request):
+        batch = json.loads(request.content)['items']
+        batches.append(batch)
+        # the batch fails after the first item is created
+        if len(batch) > 1:
+            return httpx.Response(500, json={'result': batch[:1]})
+        return httpx.Response(200, json={'result': batch})
+
+    httpx_mock.add_callback(create_items, method='POST', url='http://metadata_service/v1/items/batch/')
+
+    response = await test_async_client.post(
+        '/v1/files/bulk', headers={'Session-Id': '1234'}, json={'items': bulk_finalize_jobs}
+    )
+
+    assert response.status_code == 200
+    assert [[item['name'] for item in batch] for batch in batches] == [['fake_job_1', 'fake_job_2'], ['fake_job_2']]
+    for job_id in ('fake_job_1', 'fake_job_2'):
+        status_mgr = SessionJob('1234', 'any', 'me', job_id)
+        await status_mgr.read()
+        assert status_mgr.status == 'SUCCEED'
@@ -14,7 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
+import json
+from io import BytesIO
+
 import pytest
+from aioredis import StrictRedis
+from starlette.config import environ
+from urllib3 import encode_multipart_formdata
 
 pytestmark = pytest.mark.asyncio  # set the mark to all tests in this file.
 
@@ -76,3 +83,413 @@ async def test_upload_chunks_return_200_when_when_success(
         'num_of_pages': 1,
         'result': {'msg': 'Succeed'},
     }
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    assert await cache.zrange('chunk_index:fake_global_entity_id', 0, -1) == [b'fake_global_entity_id:1']
+
+
+async def test_upload_chunks_return_400_when_chunk_exceeds_negotiated_chunk_size(
+    test_async_client,
+    httpx_mock,
+    mock_boto3,
+):
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    await cache.set('chunk_config:fake_global_entity_id', json.dumps({'chunk_size': 1}))
+
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234'},
+        files={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any',
+            'resumable_chunk_number': str(1),
+            'resumable_total_chunks': str(1),
+            'resumable_total_size': str(10),
+            'chunk_data': ('chunk.txt', BytesIO(b'0123456789'), 'text/plain'),
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'Chunk size 10 exceeds the negotiated chunk size 1'
+
+
+async def test_upload_chunks_return_503_with_retry_after_when_worker_is_saturated(
+    test_async_client, httpx_mock, monkeypatch
+):
+    from app.resources.admission import chunk_admission
+
+    monkeypatch.setattr(chunk_admission, 'max_concurrency', 0)
+
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234'},
+        files={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any',
+            'resumable_chunk_number': str(1),
+            'resumable_total_chunks': str(1),
+            'resumable_total_size': str(10),
+            'chunk_data': ('chunk.txt', BytesIO(b'0123456789'), 'text/plain'),
+        },
+    )
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.json()['error_msg'] == 'Upload service is busy, please retry later'
+    assert chunk_admission.inflight_requests == 0
+
+
+@pytest.mark.parametrize('content_length', ['-1', 'abc'])
+async def test_upload_chunks_return_400_when_content_length_is_invalid(test_async_client, httpx_mock, content_length):
+    from app.resources.admission import chunk_admission
+
+    response = await test_async_client.post(
+        '/v1/files/chunks', headers={'Session-Id': '1234', 'Content-Length': content_length}, data=b'0123456789'
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'Invalid Content-Length header'
+    assert chunk_admission.inflight_requests == 0
+
+
+async def test_upload_chunks_return_429_with_retry_after_when_user_exceeds_rate_limit(
+    test_async_client, httpx_mock, mock_boto3, monkeypatch
+):
+    from app.config import ConfigClass
+
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_BURST_SECONDS', 1)
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_USER_CHUNK_BYTES', 1)
+
+    responses = []
+    for chunk_number in range(1, 3):
+        response = await test_async_client.post(
+            '/v1/files/chunks',
+            headers={'Session-Id': '1234'},
+            files={
+                'project_code': 'any',
+                'operator': 'me',
+                'resumable_identifier': 'fake_global_entity_id',
+                'resumable_filename': 'any',
+                'resumable_chunk_number': str(chunk_number),
+                'resumable_total_chunks': str(2),
+                'resumable_total_size': str(20),
+                'chunk_data': ('chunk.txt', BytesIO(b'0123456789'), 'text/plain'),
+            },
+        )
+        responses.append(response)
+
+    assert responses[0].status_code == 200
+    assert responses[1].status_code == 429
+    assert int(responses[1].headers['Retry-After']) >= 1
+    assert responses[1].json()['result']['retry_after'] > 0
+
+
+async def test_upload_chunks_should_throttle_before_reading_chunk_when_user_exceeds_rate_limit(
+    test_async_client, httpx_mock, mock_boto3, monkeypatch, mocker
+):
+    from starlette.datastructures import UploadFile
+
+    from app.config import ConfigClass
+
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_BURST_SECONDS', 1)
+    monkeypatch.setattr(ConfigClass, 'RATE_LIMIT_USER_CHUNK_BYTES', 1)
+    body, content_type = encode_multipart_formdata(
+        [
+            ('project_code', 'any'),
+            ('operator', 'throttled'),
+            ('resumable_identifier', 'fake_global_entity_id'),
+            ('resumable_filename', 'any'),
+            ('resumable_chunk_number', '1'),
+            ('resumable_total_chunks', '1'),
+            ('resumable_total_size', '10'),
+            ('chunk_data', ('chunk.txt', b'0123456789', 'text/plain')),
+        ]
+    )
+    headers = {'Session-Id': '1234', 'Content-Type': content_type, 'Content-Length': str(len(body))}
+
+    await test_async_client.post('/v1/files/chunks', headers=headers, data=body)
+    write = mocker.spy(UploadFile, 'write')
+    response = await test_async_client.post('/v1/files/chunks', headers=headers, data=body)
+
+    assert response.status_code == 429
+    assert response.json()['result']['retry_after'] > 0
+    write.assert_not_called()
+
+
+async def test_upload_chunks_should_not_charge_rate_limit_when_session_id_header_is_missing(
+    test_async_client, httpx_mock, mocker
+):
+    consume_rate_limit = mocker.patch(
+        'app.resources.chunk_ingestion.consume_rate_limit', new=mocker.AsyncMock(return_value=None)
+    )
+    body, content_type = get_chunk_body(b'0123456789')
+
+    response = await test_async_client.post('/v1/files/chunks', headers={'Content-Type': content_type}, data=body)
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'session_id is required'
+    consume_rate_limit.assert_not_called()
+
+
+async def test_upload_chunks_return_400_when_multipart_body_is_malformed(test_async_client, httpx_mock):
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234', 'Content-Type': 'multipart/form-data; boundary=abc'},
+        data=b'--abc\r\nContent-Type: text/plain\r\n\r\n0123456789\r\n--abc--\r\n',
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'There was an error parsing the body'
+
+
+async def test_upload_chunks_return_500_when_rate_limit_backend_fails(test_async_client, httpx_mock, mocker):
+    from aioredis.exceptions import ConnectionError as RedisConnectionError
+
+    mocker.patch(
+        'app.resources.chunk_ingestion.consume_rate_limit',
+        new=mocker.AsyncMock(side_effect=RedisConnectionError('redis is down')),
+    )
+    body, content_type = get_chunk_body(b'0123456789')
+
+    with pytest.raises(RedisConnectionError):
+        await test_async_client.post(
+            '/v1/files/chunks', headers={'Session-Id': '1234', 'Content-Type': content_type}, data=body
+        )
+
+
+@pytest.mark.parametrize('spool_max_size,spooled', [(4 * 1024 * 1024, False), (1024, True)])
+async def test_upload_chunks_should_spool_chunk_to_disk_only_over_spool_max_size(
+    test_async_client, httpx_mock, mock_boto3, monkeypatch, mocker, tmp_path, spool_max_size, spooled
+):
+    from prometheus_client import REGISTRY
+
+    from app.config import ConfigClass
+
+    monkeypatch.setattr(ConfigClass, 'CHUNK_SPOOL_MAX_SIZE', spool_max_size)
+    monkeypatch.setattr(ConfigClass, 'CHUNK_SPOOL_DIR', str(tmp_path))
+    part_upload = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.part_upload',
+        new=mocker.AsyncMock(return_value={'ETag': 'etag', 'PartNumber': 1}),
+    )
+    avoided_bytes = REGISTRY.get_sample_value('upload_chunk_spool_avoided_bytes_total')
+    spooled_bytes = REGISTRY.get_sample_value('upload_chunk_spooled_bytes_total')
+
+    chunk = b'0' * 2 * 1024 * 1024
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234'},
+        files={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any',
+            'resumable_chunk_number': str(1),
+            'resumable_total_chunks': str(1),
+            'resumable_total_size': str(len(chunk)),
+            'chunk_data': ('chunk.txt', BytesIO(chunk), 'application/octet-stream'),
+        },
+    )
+
+    assert response.status_code == 200
+    assert part_upload.call_args[0][4] == chunk
+    assert REGISTRY.get_sample_value('upload_chunk_spooled_bytes_total') - spooled_bytes == (
+        len(chunk) if spooled else 0
+    )
+    assert REGISTRY.get_sample_value('upload_chunk_spool_avoided_bytes_total') - avoided_bytes == (
+        0 if spooled else len(chunk)
+    )
+
+
+def get_chunk_body(chunk: bytes):
+    return encode_multipart_formdata(
+        {
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_global_entity_id',
+            'resumable_filename': 'any',
+            'resumable_chunk_number': '1',
+            'resumable_total_chunks': '1',
+            'resumable_total_size': str(len(chunk)),
+            'chunk_data': ('chunk.txt', chunk, 'application/octet-stream'),
+        }
+    )
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    if encoding == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        return zstandard.ZstdCompressor().compress(body)
+    return gzip.compress(body)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+async def test_upload_chunks_should_decompress_body_when_content_encoding_is_set(
+    test_async_client, httpx_mock, mock_boto3, mocker, encoding
+):
+    from prometheus_client import REGISTRY
+
+    part_upload = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.part_upload',
+        new=mocker.AsyncMock(return_value={'ETag': 'etag', 'PartNumber': 1}),
+    )
+    decompressed_bytes = REGISTRY.get_sample_value('upload_chunk_decompressed_bytes_total', {'encoding': encoding}) or 0
+
+    chunk = b'0123456789' * 100 * 1024
+    body, content_type = get_chunk_body(chunk)
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234', 'Content-Type': content_type, 'Content-Encoding': encoding},
+        data=compress(encoding, body),
+    )
+
+    assert response.status_code == 200
+    assert part_upload.call_args[0][4] == chunk
+    assert REGISTRY.get_sample_value(
+        'upload_chunk_decompressed_bytes_total', {'encoding': encoding}
+    ) - decompressed_bytes == len(body)
+
+
+@pytest.mark.parametrize(
+    'encoding,body_size,code',
+    [
+        ('br', 10, 415),
+        ('gzip', 10, 400),
+        ('gzip', 2 * 1024 * 1024, 413),
+        ('zstd', 10, 400),
+        ('zstd', 2 * 1024 * 1024, 413),
+    ],
+)
+async def test_upload_chunks_should_reject_body_when_it_cannot_be_decompressed(
+    test_async_client, httpx_mock, mock_boto3, monkeypatch, encoding, body_size, code
+):
+    from app.config import ConfigClass
+    from app.resources import chunk_ingestion
+
+    monkeypatch.setattr(ConfigClass, 'CHUNK_SIZE_MAX', 1024)
+    monkeypatch.setattr(chunk_ingestion, '_FORM_MAX_OVERHEAD', 1024)
+
+    body, content_type = get_chunk_body(b'0' * body_size)
+    data = compress(encoding, body) if encoding == 'zstd' else gzip.compress(body)
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234', 'Content-Type': content_type, 'Content-Encoding': encoding},
+        data=data[:-8] if code == 400 else data,
+    )
+
+    assert response.status_code == code
+
+
+async def test_upload_chunks_should_charge_compressed_body_as_the_negotiated_chunk_size(
+    test_async_client, httpx_mock, mock_boto3, mocker
+):
+    from app.resources.admission import chunk_admission
+
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    await cache.set('chunk_config:fake_global_entity_id', json.dumps({'chunk_size': 4096}))
+    try_acquire = mocker.spy(chunk_admission, 'try_acquire')
+    resize = mocker.spy(chunk_admission, 'resize')
+    body, content_type = get_chunk_body(b'0' * 1024)
+    data = gzip.compress(body)
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={
+            'Session-Id': '1234',
+            'Content-Type': content_type,
+            'Content-Encoding': 'gzip',
+            'Content-Length': str(len(data)),
+        },
+        data=data,
+    )
+
+    assert response.status_code == 200
+    try_acquire.assert_called_once_with(len(data))
+    resize.assert_called_once_with(len(data), 4096)
+    assert chunk_admission.inflight_bytes == 0
+
+
+async def test_upload_chunks_return_413_when_compressed_body_exceeds_negotiated_chunk_size(
+    test_async_client, httpx_mock, mock_boto3
+):
+    from app.resources.chunk_ingestion import _FORM_MAX_OVERHEAD
+
+    cache = StrictRedis(host=environ.get('REDIS_HOST', 'localhost'), port=int(environ.get('REDIS_PORT', '6379')))
+    await cache.set('chunk_config:fake_global_entity_id', json.dumps({'chunk_size': 1024}))
+    body, content_type = get_chunk_body(b'0' * (_FORM_MAX_OVERHEAD + 4096))
+    response = await test_async_client.post(
+        '/v1/files/chunks',
+        headers={'Session-Id': '1234', 'Content-Type': content_type, 'Content-Encoding': 'gzip'},
+        data=gzip.compress(body),
+    )
+
+    assert response.status_code == 413
+
+
+async def test_zstd_decoder_should_cap_output_at_max_length():
+    zstandard = pytest.importorskip('zstandard')
+    from app.resources.chunk_ingestion import ZstdDecoder
+
+    bomb = zstandard.ZstdCompressor().compress(b'0' * 64 * 1024 * 1024)
+
+    assert len(ZstdDecoder().decompress(bomb, 1024)) == 1024
+
+
+async def test_upload_chunks_should_sample_chunk_logs_and_write_them_in_background(
+    test_async_client, httpx_mock, mock_boto3, mocker
+):
+    import logging
+    import threading
+
+    from app.commons.logger import LoggerFactory, LogSamplingFilter, log_dispatcher
+
+    mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.part_upload',
+        new=mocker.AsyncMock(return_value={'ETag': 'etag', 'PartNumber': 1}),
+    )
+
+    class CollectHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append((self.format(record), threading.current_thread()))
+
+    # all the chunks are uploaded in the same second
+    logger = LoggerFactory('api_data_upload').get_logger()
+    sampling_filter = next(f for f in logger.filters if isinstance(f, LogSamplingFilter))
+    mocker.patch.object(sampling_filter, 'max_per_second', 1)
+    mocker.patch.object(sampling_filter, '_windows', {})
+    mocker.patch('app.commons.logger.time', monotonic=lambda: 100.0)
+    handler = CollectHandler()
+    mocker.patch.dict(log_dispatcher.handlers, {'api_data_upload': [handler]})
+
+    for chunk_number in range(1, 4):
+        response = await test_async_client.post(
+            '/v1/files/chunks',
+            headers={'Session-Id': '1234'},
+            files={
+                'project_code': 'any',
+                'operator': 'me',
+                'resumable_identifier': 'fake_global_entity_id',
+                'resumable_filename': 'any',
+                'resumable_chunk_number': str(chunk_number),
+                'resumable_total_chunks': str(3),
+                'resumable_total_size': str(30),
+                'chunk_data': ('chunk.txt', BytesIO(b'0123456789'), 'text/plain'),
+            },
+        )
+        assert response.status_code == 200
+
+    # flush the queued records
+    log_dispatcher.stop()
+    log_dispatcher.start()
+
+    uploading = [message for message, _ in handler.messages if 'Uploading file' in message]
+    assert len(uploading) == 1
+    assert 'Uploading file any chunk 1' in uploading[0]
+    assert all(thread is not threading.main_thread() for _, thread in handler.messages)
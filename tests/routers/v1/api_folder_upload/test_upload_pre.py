@@ -199,3 +199,106 @@ async def test_files_jobs_adds_folder_should_return_200_when_success(
     assert result['action'] == 'data_upload'
     assert result['status'] == 'PRE_UPLOADED'
     assert result['operator'] == 'me'
+
+
+async def test_files_jobs_should_return_recommended_chunk_size_based_on_file_size(
+    test_async_client, httpx_mock, create_job_folder, mock_boto3, mocker
+):
+
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=any&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={}, status_code=200)
+
+    # 200GB file cannot fit into 10000 parts with default 2MB chunk
+    file_size = 200 * 1024 * 1024 * 1024
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [{'resumable_filename': 'any', 'resumable_total_size': file_size}],
+            'negotiate_chunk_size': True,
+        },
+    )
+    assert response.status_code == 200
+    chunk_size = response.json()['result'][0]['payload']['chunk_size']
+    assert chunk_size == 21 * 1024 * 1024
+    assert file_size / chunk_size <= 10000
+
+
+async def test_files_jobs_should_keep_default_chunk_size_for_legacy_client_under_load(
+    test_async_client, httpx_mock, create_job_folder, mock_boto3, mocker
+):
+    from app.commons.data_providers.redis import SrvAioRedisSingleton
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+    from app.config import ConfigClass
+    from app.resources.chunk_size import get_negotiated_chunk_size
+
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+    mocker.patch('app.routers.v1.api_data_upload.get_server_load', return_value=1.0)
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=any&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [{'resumable_filename': 'any', 'resumable_total_size': 10 * 1024 * 1024}],
+        },
+    )
+    assert response.status_code == 200
+    job = response.json()['result'][0]
+    assert job['payload']['chunk_size'] == ConfigClass.CHUNK_SIZE_DEFAULT
+
+    # neither the chunks nor the number of chunks are checked
+    status_mgr = SessionJob('1234', 'any', 'me', job['job_id'])
+    await status_mgr.read()
+    assert get_negotiated_chunk_size(status_mgr.payload) is None
+    # the response is the record written in redis
+    assert job['payload'] == status_mgr.payload
+    assert job['timeline'] == status_mgr.timeline
+    assert await SrvAioRedisSingleton().get_by_key('chunk_config:%s' % job['job_id']) is None
+
+
+async def test_files_jobs_return_400_when_file_size_exceeds_upload_limit(test_async_client, httpx_mock, mocker):
+
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=any&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [{'resumable_filename': 'any', 'resumable_total_size': 10 * 1024**4}],
+        },
+    )
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'File size %s exceeds the upload limit' % (10 * 1024**4)
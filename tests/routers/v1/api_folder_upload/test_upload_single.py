@@ -0,0 +1,266 @@
+# PILOT
+# Copyright (C) 2022 Indoc Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from io import BytesIO
+
+import pytest
+
+pytestmark = pytest.mark.asyncio  # set the mark to all tests in this file.
+
+
+@pytest.fixture
+async def create_small_file_job():
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    job = SessionJob('1234', 'any', 'me', 'fake_small_file_id')
+    job.set_source('any')
+    job.add_payload('task_id', 'fake_small_file_id')
+    job.add_payload('resumable_identifier', 'fake_small_file_id')
+    job.add_payload('upload_mode', 'SINGLE')
+    await job.set_status('PRE_UPLOADED')
+
+
+def get_single_upload_form(**kwargs) -> dict:
+    form = {
+        'project_code': 'any',
+        'operator': 'me',
+        'resumable_identifier': 'fake_small_file_id',
+        'resumable_filename': 'any',
+        'resumable_relative_path': 'folder',
+        'resumable_total_size': str(10),
+        'file_data': ('any', BytesIO(b'0123456789'), 'text/plain'),
+    }
+    form.update(kwargs)
+    return form
+
+
+async def test_files_jobs_should_negotiate_single_upload_for_small_file(
+    test_async_client, httpx_mock, mock_boto3, mocker
+):
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+    prepare_multipart_upload = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.prepare_multipart_upload',
+        new=mocker.AsyncMock(return_value=['upload_id']),
+    )
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=small&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=large&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [
+                {'resumable_filename': 'small', 'resumable_total_size': 10},
+                {'resumable_filename': 'large', 'resumable_total_size': 10 * 1024 * 1024},
+            ],
+            'single_upload': True,
+        },
+    )
+
+    assert response.status_code == 200
+    small, large = response.json()['result']
+    assert small['payload']['upload_mode'] == 'SINGLE'
+    assert small['job_id'] != 'upload_id'
+    assert large['payload']['upload_mode'] == 'MULTIPART'
+    assert large['job_id'] == 'upload_id'
+    # only the large file starts the multipart upload
+    assert prepare_multipart_upload.call_args[0][1] == ['/large']
+
+
+async def test_files_jobs_should_keep_multipart_upload_for_small_file_of_legacy_client(
+    test_async_client, httpx_mock, mock_boto3, mocker
+):
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+    prepare_multipart_upload = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.prepare_multipart_upload',
+        new=mocker.AsyncMock(return_value=['upload_id']),
+    )
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=small&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [{'resumable_filename': 'small', 'resumable_total_size': 10}],
+        },
+    )
+
+    assert response.status_code == 200
+    small = response.json()['result'][0]
+    assert small['payload']['upload_mode'] == 'MULTIPART'
+    assert small['job_id'] == 'upload_id'
+    assert prepare_multipart_upload.call_args[0][1] == ['/small']
+
+
+async def test_files_jobs_should_keep_multipart_upload_for_empty_file_when_single_upload_is_disabled(
+    test_async_client, httpx_mock, mock_boto3, mocker, monkeypatch
+):
+    from app.config import ConfigClass
+
+    monkeypatch.setattr(ConfigClass, 'SMALL_FILE_MAX_SIZE', 0)
+    mocker.patch('common.ProjectClient.get', return_value={'any': 'any', 'global_entity_id': 'fake_global_entity_id'})
+    mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.prepare_multipart_upload',
+        new=mocker.AsyncMock(return_value=['upload_id']),
+    )
+    httpx_mock.add_response(
+        method='GET',
+        url='http://metadata_service/v1/items/search/?parent_path=&name=empty&'
+        'container_code=any&archived=false&zone=1&recursive=false',
+        json={'result': []},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='POST', url='http://DATAOPS_SERVICE/v2/resource/lock/bulk', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files/jobs',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'job_type': 'AS_FILE',
+            'data': [{'resumable_filename': 'empty', 'resumable_total_size': 0}],
+            'single_upload': True,
+        },
+    )
+
+    assert response.status_code == 200
+    empty = response.json()['result'][0]
+    assert empty['payload']['upload_mode'] == 'MULTIPART'
+    assert empty['job_id'] == 'upload_id'
+
+
+async def test_upload_chunks_return_400_when_job_is_single_upload(test_async_client, httpx_mock, mocker):
+    from app.commons import serializer
+    from app.commons.data_providers.redis import SrvAioRedisSingleton
+
+    part_upload = mocker.patch(
+        'common.object_storage_adaptor.boto3_client.Boto3Client.part_upload', new=mocker.AsyncMock()
+    )
+    await SrvAioRedisSingleton().set_by_key(
+        'chunk_config:fake_small_file_id', serializer.dumps({'upload_mode': 'SINGLE'}), 60
+    )
+
+    form = get_single_upload_form(resumable_chunk_number='1', resumable_total_chunks='1')
+    form['chunk_data'] = form.pop('file_data')
+    response = await test_async_client.post('/v1/files/chunks', headers={'Session-Id': '1234'}, files=form)
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == (
+        'Job fake_small_file_id is negotiated for single upload, upload the file with /v1/files/single'
+    )
+    part_upload.assert_not_called()
+
+
+async def test_on_success_return_400_when_job_is_single_upload(test_async_client, httpx_mock, create_small_file_job):
+    response = await test_async_client.post(
+        '/v1/files',
+        headers={'Session-Id': '1234'},
+        json={
+            'project_code': 'any',
+            'operator': 'me',
+            'resumable_identifier': 'fake_small_file_id',
+            'resumable_filename': 'any',
+            'resumable_relative_path': 'folder',
+            'resumable_total_chunks': 1,
+            'resumable_total_size': 10,
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == (
+        'Job fake_small_file_id is negotiated for single upload, upload the file with /v1/files/single'
+    )
+
+
+async def test_upload_single_should_put_file_and_finish_job(
+    test_async_client, httpx_mock, create_small_file_job, mock_kafka_producer, mocker
+):
+    from app.commons.data_providers.redis_project_session_job import SessionJob
+
+    class FakeLastNode:
+        global_entity_id = 'fake_geid'
+
+    mocker.patch('app.routers.v1.api_data_upload.folder_creation', return_value=FakeLastNode())
+    put_object = mocker.patch('app.routers.v1.api_data_upload.put_object', return_value={'VersionId': 'fake_version'})
+    httpx_mock.add_response(
+        method='POST',
+        url='http://DATAOPS_SERVICE/v1/filedata/',
+        json={'result': {'id': 'fake_file_geid'}},
+        status_code=200,
+    )
+    httpx_mock.add_response(method='DELETE', url='http://DATAOPS_SERVICE/v2/resource/lock/', json={}, status_code=200)
+
+    response = await test_async_client.post(
+        '/v1/files/single', headers={'Session-Id': '1234'}, files=get_single_upload_form()
+    )
+
+    assert response.status_code == 200
+    assert response.json()['result']['status'] == 'SUCCEED'
+    assert put_object.call_args[0][1:] == ('core-any', 'folder/any', b'0123456789')
+
+    status_mgr = SessionJob('1234', 'any', 'me', 'fake_small_file_id')
+    await status_mgr.read()
+    assert status_mgr.payload['source_geid'] == 'fake_file_geid'
+    assert list(status_mgr.timeline) == ['PRE_UPLOADED', 'CHUNK_UPLOADED', 'FINALIZED', 'SUCCEED']
+    assert set(status_mgr.stage_durations) == {'folder_creation', 'object_put', 'metadata_create', 'kafka', 'finalize'}
+
+
+async def test_upload_single_return_400_when_job_is_multipart(test_async_client, httpx_mock, create_fake_job):
+    response = await test_async_client.post(
+        '/v1/files/single',
+        headers={'Session-Id': '1234'},
+        files=get_single_upload_form(resumable_identifier='fake_global_entity_id'),
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'Job fake_global_entity_id is not negotiated for single upload'
+
+
+async def test_upload_single_return_400_when_size_does_not_match(test_async_client, httpx_mock, create_small_file_job):
+    response = await test_async_client.post(
+        '/v1/files/single', headers={'Session-Id': '1234'}, files=get_single_upload_form(resumable_total_size='11')
+    )
+
+    assert response.status_code == 400
+    assert response.json()['error_msg'] == 'File size 10 does not match the single upload of 11 bytes'